@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
+import argparse
 import configparser
 import datetime as dt
 import os
 import shutil
 import traceback
 import pathlib as pl
-from utilities.run_log_command import run_shell_command, OvernightLogger
+from utilities.run_log_command import run_shell_command, OvernightLogger, configure_command_timeouts, \
+    configure_run_log, flush_logs, log_phase, shutdown_logging
+from utilities.run_log_store import RunLogStore, run_log_db, run_log_directory
 
 from system_control.manage_google_drive import ManageGoogleDrive
 from manage_users.create_resident_list import CreateUserList
 import config_private as pvt
 import tempfile as tf
 from system_control import system_manager as sm
+from system_control import rclone_rc
+from system_control import transfer_scheduler
+from utilities.send_email import stop_mail_worker
+from utilities import metrics, profiling, tracing
+from utilities.subprocess_accounting import get_accounting
 import yaml
 import system_control.manage_google_drive as mgd
+from new_content.conversion_cache import configure_conversion_cache, get_conversion_cache
+from new_content.docx_conversion import configure_docx_conversion, stop_docx_conversion
+from new_content.validate_documents import ValidateDocuments
+from new_content.shortcode_index import update_index
 
 
 import json
@@ -21,7 +33,7 @@ import json
 
 # RClone config file in /home/don/.config/rclone/rclone.conf
 
-def driver():
+def driver(force_reprocess=False, validate_only=None):
     try:
         # Use environment variable to determine user for accessing config file
         # machine dependencies.  When running in PyCharm, define in run configuration.
@@ -45,130 +57,280 @@ def driver():
     sst_directory = config[sst_user]['SSTDirectory']
     sst_support_directory = config[sst_user]['supportDirectory']
 
+    # Every log entry of the run is also written with its run id, folder, command, ... to runs/<run_id>.jsonl
+    run_started = dt.datetime.now()
+    run_id = run_started.strftime('%Y%m%d-%H%M%S')
+    run_log = configure_run_log(run_log_directory(logs_directory), run_id)
+    if config.getboolean('performance', 'tracing', fallback=False):
+        tracing.configure_tracing(max_spans=config.getint('performance', 'traceMaxSpans', fallback=200000))
+    _configure_profiling(config, logs_directory, run_id)
     summary_logger = OvernightLogger('sst_utils_log', logs_directory)  # Logger - see use below
     summary_logger.make_info_entry(f"Begin sst_utils run ")
 
-    if pvt.sst_management:
-        summary_logger.make_info_entry(f"Begin command processing")
-        # commands.txt user prefix set with: os.environ["USER_PREFIX"] of the form "username_"
-        # where username must exist in config_users.yaml
-        sys_mgr = sm.SystemManager()
-        sys_mgr.run_command_processor()
-        summary_logger.make_info_entry(f"Complete command processing")
-
-    if pvt.build_user_list or pvt.build_staff_list or pvt.build_horizon_list:
-        summary_logger.make_info_entry(f"Begin login list processing")
-        # Copy Sunnyside Resident Phone Directory from google drive (SSTmanagement/UserData) to
-        # a temporary directory.  Parse and convert the file to build user login csv file for residents
-        try:
-            sst_logger = OvernightLogger('build_user_list', logs_directory)
-            sst_logger.make_info_entry('Start User Login Creation')
-
-            resident_phone_list = "Sunnyside Resident Phone Directory. 01-2022.xls"
-            staff_phone_list = "Sunnyside Staff Directory. 01-2022.xls"
-            horizon_club_list = "Horizon_club.xls"
-            google_drive_dir = "SSTmanagement/UserData/"
-            temps = temp_directory + 'user_list_temp/'
-            if os.path.exists(temps):  # Anything from prior runs is gone
-                shutil.rmtree(temps)
-            os.mkdir(temps)
-
-            res_list_processor = CreateUserList(sst_logger, temps, google_drive_dir)
-            if pvt.build_user_list:
-                res_list_processor.process_resident_directory(resident_phone_list)
-            if pvt.build_staff_list:
-                res_list_processor.process_staff_directory(staff_phone_list)
-            if pvt.build_horizon_list:
-                res_list_processor.process_horizon_directory(horizon_club_list)
-
-            # Log completion
-            sst_logger.make_info_entry('Complete User Login Creation')
-            sst_logger.close_logger()
-            summary_logger.make_info_entry('build_user_list completed normally')
-        except Exception as e:
-            summary_logger.make_error_entry('build_user_list failed with exception: {}'.format(e.args))
+    # Whatever happens to the run, its reports are written, the mail worker sends the error digests and the
+    # logs are written out
+    try:
+        if config.getboolean('rclone', 'useRemoteControl', fallback=False):
+            # Falls back to an rclone subprocess per drive call if the daemon cannot be started
+            rclone_rc.start_remote_control(summary_logger, rc_address=config['rclone']['rcAddress'],
+                                           rclone_command=config['rclone']['rcloneCommand'])
+        # Hung rclone or pandoc processes are killed rather than stalling the run
+        configure_command_timeouts(timeout=config.getint('performance', 'commandTimeout', fallback=0) or None,
+                                   idle_timeout=config.getint('performance', 'commandIdleTimeout', fallback=0) or None)
+        mgd.configure_rclone(rclone_command=config.get('rclone', 'rcloneCommand', fallback='rclone'),
+                             transfers=config.getint('rclone', 'transfers', fallback=4))
+        transfer_scheduler.configure_scheduler(max_concurrency=config.getint('rclone', 'maxConcurrency', fallback=8),
+                                               min_concurrency=config.getint('rclone', 'minConcurrency', fallback=1),
+                                               rate=config.getfloat('rclone', 'callsPerSecond', fallback=10.0),
+                                               burst=config.getint('rclone', 'callBurst', fallback=10),
+                                               max_retries=config.getint('rclone', 'maxRetries', fallback=6),
+                                               base_delay=config.getfloat('rclone', 'retryBaseDelay', fallback=1.0),
+                                               max_delay=config.getfloat('rclone', 'retryMaxDelay', fallback=64.0))
 
-    if pvt.create_combined_login:
-        # Copy current login lists from Google Drive, combine them and move to sst/support/users.csv
-        try:
-            summary_logger.make_info_entry(f"Begin create combined login")
-
-            resident_phone_list = "Sunnyside Resident Phone Directory. 01-2022.xls"
-            staff_phone_list = "Sunnyside Staff Directory. 01-2022.xls"
-            # TODO: move directory to config file, check if this is right way to handle temps
-            google_drive_dir = "SSTmanagement/UserData/"
-            temps = temp_directory + 'user_list_temp/'
-            if os.path.exists(temps):  # Anything from prior runs is gone
-                shutil.rmtree(temps)
-            os.mkdir(temps)
-
-            files = ['residents.csv', 'staff.csv', 'horizon.csv']
-            outfile = 'users.csv'
-            res_list_processor = CreateUserList(summary_logger, temps, google_drive_dir)
-            res_list_processor.get_all_users(files, outfile)
-
-            shutil.copy(temps + 'users.csv', sst_support_directory + 'users.csv')
-
-            # Log completion
-            summary_logger.make_info_entry('Complete Creation of sst/support/users.csv')
-        except Exception as e:
-            summary_logger.make_error_entry('build_users_csv failed with exception: {}'.format(e.args))
+        listing_ttl = config.getint('cache', 'listingTtl', fallback=0)
+        if listing_ttl:
+            listing_cache_file = config.get('cache', 'listingCacheFile', fallback='')
+            mgd.configure_listing_cache(ttl=listing_ttl,
+                                        max_entries=config.getint('cache', 'listingMaxEntries', fallback=5000),
+                                        cache_file=temp_directory + listing_cache_file if listing_cache_file else None)
+        if config.getboolean('cache', 'incrementalDownloads', fallback=False):
+            mgd.configure_manifest(temp_directory + 'drive_manifest.sqlite', temp_directory + 'drive_mirror/')
+            blob_store_mb = config.getint('cache', 'blobStoreMaxMb', fallback=0)
+            if blob_store_mb:
+                mgd.configure_blob_store(temp_directory + 'blob_store/', blob_store_mb * 1024 * 1024)
+        conversion_cache_mb = config.getint('cache', 'conversionCacheMb', fallback=0)
+        if conversion_cache_mb:
+            configure_conversion_cache(temp_directory + 'pandoc_cache/', conversion_cache_mb * 1024 * 1024)
+        if config.getboolean('performance', 'parallelConversion', fallback=False):
+            configure_docx_conversion(max_workers=config.getint('performance', 'pandocWorkers', fallback=0) or None)
 
-    if pvt.prototyping:
-        """Scan for page urls."""
-        summary_logger.make_info_entry(f"Begin prototyping run")
-        target_directory = temp_directory + 'worktemp/'
+        # A validate only run checks the shortcodes of the documents below validate_only ('' = the whole
+        # management tree) and does nothing else
+        run_jobs = validate_only is None
+        if not run_jobs:
+            with log_phase(summary_logger, 'validate_documents'):
+                ValidateDocuments(summary_logger, validate_only or config['drive paths']['driveSSTManagement'],
+                                  temp_directory).validate()
 
-        foo = 3
+        if run_jobs and pvt.sst_management:
+            summary_logger.make_info_entry(f"Begin command processing")
+            # commands.txt user prefix set with: os.environ["USER_PREFIX"] of the form "username_"
+            # where username must exist in config_users.yaml
+            with tracing.span('command_processing'), profiling.profile('command_processing'):
+                sys_mgr = sm.SystemManager(force_reprocess=force_reprocess)
+                sys_mgr.run_command_processor()
+            summary_logger.make_info_entry(f"Complete command processing")
 
+        if run_jobs and (pvt.build_user_list or pvt.build_staff_list or pvt.build_horizon_list):
+            summary_logger.make_info_entry(f"Begin login list processing")
+            # Copy Sunnyside Resident Phone Directory from google drive (SSTmanagement/UserData) to
+            # a temporary directory.  Parse and convert the file to build user login csv file for residents
+            try:
+                sst_logger = OvernightLogger('build_user_list', logs_directory)
+                sst_logger.make_info_entry('Start User Login Creation')
 
-    if False and pvt.prototyping:
-        """Modify meta_paths in directory containing possibly recursive structure of files. """
-        drive_dir_to_download = config['drive paths']['driveAdmin'] + config['drive paths']['driveMinutes']
-        target_directory = work_directory + 'worktemp/'
-        test_dir = temp_directory + 'fix_meta_paths/'
-        path_element_to_find = 'pages/aa-activities-index'
-        path_element_to_replace = 'pages'
-        try:
-            for root, dirs, files in os.walk(test_dir):
-                print(f"{root}")
-                # for dir in dirs:
-                #     print(f"    DIR:  {dir}")
-                # for file in files:
-                #     print(f"    FILE: {file}")
-                if 'meta.txt' in files:
-                    meta_path = os.path.join(root, 'meta.txt')
-                    changed = False
-                    try:
-                        with open(meta_path) as stream:
-                            story_meta_tmp = yaml.safe_load(stream.read().replace('\t', ' '))
-                            if not story_meta_tmp:
-                                print(f"meta.txt is empty")
-                            else:
-                                path = story_meta_tmp['.. path']
-                                print(f"{path}")
-                                if path_element_to_find in path:
-                                    path_new = path.replace(path_element_to_find, path_element_to_replace)
-                                    print(f"\nOLD: {path}")
-                                    print(f"NEW: {path_new}")
-                                    story_meta_tmp['.. path'] = path_new
-                                    changed = True
-                            stream.close()
-                        if changed:
-                            with open(meta_path, 'w') as stream:
-                                yaml.safe_dump(story_meta_tmp, stream)
+                resident_phone_list = "Sunnyside Resident Phone Directory. 01-2022.xls"
+                staff_phone_list = "Sunnyside Staff Directory. 01-2022.xls"
+                horizon_club_list = "Horizon_club.xls"
+                google_drive_dir = "SSTmanagement/UserData/"
+                temps = temp_directory + 'user_list_temp/'
+                if os.path.exists(temps):  # Anything from prior runs is gone
+                    shutil.rmtree(temps)
+                os.mkdir(temps)
+
+                res_list_processor = CreateUserList(sst_logger, temps, google_drive_dir)
+                phone_lists = [resident_phone_list] if pvt.build_user_list else []
+                phone_lists += [staff_phone_list] if pvt.build_staff_list else []
+                phone_lists += [horizon_club_list] if pvt.build_horizon_list else []
+                res_list_processor.fetch_files(phone_lists)
+                if pvt.build_user_list:
+                    res_list_processor.process_resident_directory(resident_phone_list)
+                if pvt.build_staff_list:
+                    res_list_processor.process_staff_directory(staff_phone_list)
+                if pvt.build_horizon_list:
+                    res_list_processor.process_horizon_directory(horizon_club_list)
+
+                # Log completion
+                sst_logger.make_info_entry('Complete User Login Creation')
+                sst_logger.close_logger()
+                summary_logger.make_info_entry('build_user_list completed normally')
+            except Exception as e:
+                summary_logger.make_error_entry('build_user_list failed with exception: {}'.format(e.args))
+
+        if run_jobs and pvt.create_combined_login:
+            # Copy current login lists from Google Drive, combine them and move to sst/support/users.csv
+            try:
+                summary_logger.make_info_entry(f"Begin create combined login")
+
+                resident_phone_list = "Sunnyside Resident Phone Directory. 01-2022.xls"
+                staff_phone_list = "Sunnyside Staff Directory. 01-2022.xls"
+                # TODO: move directory to config file, check if this is right way to handle temps
+                google_drive_dir = "SSTmanagement/UserData/"
+                temps = temp_directory + 'user_list_temp/'
+                if os.path.exists(temps):  # Anything from prior runs is gone
+                    shutil.rmtree(temps)
+                os.mkdir(temps)
+
+                files = ['residents.csv', 'staff.csv', 'horizon.csv']
+                outfile = 'users.csv'
+                res_list_processor = CreateUserList(summary_logger, temps, google_drive_dir)
+                res_list_processor.get_all_users(files, outfile)
+
+                shutil.copy(temps + 'users.csv', sst_support_directory + 'users.csv')
+
+                # Log completion
+                summary_logger.make_info_entry('Complete Creation of sst/support/users.csv')
+            except Exception as e:
+                summary_logger.make_error_entry('build_users_csv failed with exception: {}'.format(e.args))
+
+        if run_jobs and pvt.prototyping:
+            """Scan for page urls."""
+            summary_logger.make_info_entry(f"Begin prototyping run")
+            target_directory = temp_directory + 'worktemp/'
+
+            foo = 3
+
+
+        if False and pvt.prototyping:
+            """Modify meta_paths in directory containing possibly recursive structure of files. """
+            drive_dir_to_download = config['drive paths']['driveAdmin'] + config['drive paths']['driveMinutes']
+            target_directory = work_directory + 'worktemp/'
+            test_dir = temp_directory + 'fix_meta_paths/'
+            path_element_to_find = 'pages/aa-activities-index'
+            path_element_to_replace = 'pages'
+            try:
+                for root, dirs, files in os.walk(test_dir):
+                    print(f"{root}")
+                    # for dir in dirs:
+                    #     print(f"    DIR:  {dir}")
+                    # for file in files:
+                    #     print(f"    FILE: {file}")
+                    if 'meta.txt' in files:
+                        meta_path = os.path.join(root, 'meta.txt')
+                        changed = False
+                        try:
+                            with open(meta_path) as stream:
+                                story_meta_tmp = yaml.safe_load(stream.read().replace('\t', ' '))
+                                if not story_meta_tmp:
+                                    print(f"meta.txt is empty")
+                                else:
+                                    path = story_meta_tmp['.. path']
+                                    print(f"{path}")
+                                    if path_element_to_find in path:
+                                        path_new = path.replace(path_element_to_find, path_element_to_replace)
+                                        print(f"\nOLD: {path}")
+                                        print(f"NEW: {path_new}")
+                                        story_meta_tmp['.. path'] = path_new
+                                        changed = True
                                 stream.close()
-                            foo =- 3
-                    except Exception as e:
-                        foo = 4
+                            if changed:
+                                with open(meta_path, 'w') as stream:
+                                    yaml.safe_dump(story_meta_tmp, stream)
+                                    stream.close()
+                                foo =- 3
+                        except Exception as e:
+                            foo = 4
+
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
 
+        index_file = config.get('index', 'shortcodeIndexFile', fallback='')
+        if run_jobs and index_file:
+            # Shortcodes and the images and galleries they use - python -m new_content.shortcode_index to query
+            with log_phase(summary_logger, 'shortcode_index'):
+                try:
+                    update_index(summary_logger, temp_directory + index_file, sst_directory, docx_directory,
+                                 image_directory, gallery_directory,
+                                 max_workers=config.getint('index', 'indexWorkers', fallback=0) or None,
+                                 report_top=config.getint('index', 'brokenReportTop', fallback=20))
+                except Exception as e:
+                    summary_logger.make_error_entry(f"Unable to update the shortcode index: {e}")
+    except Exception as e:
+        summary_logger.make_error_entry(f"sst_utils run failed with exception: {e.args}\n{traceback.format_exc()}")
+        raise
+    finally:
+        _finish_run(config, summary_logger, logs_directory, run_id, run_started, run_log)
+
+
+def _finish_run(config, summary_logger, logs_directory, run_id, run_started, run_log):
+    """Report on the run, stop the workers it started and write out its logs - also when it failed."""
+    try:
+        transfer_scheduler.get_scheduler().report(summary_logger)
+        tracer = tracing.get_tracer()
+        if tracer:
+            trace_file = tracer.export_chrome_trace(os.path.join(run_log_directory(logs_directory),
+                                                                 run_id + '.trace.json'))
+            summary_logger.make_info_entry(f"Trace of the run (chrome://tracing or ui.perfetto.dev): {trace_file}")
+            tracer.report(summary_logger, top=config.getint('performance', 'traceTop', fallback=20))
+        _write_metrics(config, summary_logger, logs_directory, run_id, run_started)
+        if profiling.profiled_files():
+            summary_logger.make_info_entry(f"Profiles written (python -m utilities.profiling show/merge/diff): "
+                                           f"{', '.join(profiling.profiled_files())}")
+        # Where the time spent in rclone and pandoc went - by command, command line and folder
+        get_accounting().report(summary_logger,
+                                top=config.getint('performance', 'subprocessReportTop', fallback=15))
+        try:
+            get_accounting().write_json(os.path.join(run_log_directory(logs_directory),
+                                                     run_id + '.subprocesses.json'))
+        except OSError as e:
+            summary_logger.make_error_entry(f"Unable to write subprocess accounting: {e}")
+        mgd.save_listing_cache()
+        mgd.evict_blob_store(summary_logger)
+        stop_docx_conversion(summary_logger)
+        if get_conversion_cache():
+            get_conversion_cache().report(summary_logger)
+    finally:
+        rclone_rc.stop_remote_control()
+        stop_mail_worker()     # Log digests are sent while the rest of the run goes on
+        summary_logger.make_info_entry('sst_utils Run Completed')
+        flush_logs()
+        try:
+            run_logs = RunLogStore(run_log_db(logs_directory))
+            run_logs.ingest(run_id, run_log)
+            run_logs.apply_retention(keep_runs=config.getint('logs', 'keepRuns', fallback=60),
+                                     compress_after=config.getint('logs', 'compressAfterRuns', fallback=5))
+            run_logs.close()
         except Exception as e:
-            print(e)
-            traceback.print_exc()
+            summary_logger.make_error_entry(f"Unable to index run log {run_log}: {e}")
+        summary_logger.close_logger()
+        shutdown_logging()
+
 
-    summary_logger.make_info_entry('sst_utils Run Completed')
-    summary_logger.close_logger()
+def _configure_profiling(config, logs_directory, run_id):
+    """Profile the phases and folders selected in [profiling] - SST_PROFILE_PHASES, SST_PROFILE_FOLDERS and
+    SST_PROFILE_SAMPLING (yes/no) in the environment override the config file for a single run."""
+    def setting(key, env_name):
+        return os.environ.get(env_name, config.get('profiling', key, fallback=''))
+    phases = [x.strip() for x in setting('phases', 'SST_PROFILE_PHASES').split(',') if x.strip()]
+    folders = [x.strip() for x in setting('folders', 'SST_PROFILE_FOLDERS').split(',') if x.strip()]
+    if phases or folders:
+        profiling.configure_profiling(run_log_directory(logs_directory), run_id, phases=phases, folders=folders,
+                                      sampling=setting('sampling', 'SST_PROFILE_SAMPLING').lower() in ('yes', 'true', '1'),
+                                      interval=config.getfloat('profiling', 'samplingInterval', fallback=0.005))
+
+
+def _write_metrics(config, logger, logs_directory, run_id, run_started):
+    """Write the run's metrics for node_exporter's textfile collector ([metrics] textfileDirectory) and as JSON."""
+    metrics.set_gauge('run_duration_seconds', (dt.datetime.now() - run_started).total_seconds(),
+                      help_text="Duration of the last sst_utils run")
+    metrics.set_gauge('run_completed_timestamp_seconds', dt.datetime.now().timestamp(),
+                      help_text="When the last sst_utils run completed")
+    registry = metrics.get_registry()
+    try:
+        registry.write_json(os.path.join(run_log_directory(logs_directory), run_id + '.metrics.json'), run_id=run_id)
+        textfile_directory = config.get('metrics', 'textfileDirectory', fallback='')
+        if textfile_directory:
+            registry.write_textfile(os.path.join(textfile_directory, 'sst_utils.prom'))
+    except OSError as e:
+        logger.make_error_entry(f"Unable to write run metrics: {e}")
 
 
 if __name__ == '__main__':
-    driver()
+    parser = argparse.ArgumentParser(description="Nightly update of Sunnyside Times content from Google Drive")
+    parser.add_argument('--force', action='store_true', help="reprocess story folders even if unchanged")
+    parser.add_argument('--validate-only', nargs='?', const='', metavar='FOLDER',
+                        help="only check the shortcodes of the docx files below FOLDER (default the whole "
+                             "management tree) without converting them")
+    args = parser.parse_args()
+    driver(force_reprocess=args.force, validate_only=args.validate_only)
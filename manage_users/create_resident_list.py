@@ -5,6 +5,7 @@ import os
 import csv
 import pandas as pd
 from system_control.manage_google_drive import ManageGoogleDrive
+from utilities.tracing import traced
 import xlrd
 
 
@@ -16,14 +17,29 @@ class CreateUserList(object):
         self.temp_dir = temp_directory
         self.google_drive_dir = google_dir
 
-    def process_resident_directory(self, dir_file):
+    @traced(category='users')
+    def fetch_files(self, dir_files):
+        """Download all the directories to be processed in one transfer."""
+        try:
+            self.drive.download_files(self.logger, dir_files, self.temp_dir, source_dir=self.google_drive_dir)
+        except:
+            raise ValueError(f"Failure downloading {', '.join(dir_files)}")
+
+    def _open_file(self, dir_file):
+        """The directory fetched by fetch_files, else read straight from drive."""
+        if os.path.exists(self.temp_dir + dir_file):
+            return self.temp_dir + dir_file
         try:
-            self.drive.download_file(self.logger, self.google_drive_dir, dir_file, self.temp_dir)
+            return self.drive.open_remote(self.logger, self.google_drive_dir + dir_file)
         except:
             raise ValueError(f"Failure downloading {dir_file}")
 
+    @traced(category='users')
+    def process_resident_directory(self, dir_file):
+        source = self._open_file(dir_file)
+
         try:
-            res_date = pd.read_excel(self.temp_dir + dir_file, header=5)
+            res_date = pd.read_excel(source, header=5)
             res_date.to_csv(self.temp_dir + "res.csv", columns=['Last Name', 'First Name'])
         except:
             raise ValueError(f"Failure reading resident phone list")
@@ -57,14 +73,12 @@ class CreateUserList(object):
         except:
             raise ValueError(f"Failure uploading residents.csv")
 
+    @traced(category='users')
     def process_staff_directory(self, dir_file):
-        try:
-            self.drive.download_file(self.logger, self.google_drive_dir, dir_file, self.temp_dir)
-        except:
-            raise ValueError(f"Failure downloading {dir_file}")
+        source = self._open_file(dir_file)
 
         try:
-            res_date = pd.read_excel(self.temp_dir + dir_file, header=2)
+            res_date = pd.read_excel(source, header=2)
             res_date.drop(res_date.columns[[0, 1, 2, 3]], axis=1, inplace=True)
             res_date.dropna(inplace=True)
             res_date.to_csv(self.temp_dir + "staff.csv", header=False, index=False)
@@ -76,14 +90,12 @@ class CreateUserList(object):
         except:
             raise ValueError(f"Failure downloading {dir_file}")
 
+    @traced(category='users')
     def process_horizon_directory(self, dir_file):
-        try:
-            self.drive.download_file(self.logger, self.google_drive_dir, dir_file, self.temp_dir)
-        except:
-            raise ValueError(f"Failure downloading {dir_file}")
+        source = self._open_file(dir_file)
 
         try:
-            res_date = pd.read_excel(self.temp_dir + dir_file, header=2)
+            res_date = pd.read_excel(source, header=2)
             res_date.drop(res_date.columns[[0, 1, 4, 5, 6]], axis=1, inplace=True)
             res_date.dropna(inplace=True)
             res_date.to_csv(self.temp_dir + "horizon.csv", header=False, index=False)
@@ -95,15 +107,15 @@ class CreateUserList(object):
         except:
             raise ValueError(f"Failure downloading {dir_file}")
 
+    @traced(category='users')
     def get_all_users(self, filenames, outfile_name):
-        try:
-            self.drive.download_directory(self.logger, self.google_drive_dir, self.temp_dir)
-        except:
-            raise ValueError(f"Failure downloading {self.google_drive_dir}")
-
         with open(self.temp_dir + outfile_name, 'w') as outfile:
             for fname in filenames:
-                with open(self.temp_dir + fname) as infile:
+                try:
+                    infile = self.drive.open_remote(self.logger, self.google_drive_dir + fname, text=True)
+                except:
+                    raise ValueError(f"Failure downloading {self.google_drive_dir}{fname}")
+                with infile:
                     outfile.write(infile.read())
 
 
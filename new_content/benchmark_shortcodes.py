@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Time shortcode checking (ValidateShortcodes.check_text) on generated markdown of growing size.
+
+    python -m new_content.benchmark_shortcodes --max-mb 16
+
+Each size doubles the last, so with a linear scan the time per MB stays level.  --legacy also times
+the scan used before check_text (a search and a copy of the rest of the file per shortcode) up to
+--legacy-max-mb."""
+import argparse
+import re
+import time
+
+from new_content.validate_shortcodes import ValidateShortcodes
+
+
+def make_page(size):
+    """Markdown of about size bytes - paragraphs of text with singlepic and box shortcodes, a few of them wrong."""
+    blocks = []
+    length = 0
+    count = 0
+    while length < size:
+        count += 1
+        if count % 50 == 0:
+            block = f'{{{{% singlepic imag="/images/p{count}.jpg" alignment="middle" %}}}}\n\n'
+        elif count % 3 == 0:
+            block = f'{{{{% box name="b{count}" direction="left" %}}}}\n\n'
+        elif count % 2 == 0:
+            block = f'{{{{% singlepic image="/images/p{count}.jpg" alignment="left" caption="c{count}" %}}}}\n\n'
+        else:
+            block = "Residents gathered in the courtyard for the annual summer picnic and music. " * 4 + "\n\n"
+        blocks.append(block)
+        length += len(block)
+    return ''.join(blocks)
+
+
+def legacy_scan(validator, rest_of_file):
+    """The scan check_text replaced - kept to compare against."""
+    found = 0
+    while True:
+        next_shortcode = re.search(validator.shortcode_re, rest_of_file)
+        if not next_shortcode:
+            return found
+        found += 1
+        sc_name = next_shortcode.group('sc_name').strip()
+        start = next_shortcode.start('sc_name')
+        end = rest_of_file[start:].find(r'%}}')
+        if sc_name.lower() not in validator.shortcodes:
+            rest_of_file = rest_of_file[next_shortcode.end():]
+        elif end == -1:
+            rest_of_file = rest_of_file[start + 3:]
+        else:
+            sc_text = rest_of_file[start:start + end]
+            rest_of_file = rest_of_file[start + end:]
+            attr_text = sc_text
+            while True:
+                next_attr = re.search(validator.sc_attr, attr_text)
+                if not next_attr:
+                    break
+                attr_text = attr_text[next_attr.end('value'):]
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shortcode checking on generated markdown")
+    parser.add_argument('--min-kb', type=int, default=64)
+    parser.add_argument('--max-mb', type=float, default=16)
+    parser.add_argument('--repeat', type=int, default=3, help="best of repeat runs is reported")
+    parser.add_argument('--legacy', action='store_true', help="also time the scan check_text replaced")
+    parser.add_argument('--legacy-max-mb', type=float, default=1)
+    args = parser.parse_args()
+
+    validator = ValidateShortcodes('benchmark.md', 'md', None)
+    print(f"{'MB':>8} {'shortcodes':>10} {'problems':>9} {'seconds':>9} {'s per MB':>9}"
+          f"{'   legacy s' if args.legacy else ''}")
+    size = args.min_kb * 1024
+    while size <= args.max_mb * 1024 * 1024:
+        text = make_page(size)
+        megabytes = len(text) / (1024 * 1024)
+        seconds = best_time(lambda: validator.check_text(text), args.repeat)
+        line = (f"{megabytes:8.2f} {len(validator.shortcode_re.findall(text)):10d} {len(validator.diagnostics):9d} "
+                f"{seconds:9.4f} {seconds / megabytes:9.4f}")
+        if args.legacy and size <= args.legacy_max_mb * 1024 * 1024:
+            line += f" {best_time(lambda: legacy_scan(validator, text), 1):10.4f}"
+        print(line)
+        size *= 2
+
+
+if __name__ == '__main__':
+    main()
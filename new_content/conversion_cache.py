@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import shutil
+import threading
+
+from utilities import metrics
+from utilities.run_log_command import run_command
+
+
+class ConversionCache(object):
+    """Markdown produced by pandoc from a docx, kept between runs.
+
+    Entries are keyed by the hash of the docx bytes, the pandoc version and the conversion options, so
+    an unchanged document is not converted again and a new pandoc or new options convert everything.
+    When the cache grows beyond max_bytes the least recently used entries are removed."""
+
+    def __init__(self, root, max_bytes, pandoc_command='pandoc'):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pandoc_command = pandoc_command
+        self.pandoc_version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _version(self, logger):
+        """First line of pandoc --version ('' if pandoc cannot be run)."""
+        with self.lock:
+            if self.pandoc_version is None:
+                try:
+                    result = run_command([self.pandoc_command, '--version'], logger, capture_stdout=True,
+                                         log_output=False)
+                    lines = result.stdout.decode('utf-8', errors='replace').splitlines() if result.ok else []
+                    self.pandoc_version = lines[0].strip() if lines else ''
+                except OSError:
+                    self.pandoc_version = ''
+            return self.pandoc_version
+
+    def key(self, logger, docx_path, options):
+        """Cache key of converting docx_path with options, None if the conversion cannot be cached."""
+        version = self._version(logger)
+        if not version:
+            return None
+        digest = hashlib.sha256()
+        with open(docx_path, 'rb') as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(f"\0{version}\0{options}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key + '.md')
+
+    def fetch(self, key, target_path):
+        """Copy the cached conversion to target_path.  Returns False if there is none."""
+        path = self.entry_path(key)
+        try:
+            shutil.copyfile(path, target_path)
+            os.utime(path)  # Recently used - kept longest on eviction
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            metrics.count('pandoc_cache_total', help_text="Docx conversions found in the pandoc cache", result='miss')
+            return False
+        with self.lock:
+            self.hits += 1
+        metrics.count('pandoc_cache_total', help_text="Docx conversions found in the pandoc cache", result='hit')
+        return True
+
+    def store(self, key, source_path):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within max_bytes.  Returns bytes removed."""
+        with self.lock:
+            entries = []
+            total = 0
+            for root, dirs, files in os.walk(self.root):
+                for file in files:
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            removed = 0
+            for mtime, size, path in sorted(entries):
+                if total - removed <= self.max_bytes:
+                    break
+                os.remove(path)
+                removed += size
+            return removed
+
+    def report(self, logger):
+        removed = self.evict()
+        logger.make_info_entry(f"Pandoc conversion cache: {self.hits} hits, {self.misses} misses"
+                               f"{f', {removed} bytes evicted' if removed else ''}")
+
+
+# Cache used by ValidateShortcodes.clean_docx (None = always run pandoc)
+_conversion_cache = None
+
+
+def configure_conversion_cache(root, max_bytes):
+    global _conversion_cache
+    _conversion_cache = ConversionCache(root, max_bytes)
+    return _conversion_cache
+
+
+def get_conversion_cache():
+    return _conversion_cache
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities import metrics
+from utilities.run_log_command import BufferedLogger
+import new_content.validate_shortcodes as vs
+
+
+class DocxConversion(object):
+    """A docx queued for conversion and shortcode validation, and the entries logged doing it."""
+
+    def __init__(self, docx_path, folder, keep=None):
+        self.docx_path = docx_path
+        self.folder = folder
+        self.name = folder + os.path.basename(docx_path)
+        self.keep = keep            # e.g. the TemporaryDirectory holding docx_path - kept until converted
+        self.logger = BufferedLogger()
+        # Entries are tagged with the folder (log_context) the document was queued from
+        self.context = contextvars.copy_context()
+        self.future = None
+        self.failed = None          # Set when the result has been logged
+
+    def error(self, entry):
+        self.context.run(self.logger.make_error_entry, entry)
+
+    @property
+    def errors(self):
+        return sum(1 for level, entry, fields in self.logger.entries if level == logging.ERROR)
+
+
+class DocxConversionService(object):
+    """Convert docx files with pandoc and validate their shortcodes, several documents at a time.
+
+    Documents are queued as the story folders of the run are processed and converted by a bounded
+    pool - each worker waits on its own pandoc process so the pool keeps up to max_workers cores busy.
+    wait() writes the entries of each document to the log in the order they were queued, with an
+    error naming the document if its conversion failed."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pandoc')
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def submit(self, docx_path, folder, keep=None):
+        conversion = DocxConversion(docx_path, folder, keep=keep)
+        conversion.future = self.executor.submit(conversion.context.run, self._convert, conversion)
+        with self.lock:
+            self.pending.append(conversion)
+        return conversion
+
+    @staticmethod
+    def _convert(conversion):
+        try:
+            val_sc = vs.ValidateShortcodes(conversion.docx_path, 'docx', conversion.logger)
+            val_sc.clean_docx()
+            val_sc.process_shortcodes()
+        finally:
+            conversion.keep = None
+
+    def wait(self, logger):
+        """Wait for the queued documents and log their results.  Returns the number with errors."""
+        with self.lock:
+            conversions = self.pending
+            self.pending = []
+        failed = 0
+        for conversion in conversions:
+            try:
+                conversion.future.result()
+            except Exception as e:
+                conversion.error(f"Conversion of {conversion.name} failed: {e.args}")
+            errors = conversion.errors
+            conversion.failed = bool(errors)
+            if errors:
+                failed += 1
+                conversion.error(f"Document {conversion.name} has {errors} errors")
+            metrics.count('docx_conversions_total', help_text="Docx documents converted and validated",
+                          outcome='error' if errors else 'ok')
+            conversion.logger.flush_to(logger)
+        if conversions:
+            logger.make_info_entry(f"Converted {len(conversions)} documents ({self.max_workers} at a time), "
+                                   f"{failed} with errors")
+        return failed
+
+    def close(self, logger):
+        self.wait(logger)
+        self.executor.shutdown(wait=True)
+
+
+# Documents are converted as they are found (in process_docx) unless configure_docx_conversion has been called
+_service = None
+
+
+def configure_docx_conversion(max_workers=None):
+    global _service
+    _service = DocxConversionService(max_workers=max_workers)
+    return _service
+
+
+def get_docx_conversion():
+    return _service
+
+
+def stop_docx_conversion(logger):
+    global _service
+    if _service:
+        _service.close(logger)
+        _service = None
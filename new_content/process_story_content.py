@@ -3,14 +3,17 @@ import os
 import shutil
 import yaml
 from system_control.manage_google_drive import ManageGoogleDrive as mgd
+from system_control.manage_google_drive import control_file
 import tempfile as tf
 import pathlib as pl
 from mako.template import Template
 from new_content import validate_shortcodes as vs
+from new_content.docx_conversion import get_docx_conversion
 from mako.lookup import TemplateLookup
 from mako.runtime import Context
 from config_private import test_run
 from system_control.exceptions import SstCommandDefinitionException as CDEx
+from utilities.tracing import traced
 
 
 class ProcessStoryContent(object):
@@ -30,14 +33,18 @@ class ProcessStoryContent(object):
         self.gallery_directory = gallery_directory
         self.template_processors = {'resident_clubs': self.resident_clubs_template}
         self.pages_directory = pl.Path(self.sst_directory) / 'pages/'
+        self.outputs = []  # Every file written to the site - used to check a skipped folder is still published
+        self.conversions = []  # Documents queued with the conversion service (see process_docx)
         # Note, downloading to max-depth=2 downloads contents of any galleries.
         self.drive.download_directory(self.logger, self.folder_path, mgd.add_slash(self.story_directory.name),
                                       max_depth=2)
 
+    @traced(category='story')
     def process_content(self):
         if "meta.txt" in self.filenames:
             has_meta = True
-            with open(pl.Path(self.story_directory.name) / 'meta.txt') as stream:
+            meta_path = control_file(self.folder_path, 'meta.txt') or pl.Path(self.story_directory.name) / 'meta.txt'
+            with open(meta_path) as stream:
                 try:
                     story_meta_tmp = yaml.safe_load(stream.read().replace('\t', ' '))
                     story_meta = dict()
@@ -93,6 +100,7 @@ class ProcessStoryContent(object):
                     if not test_run:
                         os.makedirs(out_dir, exist_ok=True)
                         shutil.copy(out_file, out_dir)
+                        self.outputs.append(str(out_dir / file))
                 except NameError:
                     pass
                 self._copy_meta_file(story_meta, out_dir=out_dir)
@@ -103,18 +111,25 @@ class ProcessStoryContent(object):
             # A directory represents a gallery and cannot be nested.
             self.process_gallery(pl.Path(self.story_directory.name) / dirname)
 
+    @traced(category='story')
     def process_docx(self, story_meta, file):
         # copy docx data_file ensuring data_file corresponds to slug
         source = pl.Path(self.story_directory.name) / file
-        val_sc = vs.ValidateShortcodes(source, 'docx', self.logger)
-        val_sc.clean_docx()  # Already duplicated in nikola command
-        val_sc.process_shortcodes()
+        conversion = get_docx_conversion()
+        if conversion:
+            # Converted and checked alongside the documents of other folders, reported when the commands finish
+            self.conversions.append(conversion.submit(str(source), self.folder_path, keep=self.story_directory))
+        else:
+            val_sc = vs.ValidateShortcodes(source, 'docx', self.logger)
+            val_sc.clean_docx()  # Already duplicated in nikola command
+            val_sc.process_shortcodes()
         target = self.docx_directory + story_meta['slug'] + ".docx"
         try:
             if not test_run:
                 if os.path.exists(target):
                     os.remove(target)
                 shutil.copy(source, target)
+                self.outputs.append(target)
         except NameError:
             pass
         if not test_run:
@@ -131,9 +146,11 @@ class ProcessStoryContent(object):
                 if os.path.exists(target):
                     os.remove(target)
                 shutil.copy(source, target)
+                self.outputs.append(str(target))
         except NameError:
             pass
 
+    @traced(category='story')
     def process_photo(self, path, file):
         ndx = 0
         if path[0] == '/':
@@ -144,9 +161,11 @@ class ProcessStoryContent(object):
             if not test_run:
                 os.makedirs(image_path, exist_ok=True)
                 shutil.copy(source, image_path)
+                self.outputs.append(os.path.join(image_path, file))
         except NameError:
             pass
 
+    @traced(category='story')
     def process_pdf(self, path, file):
         ndx = 0
         if path[0] == '/':
@@ -160,6 +179,7 @@ class ProcessStoryContent(object):
         except NameError:
             pass
 
+    @traced(category='story')
     def process_gallery(self, path_to_gallery):
         if os.path.exists(path_to_gallery):  # can be empty if there was an ignore folder
             photo_files = os.listdir(path_to_gallery)
@@ -191,9 +211,11 @@ class ProcessStoryContent(object):
                             shutil.copy(resolved_gallery_path / 'metadata.yml', gal_path)
                             if not gal_path.endswith('/'):
                                 gal_path += '/'
+                            self.outputs.append(gal_path + 'metadata.yml')
                             for doc in gallery_meta:
                                 if doc:
                                     shutil.copy(resolved_gallery_path / doc['name'], gal_path + doc['name'])
+                                    self.outputs.append(gal_path + doc['name'])
                     except NameError:
                         pass
                     except Exception as e:
@@ -202,6 +224,7 @@ class ProcessStoryContent(object):
                 self.logger.make_error_entry(f"No metadata.yml data_file in {path_to_gallery}")
                 raise CDEx(f"No metadata.yml data_file in {path_to_gallery}")
 
+    @traced(category='story')
     def process_template(self, story_meta, data_file):
         """
         Take a meta_file and a data_file and build a page with a mako template.
@@ -287,6 +310,7 @@ class ProcessStoryContent(object):
                 with open(out_dir / (story_meta['slug'] + '.md'), 'w') as outfile:
                     outfile.write(results)
                     outfile.close()
+                self.outputs.append(str(out_dir / (story_meta['slug'] + '.md')))
         except NameError:
             pass
 
@@ -10,6 +10,8 @@ from new_content import validate_shortcodes as vs
 from mako.lookup import TemplateLookup
 from mako.runtime import Context
 from config_private import test_run
+from utilities.tracing import traced
+from utilities import metrics
 
 
 
@@ -30,6 +32,7 @@ class RelocateInformation(object):
         self.local_temp = tf.TemporaryDirectory(dir=self.temp_dir, prefix='xfr')
 
 
+    @traced(category='pages')
     def move_folder_of_pagefiles(self, target_dir):
         """Copy all files that have a corresponding meta file."""
         self.drive.download_directory(self.logger, self.folder_path, self.local_temp.name)
@@ -50,10 +53,20 @@ class RelocateInformation(object):
                         shutil.copy(self.local_temp.name + '/' + file, real_target + paired_file)
                 except NameError:
                     pass
+    @traced(category='pages')
+    def fetch_page_files(self, files_to_process):
+        """Download all page action files of the folder in one transfer."""
+        self.drive.download_files(self.logger, files_to_process, self.local_temp.name, source_dir=self.folder_path)
+
+    @traced(category='pages')
     def process_page_file_actions(self, file_to_process):
         """Read YAML file and drive processing of specified actions."""
-        self.drive.download_file(self.logger, self.folder_path, file_to_process, self.local_temp.name)
-        with open(self.local_temp.name + '/' + file_to_process) as stream:
+        local_path = self.local_temp.name + '/' + file_to_process
+        if os.path.exists(local_path):      # Fetched with fetch_page_files
+            stream = open(local_path)
+        else:
+            stream = self.drive.open_remote(self.logger, self.folder_path + file_to_process, text=True)
+        with stream:
             try:
                 # Note: yaml is small and we convert to list so it can be reused
                 actions = [x for x in yaml.safe_load_all(stream)]
@@ -74,6 +87,7 @@ class RelocateInformation(object):
                 except KeyError as e:
                     self.logger.make_error_entry(f"Invalid key error processing actions: {e.args}")
 
+    @traced(category='pages')
     def remove_page_from_website(self, url):
         """Remove a page from the site."""
         file_path = url.split("/pages/")
@@ -107,6 +121,7 @@ class RelocateInformation(object):
                 os.remove(file_base + '.meta')
         if found:
             self.logger.make_info_entry(f"Page {url} removed.")
+            metrics.count('pages_removed_total', help_text="Pages removed from the website")
         else:
             self.logger.make_error_entry(f"Page {url} not found.")
 
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from new_content.validate_shortcodes import docx_paragraphs
+
+SHORTCODE = re.compile(r'\{\{%\s*(?P<name>[\w:;-]+)(?P<args>.*?)%\}\}', re.DOTALL)
+ATTRIBUTE = re.compile(r'(?P<attribute>\w+)="(?P<value>[^"]*)"')
+MARKDOWN_LINK = re.compile(r'!?\[[^\]\n]*\]\((?P<target>[^)\s]+)')
+# Site paths of the assets tracked, and the kind of asset each is
+ASSET_PREFIXES = (('/images/', 'image'), ('/galleries/', 'gallery'))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.webp')
+
+
+def _asset(target):
+    """(kind, normalized site path) of a reference to an image or gallery, None for anything else."""
+    target = target.strip().strip('"\'').split('#')[0].split('?')[0]
+    for prefix, kind in ASSET_PREFIXES:
+        if target.startswith(prefix):
+            return kind, target.rstrip('/') if kind == 'gallery' else target
+    return None
+
+
+def scan_text(text):
+    """(shortcodes, references) of the text of a page or document.
+
+    shortcodes are (line, name, attributes as JSON), references (line, kind, site path) of each image
+    or gallery used - by a shortcode attribute or argument or a markdown image or link.  A gallery
+    shortcode naming a gallery without a path refers to /galleries/<name>."""
+    shortcodes = []
+    references = []
+    matches = [(x.start(), x) for x in SHORTCODE.finditer(text)]
+    matches += [(x.start(), x) for x in MARKDOWN_LINK.finditer(text)]
+    line, counted = 1, 0
+    for position, match in sorted(matches, key=lambda x: x[0]):
+        line += text.count('\n', counted, position)
+        counted = position
+        if match.re is MARKDOWN_LINK:
+            asset = _asset(match.group('target'))
+            if asset:
+                references.append((line,) + asset)
+            continue
+        name = match.group('name').lower()
+        args = match.group('args')
+        attributes = {x.group('attribute'): x.group('value') for x in ATTRIBUTE.finditer(args)}
+        arguments = ATTRIBUTE.sub(' ', args).split()
+        shortcodes.append((line, name, json.dumps(attributes, sort_keys=True)))
+        for value in list(attributes.values()) + arguments:
+            asset = _asset(value)
+            if not asset and name == 'gallery' and value.strip('"\'') and not value.startswith('/'):
+                asset = _asset('/galleries/' + value)
+            if asset:
+                references.append((line,) + asset)
+    return shortcodes, references
+
+
+def scan_file(path):
+    """(path, shortcodes, references, error) of a markdown file or docx - run in the index worker processes."""
+    try:
+        if path.lower().endswith('.docx'):
+            text = '\n'.join(docx_paragraphs(path))
+        else:
+            with open(path, encoding='utf-8', errors='replace') as fd:
+                text = fd.read()
+        return (path,) + scan_text(text) + (None,)
+    except Exception as e:
+        return path, [], [], str(e)
+
+
+class ShortcodeIndex(object):
+    """Persistent index of the shortcodes used by the site and the images and galleries they refer to.
+
+    Every .md below SSTDirectory/pages and every document (.docx, .md) in docxDirectory is indexed.  An
+    update only scans files whose modification time or size has changed, in parallel worker processes,
+    and removes files that have gone.  The images and galleries of the site are listed on each update so
+    broken references, unused images and the pages using an asset are single queries."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT, mtime REAL, "
+                                "size INTEGER, error TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shortcodes (path TEXT, line INTEGER, name TEXT, "
+                                "attributes TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS refs (path TEXT, line INTEGER, kind TEXT, target TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS assets (target TEXT PRIMARY KEY, kind TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS shortcodes_path ON shortcodes (path)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS shortcodes_name ON shortcodes (name)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS refs_path ON refs (path)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS refs_target ON refs (target)")
+        self.connection.commit()
+
+    @staticmethod
+    def _source_files(page_directory, docx_directory):
+        """{path: (kind, mtime, size)} of the files to index."""
+        files = dict()
+        for directory, kind, extensions in ((page_directory, 'page', ('.md',)),
+                                            (docx_directory, 'docx', ('.docx', '.md'))):
+            for root, dirs, names in os.walk(directory):
+                for name in names:
+                    if name.lower().endswith(extensions) and not name.startswith('~$'):
+                        path = os.path.join(root, name)
+                        stat = os.stat(path)
+                        files[path] = (kind, stat.st_mtime, stat.st_size)
+        return files
+
+    @staticmethod
+    def _site_assets(sst_directory, image_directory, gallery_directory):
+        """[(site path, kind)] of the images and galleries of the site."""
+        assets = []
+        for root, dirs, names in os.walk(image_directory):
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    assets.append(('/' + os.path.relpath(os.path.join(root, name), sst_directory).replace(os.sep, '/'),
+                                   'image'))
+        for root, dirs, names in os.walk(gallery_directory):
+            for name in dirs:
+                assets.append(('/' + os.path.relpath(os.path.join(root, name), sst_directory).replace(os.sep, '/'),
+                               'gallery'))
+        return assets
+
+    def update(self, sst_directory, docx_directory, image_directory, gallery_directory, max_workers=None):
+        """Bring the index up to date.  Returns (files scanned, files removed, files unchanged, scan errors)."""
+        files = self._source_files(os.path.join(sst_directory, 'pages'), docx_directory)
+        with self.lock:
+            known = {path: (mtime, size) for path, mtime, size in
+                     self.connection.execute("SELECT path, mtime, size FROM files")}
+        changed = sorted(path for path, (kind, mtime, size) in files.items() if known.get(path) != (mtime, size))
+        removed = [path for path in known if path not in files]
+        if len(changed) > 1 and max_workers != 1:
+            # Scanning is CPU bound - worker processes rather than threads.  They are spawned, not forked: the
+            # run has threads (log listeners, mail worker, pools) that may hold locks at the time of a fork.
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(scan_file, changed, chunksize=max(1, min(64, len(changed) // 32))))
+        else:
+            results = [scan_file(path) for path in changed]
+        errors = []
+        with self.lock:
+            for path in removed + changed:
+                self.connection.execute("DELETE FROM shortcodes WHERE path = ?", (path,))
+                self.connection.execute("DELETE FROM refs WHERE path = ?", (path,))
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+            for path, shortcodes, references, error in results:
+                kind, mtime, size = files[path]
+                self.connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)", (path, kind, mtime, size, error))
+                self.connection.executemany("INSERT INTO shortcodes VALUES (?, ?, ?, ?)",
+                                            [(path,) + x for x in shortcodes])
+                self.connection.executemany("INSERT INTO refs VALUES (?, ?, ?, ?)", [(path,) + x for x in references])
+                if error:
+                    errors.append((path, error))
+            self.connection.execute("DELETE FROM assets")
+            self.connection.executemany("INSERT OR REPLACE INTO assets VALUES (?, ?)",
+                                        self._site_assets(sst_directory, image_directory, gallery_directory))
+            self.connection.commit()
+        return len(changed), len(removed), len(files) - len(changed), errors
+
+    def broken_references(self):
+        """(path, line, kind, site path) of each reference to an image or gallery the site does not have."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT r.path, r.line, r.kind, r.target FROM refs r LEFT JOIN assets a ON a.target = r.target "
+                "WHERE a.target IS NULL ORDER BY r.path, r.line").fetchall()
+
+    def unused_assets(self, kind='image'):
+        """Site paths of the images (or galleries) no page or document refers to."""
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT target FROM assets a WHERE kind = ? AND NOT EXISTS "
+                "(SELECT 1 FROM refs r WHERE r.target = a.target) ORDER BY target", (kind,))]
+
+    def asset_uses(self, target):
+        """(path, line, site path) of each use of an asset (a site path, or a directory of them ending '/')."""
+        with self.lock:
+            if target.endswith('/'):
+                return self.connection.execute("SELECT path, line, target FROM refs WHERE target LIKE ? "
+                                               "ORDER BY path, line", (target + '%',)).fetchall()
+            return self.connection.execute("SELECT path, line, target FROM refs WHERE target = ? ORDER BY path, line",
+                                           (target,)).fetchall()
+
+    def shortcode_uses(self, name):
+        """(path, line, attributes) of each use of a shortcode."""
+        with self.lock:
+            return [(path, line, json.loads(attributes)) for path, line, attributes in self.connection.execute(
+                "SELECT path, line, attributes FROM shortcodes WHERE name = ? ORDER BY path, line", (name.lower(),))]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def update_index(logger, db_file, sst_directory, docx_directory, image_directory, gallery_directory,
+                 max_workers=None, report_top=20):
+    """Update the index at db_file and log what changed and the broken references found."""
+    start = time.monotonic()
+    index = ShortcodeIndex(db_file)
+    try:
+        scanned, removed, unchanged, errors = index.update(sst_directory, docx_directory, image_directory,
+                                                           gallery_directory, max_workers=max_workers)
+        for path, error in errors:
+            logger.make_error_entry(f"Unable to index {path}: {error}")
+        broken = index.broken_references()
+        logger.make_info_entry(f"Shortcode index updated in {time.monotonic() - start:.1f}s: {scanned} files scanned, "
+                               f"{removed} removed, {unchanged} unchanged - {len(broken)} broken references")
+        for path, line, kind, target in broken[:report_top]:
+            logger.make_error_entry(f"Missing {kind} {target} used in {path} (line {line})")
+    finally:
+        index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index of the shortcodes, images and galleries used by the site")
+    parser.add_argument('db_file', help="index file (tempDirectory/[index] shortcodeIndexFile)")
+    commands = parser.add_subparsers(dest='query', required=True)
+    update = commands.add_parser('update', help="scan new and changed pages and documents")
+    update.add_argument('--config', default='./config_file.cfg', help="directories are those of the user in config")
+    update.add_argument('--user', default=os.environ.get('USER'))
+    update.add_argument('--workers', type=int, default=None, help="scanning processes (default one per CPU)")
+    commands.add_parser('broken', help="references to images and galleries that do not exist")
+    unused = commands.add_parser('unused', help="images (or galleries) nothing refers to")
+    unused.add_argument('--kind', default='image', choices=['image', 'gallery'])
+    uses = commands.add_parser('uses', help="pages and documents using an asset (or a directory ending '/')")
+    uses.add_argument('target', help="site path, e.g. /images/2023/picnic.jpg")
+    shortcode = commands.add_parser('shortcode', help="uses of a shortcode")
+    shortcode.add_argument('name')
+    args = parser.parse_args()
+
+    index = ShortcodeIndex(args.db_file)
+    if args.query == 'update':
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        directories = config[args.user]
+        scanned, removed, unchanged, errors = index.update(directories['SSTDirectory'], directories['docxDirectory'],
+                                                           directories['imageDirectory'],
+                                                           directories['galleryDirectory'], max_workers=args.workers)
+        print(f"{scanned} files scanned, {removed} removed, {unchanged} unchanged")
+        for path, error in errors:
+            print(f"Unable to index {path}: {error}")
+    elif args.query == 'broken':
+        for path, line, kind, target in index.broken_references():
+            print(f"{path}:{line}  missing {kind} {target}")
+    elif args.query == 'unused':
+        for target in index.unused_assets(args.kind):
+            print(target)
+    elif args.query == 'uses':
+        for path, line, target in index.asset_uses(args.target):
+            print(f"{path}:{line}  {target}")
+    else:
+        for path, line, attributes in index.shortcode_uses(args.name):
+            print(f"{path}:{line}  {' '.join(f'{key}={value}' for key, value in attributes.items())}")
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
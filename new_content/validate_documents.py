@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import logging
+import os
+import tempfile as tf
+import time
+
+from new_content import validate_shortcodes as vs
+from system_control.manage_google_drive import ManageGoogleDrive as mgd
+from utilities import metrics
+from utilities.run_log_command import BufferedLogger, log_context
+
+
+class ValidateDocuments(object):
+    """Check the shortcodes of every docx below a drive folder without converting them (validate only runs).
+
+    The documents are fetched in one transfer and read directly (ValidateShortcodes.validate_docx) so the
+    errors of a whole tree are found without running pandoc.  Folders named 'ignore' are skipped, as they
+    are by the command processor.  Entries are tagged with the drive folder of the document."""
+
+    def __init__(self, logger, root, temp_directory):
+        self.logger = logger
+        self.root = root.strip('/')
+        self.temp_directory = temp_directory
+        self.drive = mgd()
+
+    def find_documents(self):
+        """Paths (relative to root) of the docx files below root."""
+        entries = self.drive.list_tree(self.logger, self.root).walk(self.root)
+        return sorted(path for path, entry in entries if not entry['IsDir'] and path.lower().endswith('.docx')
+                      and 'ignore' not in path.split('/')[:-1])
+
+    def validate(self):
+        """Validate every document, returning the number with errors."""
+        start = time.monotonic()
+        documents = self.find_documents()
+        failed = 0
+        with tf.TemporaryDirectory(prefix='validate', dir=self.temp_directory) as target:
+            self.drive.download_files(self.logger, documents, target, source_dir=self.root)
+            for path in documents:
+                folder = '/'.join(x for x in (self.root, os.path.dirname(path)) if x)
+                with log_context(folder=folder):
+                    if self._validate(os.path.join(target, path), folder + '/' + os.path.basename(path)):
+                        failed += 1
+        self.logger.make_info_entry(f"Validated {len(documents)} documents below {self.root} in "
+                                    f"{time.monotonic() - start:.1f}s, {failed} with errors")
+        return failed
+
+    def _validate(self, local_path, name):
+        logger = BufferedLogger()
+        vs.ValidateShortcodes(local_path, 'docx', logger).validate_docx()
+        errors = sum(1 for level, entry, fields in logger.entries if level == logging.ERROR)
+        if errors:
+            logger.make_error_entry(f"Document {name} has {errors} errors")
+        else:
+            logger.make_info_entry(f"Document {name} has no shortcode errors")
+        metrics.count('docx_validated_total', help_text="Docx documents checked in validate only runs",
+                      outcome='error' if errors else 'ok')
+        logger.flush_to(self.logger)
+        return errors
@@ -1,7 +1,56 @@
 #!/usr/bin/env python3
 import os
 import re
-import subprocess
+import zipfile
+import xml.etree.ElementTree as ET
+from utilities.run_log_command import run_command
+from utilities.tracing import traced
+from utilities import metrics
+from new_content.conversion_cache import get_conversion_cache
+
+# Appended to the pandoc output file name - pandoc writes to '<name>.md -t ...' which clean_docx renames
+PANDOC_FORMAT = "-t markdown-simple_tables+pipe_tables "
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def docx_paragraphs(docx_path):
+    """Generate the text of each paragraph of a docx as word/document.xml is parsed.
+
+    The text of a paragraph is that of its runs (w:t), with tabs and line breaks - a shortcode split
+    across runs by formatting is joined up again.  Deleted text and field codes are not included."""
+    text_tag, paragraph_tag = WORD_NAMESPACE + 't', WORD_NAMESPACE + 'p'
+    separators = {WORD_NAMESPACE + 'tab': '\t', WORD_NAMESPACE + 'br': '\n', WORD_NAMESPACE + 'cr': '\n'}
+    with zipfile.ZipFile(docx_path) as docx, docx.open('word/document.xml') as fd:
+        parts = []
+        for event, element in ET.iterparse(fd, events=('end',)):
+            if element.tag == text_tag:
+                parts.append(element.text or '')
+            elif element.tag in separators:
+                parts.append(separators[element.tag])
+            elif element.tag == paragraph_tag:
+                yield ''.join(parts)
+                parts = []
+                element.clear()     # The document is not kept in memory
+
+
+class ShortcodeDiagnostic(object):
+    """A problem found in a shortcode - where it starts (line and column from 1), its name and the attribute."""
+    __slots__ = ('message', 'line', 'column', 'shortcode', 'attribute')
+
+    def __init__(self, message, line, column, shortcode=None, attribute=None):
+        self.message = message
+        self.line = line
+        self.column = column
+        self.shortcode = shortcode
+        self.attribute = attribute
+
+    def __str__(self):
+        return f"{self.message} (line {self.line}, column {self.column})"
+
+    def __repr__(self):
+        return (f"ShortcodeDiagnostic({self.message!r}, {self.line}, {self.column}, {self.shortcode!r}, "
+                f"{self.attribute!r})")
 
 
 class ValidateShortcodes(object):
@@ -13,6 +62,8 @@ class ValidateShortcodes(object):
         self.filetype = filetype
         self.shortcode_re = re.compile(r'(\{\{% +(?P<sc_name>((\w|:|\-|;|_)+)\s+))')
         self.sc_attr = re.compile(r'(?P<attribute>\w+)="(?P<value>(\w|_|\-|:|;|/|\.)+)"')
+        self.diagnostics = []       # Of the last text checked
+        self._position = (1, 1)     # Line and column of the shortcode being checked
         # Translate table for non-ascii chars we might use.
         self.transl_table = dict([(ord(x), ord(y)) for x, y in zip(u"‘’´“”–-", u"'''\"\"--")])
         self.singlepic_attributes = ['image', 'width', 'height', 'alignment', 'caption', 'title', 'has_borders']
@@ -29,6 +80,7 @@ class ValidateShortcodes(object):
                            'box': (self._generic, None, None)}
 
 
+    @traced(category='shortcodes')
     def clean_docx(self):
         """Remove smart quotes, long dashes from file."""
         try:
@@ -38,9 +90,18 @@ class ValidateShortcodes(object):
             self.logger.make_info_entry(f"Checking document {self.filepath}")
             ml_filename = os.path.abspath(self.filepath)[:-4] + 'md'
             ml_filename_copy = ml_filename
-            command = ["pandoc", f"{self.filepath}", "-o", f"{ml_filename} -t markdown-simple_tables+pipe_tables "]
+            command = ["pandoc", f"{self.filepath}", "-o", f"{ml_filename} {PANDOC_FORMAT}"]
+            # Unchanged documents are not converted again
+            cache = get_conversion_cache()
+            cache_key = cache.key(self.logger, self.filepath, PANDOC_FORMAT) if cache else None
+            if cache_key and cache.fetch(cache_key, ml_filename_copy):
+                self.logger.make_info_entry(f"Using cached conversion of {self.filepath}")
+                self.filepath = ml_filename_copy
+                return
             try:
-                res = subprocess.run(command, check=True)
+                res = run_command(command, self.logger)
+                if not res.ok:
+                    raise OSError(f"pandoc returned {res.returncode}")
             except Exception as e:
                 self.logger.make_error_entry(f'Error running pandoc with command: {command} and error: {e}')
                 return
@@ -48,7 +109,9 @@ class ValidateShortcodes(object):
             dirpath = '/'.join(file_base.split('/')[:-1])
             dir_files = os.listdir(dirpath)
             for file_nm in dir_files:
-                if file_nm.strip().endswith('markdown-simple_tables+pipe_tables'):
+                # Only this document's output - other documents of the folder may be converted at the same time
+                if file_nm.startswith(os.path.basename(ml_filename) + ' ') and \
+                        file_nm.strip().endswith('markdown-simple_tables+pipe_tables'):
                     # This is the file that has been misnamed
                     os.rename(dirpath + '/' + file_nm, ml_filename_copy)
             with open(ml_filename_copy, "r") as fd:
@@ -58,58 +121,97 @@ class ValidateShortcodes(object):
             with open(ml_filename_copy, 'w') as fd:
                 fd.write(file_content_x)
                 fd.close()
+            if cache_key:
+                cache.store(cache_key, ml_filename_copy)
             self.filepath = ml_filename_copy
         except Exception as e:
             self.logger.make_error_entry(f"An error: {e.args} occurred processing {self.filepath}")
 
+    @traced(category='shortcodes')
     def process_shortcodes(self):
+        """Check the shortcodes of the (markdown) file, logging an entry per problem.  Returns the diagnostics."""
         try:
             with open(self.filepath, "r") as fd:
-                file_content = fd.readlines()
+                file_content = fd.read()
                 fd.close()
-            rest_of_file = ''.join(file_content)
-            while True:
-                next_shortcode = re.search(self.shortcode_re, rest_of_file)
-                if next_shortcode:
-                    sc_name = next_shortcode.group('sc_name').strip()
-                    if sc_name.lower() in self.shortcodes.keys():
-                        if sc_name != sc_name.lower():
-                            self.logger.make_error_entry(f'Invalid capitalization in shortcode {sc_name}')
-                            sc_name = sc_name.lower()
-                        start = next_shortcode.start('sc_name')
-                        end = rest_of_file[start:].find(r'%}}')
-                        if end == -1:
-                            self.logger.make_error_entry(f'Shortcode {sc_name} has not been terminated (no "%}}"')
-                            rest_of_file = rest_of_file[start + 3:]
-                        else:
-                            sc_text = rest_of_file[start:start + end].strip()
-                            rest_of_file = rest_of_file[start + end:]
-                            if sc_text:
-                                processor, attrs_valid, attrs_required = self.shortcodes[sc_name]
-                                if processor != self._xx:
-                                    processor(sc_name, sc_text, attrs_valid, attrs_required)
-
-                    else:
-                        self.logger.make_error_entry(f'Shortcode {sc_name} is not a recognized shortcode.')
-
-                else:
-                    break
+            self._log_diagnostics(self.check_text(file_content))
         except FileNotFoundError as e:
             self.logger.make_error_entry(f'File {self.filepath} not found - does the actual filename contain spaces? ')
         except Exception as e:
             self.logger.make_error_entry(f'Error: {e.args}')
+        return self.diagnostics
+
+    @traced(category='shortcodes')
+    def validate_docx(self):
+        """Check the shortcodes of a docx without converting it - the text is read from the document's XML."""
+        if self.filetype != 'docx':
+            self.logger.make_error_entry(f"File {self.filepath} is not of type docx")
+            return self.diagnostics
+        try:
+            # One line per paragraph - diagnostics give the paragraph as the line
+            text = '\n'.join(docx_paragraphs(self.filepath)).translate(self.transl_table)
+        except (OSError, KeyError, zipfile.BadZipFile, ET.ParseError) as e:
+            self.logger.make_error_entry(f"Unable to read document {self.filepath}: {e}")
+            return self.diagnostics
+        try:
+            self._log_diagnostics(self.check_text(text))
+        except Exception as e:
+            self.logger.make_error_entry(f'Error: {e.args}')
+        return self.diagnostics
+
+    def check_text(self, text):
+        """Check every shortcode of text in one pass, returning a ShortcodeDiagnostic per problem found.
+
+        A shortcode runs from '{{% name' to the next '%}}' - shortcodes within it are not checked."""
+        self.diagnostics = []
+        resume = 0              # Matches before this are within a shortcode already checked
+        close = None            # Next '%}}' at or after the current shortcode, -1 if there are no more
+        line, line_start, counted = 1, 0, 0     # Line (and where it starts) of position counted
+        for next_shortcode in self.shortcode_re.finditer(text):
+            if next_shortcode.start() < resume:
+                continue
+            newlines = text.count('\n', counted, next_shortcode.start())
+            if newlines:
+                line += newlines
+                line_start = text.rfind('\n', counted, next_shortcode.start()) + 1
+            counted = next_shortcode.start()
+            self._position = (line, counted - line_start + 1)
+            start = next_shortcode.start('sc_name')
+            sc_name = next_shortcode.group('sc_name').strip()
+            if sc_name.lower() not in self.shortcodes:
+                self._shortcode_error(f'Shortcode {sc_name} is not a recognized shortcode.', sc_name)
+                resume = next_shortcode.end()
+                continue
+            if sc_name != sc_name.lower():
+                self._shortcode_error(f'Invalid capitalization in shortcode {sc_name}', sc_name)
+                sc_name = sc_name.lower()
+            if close is None or -1 < close < start:
+                close = text.find('%}}', start)
+            if close == -1:
+                # Nor will any later shortcode be - each is reported without searching again
+                self._shortcode_error(f'Shortcode {sc_name} has not been terminated (no "%}}}}")', sc_name)
+                resume = start + 3
+                continue
+            sc_text = text[start:close].strip()
+            resume = close
+            if sc_text:
+                processor, attrs_valid, attrs_required = self.shortcodes[sc_name]
+                if processor != self._xx:
+                    processor(sc_name, sc_text, attrs_valid, attrs_required)
+        return self.diagnostics
+
+    def _shortcode_error(self, entry, shortcode=None, attribute=None):
+        line, column = self._position
+        self.diagnostics.append(ShortcodeDiagnostic(entry, line, column, shortcode, attribute))
+        metrics.count('shortcode_errors_total', help_text="Errors found in shortcodes of documents")
+
+    def _log_diagnostics(self, diagnostics):
+        for diagnostic in diagnostics:
+            self.logger.make_error_entry(str(diagnostic))
 
     def _make_attribute_dictionary(self, sc_text):
         """Create dictionary of attributes/values for shortcode. """
-        attr_dict = dict()
-        while True:
-            next_attr = re.search(self.sc_attr, sc_text)
-            if not next_attr:
-                break
-            else:
-                attr_dict[next_attr.group('attribute')] = next_attr.group('value')
-                sc_text = sc_text[next_attr.end('value'):]
-        return attr_dict
+        return {x.group('attribute'): x.group('value') for x in self.sc_attr.finditer(sc_text)}
 
     def _verify_attribute_names(self, attr_dict, valid_attributes, required_attributes, sc_name):
         """Verify that attributes exist and are spelled correctly."""
@@ -118,18 +220,19 @@ class ValidateShortcodes(object):
         if '*' not in valid_attributes:
             for key in attr_dict.keys():
                 if key.lower() not in valid_attributes:
-                    self.logger.make_error_entry(f"Unrecognized attribute {key} in {sc_name}.")
+                    self._shortcode_error(f"Unrecognized attribute {key} in {sc_name}.", sc_name, key)
                 elif key not in valid_attributes:
-                    self.logger.make_error_entry(f"Improper capitalization for attribute {key} in {sc_name}.")
+                    self._shortcode_error(f"Improper capitalization for attribute {key} in {sc_name}.", sc_name, key)
         else:
             # Check capitalization on any that happen to be in valid_attributes as any other must be assumed valid
             for key in attr_dict.keys():
                 if key.lower() in valid_attributes and key not in valid_attributes:
-                    self.logger.make_error_entry(f"Improper capitalization for attribute {key} in {sc_name}.")
+                    self._shortcode_error(f"Improper capitalization for attribute {key} in {sc_name}.", sc_name, key)
         if required_attributes:
             for attr_name in required_attributes:
                 if attr_name not in attr_dict.keys():
-                    self.logger.make_error_entry(f"Required attribute {attr_name} not found in shortcode {sc_name}")
+                    self._shortcode_error(f"Required attribute {attr_name} not found in shortcode {sc_name}", sc_name,
+                                          attr_name)
 
     def _singlepic(self, sc_name, sc_text, attrs_valid, attrs_required):
         try:
@@ -140,15 +243,16 @@ class ValidateShortcodes(object):
                 attr_val = attr_dict[key]
                 if key == 'image':
                     if not attr_val.startswith('/images') or attr_val.split('.')[-1] not in ['jpg', 'jpeg', 'tif']:
-                        self.logger.make_error_entry(f"Image path: {attr_val} appears to be invalid.")
+                        self._shortcode_error(f"Image path: {attr_val} appears to be invalid.", sc_name, key)
                 elif key == 'alignment':
                     if attr_val and attr_val not in ['right', 'center', 'left', 'float-left', 'float-right']:
-                        self.logger.make_error_entry(f"Invalid alignment value {attr_val} in {sc_name}.")
+                        self._shortcode_error(f"Invalid alignment value {attr_val} in {sc_name}.", sc_name, key)
             for required_attr in attrs_required:
                 if required_attr not in attr_dict.keys():
-                    self.logger.make_error_entry(f"Missing required attribute {required_attr} in {sc_name}.")
+                    self._shortcode_error(f"Missing required attribute {required_attr} in {sc_name}.", sc_name,
+                                          required_attr)
         except Exception as e:
-            self.logger.make_error_entry(f"Encountered exception {e.args} when validating singlepic.")
+            self._shortcode_error(f"Encountered exception {e.args} when validating singlepic.", sc_name)
 
     def _xx(self):
         pass
@@ -158,7 +262,7 @@ class ValidateShortcodes(object):
             attr_dict = self._make_attribute_dictionary(sc_text)
             self._verify_attribute_names(attr_dict, attrs_valid, attrs_required, sc_name)
         except Exception as e:
-            self.logger.make_error_entry(f"Encountered exception {e.args} when validating {sc_name}.")
+            self._shortcode_error(f"Encountered exception {e.args} when validating {sc_name}.", sc_name)
 
 
     def _xx(self):
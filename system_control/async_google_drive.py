@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import tempfile as tf
+
+from system_control import manage_google_drive as mgd
+from system_control.drive_snapshot import DriveSnapshot
+from utilities.run_log_command import run_command_async
+
+
+def _tree_size(directory):
+    """(files, bytes) below a local directory."""
+    files = size = 0
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+class AsyncManageGoogleDrive(object):
+    """Asyncio version of ManageGoogleDrive for overlapping drive operations in one event loop.
+
+    Operations are built by ManageGoogleDrive (same rc calls and rclone command lines) and share its
+    daemon, transfer scheduler, listing cache, snapshot and download manifest.  At most max_operations
+    run at a time from this instance, within the limits of the run's transfer scheduler."""
+
+    def __init__(self, max_operations=4):
+        self.drive = mgd.ManageGoogleDrive()
+        self.max_operations = max_operations
+        self.semaphore = None   # Created in the event loop on first use
+
+    def _limit(self):
+        if not self.semaphore:
+            self.semaphore = asyncio.Semaphore(self.max_operations)
+        return self.semaphore
+
+    async def _run_rclone(self, command_line, logger, result_as_string=False):
+        result = await self.drive.scheduler.run_async(
+            logger, command_line, lambda: run_command_async(command_line, logger, capture_stdout=result_as_string),
+            check=lambda x: x.output_text)
+        if result_as_string:
+            return result.stdout if result.ok else None
+        return result.ok
+
+    async def _perform(self, logger, request, listing=False):
+        """Carry out a request built by ManageGoogleDrive - see ManageGoogleDrive._perform."""
+        method, params, command_line = request
+        async with self._limit():
+            if self.drive.remote_control:
+                # The daemon is called over a blocking http connection - keep it off the event loop
+                loop = asyncio.get_event_loop()
+                res = await loop.run_in_executor(None, self.drive._rc_call, logger, method, params)
+                if res is not None:
+                    return res['list'] if listing else res
+            res = await self._run_rclone(command_line, logger, result_as_string=listing)
+        return self.drive._decode_listing(request, res) if listing else res
+
+    async def list_tree(self, logger, root, max_depth=-1):
+        entries = await self._perform(logger, self.drive._list_request(root, recurse=True, max_depth=max_depth),
+                                      listing=True)
+        return DriveSnapshot(root, entries)
+
+    async def list_entries(self, logger, directory):
+        entries = self.drive._known_entries(directory)
+        if entries is not None:
+            return entries
+        try:
+            entries = await self._perform(logger, self.drive._list_request(directory), listing=True)
+        except Exception as e:
+            logger.make_error_entry(f'Error listing files in directory: {directory}')
+            raise e
+        if mgd._listing_cache:
+            mgd._listing_cache.put(directory, entries)
+        return entries
+
+    async def directory_list_files(self, logger, directory):
+        return [entry['Name'] for entry in await self.list_entries(logger, directory) if not entry['IsDir']]
+
+    async def directory_list_directories(self, logger, directory):
+        return [entry['Name'] for entry in await self.list_entries(logger, directory) if entry['IsDir']]
+
+    async def download_directory(self, logger, dir_to_download, target_dir, max_depth=1):
+        if mgd._manifest:
+            # Incremental downloads work on the local manifest and mirror - run the synchronous version
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.drive.download_directory, logger, dir_to_download,
+                                       target_dir, max_depth)
+            return
+        try:
+            await self._perform(logger, self.drive._download_directory_request(dir_to_download, target_dir, max_depth))
+        except Exception as e:
+            logger.make_error_entry('Error downloading file directory {}'.format(dir_to_download))
+            raise e
+
+    async def download_file(self, logger, source_dir, file_to_download, target_dir):
+        try:
+            await self._perform(logger, self.drive._download_file_request(source_dir, file_to_download, target_dir))
+        except Exception as e:
+            logger.make_error_entry('Error downloading file  {}'.format(file_to_download))
+            raise e
+
+    async def download_files(self, logger, paths, target_dir, source_dir=''):
+        if not paths:
+            return
+        source_dir = source_dir.strip('/')
+        files_from = self.drive._write_files_from(paths)
+        try:
+            await self._perform(logger, self.drive._download_files_request(files_from, target_dir, source_dir))
+        except Exception as e:
+            logger.make_error_entry(f'Error downloading {len(paths)} files from {source_dir}')
+            raise e
+        finally:
+            os.remove(files_from)
+        local_paths = [os.path.join(str(target_dir), path.strip('/')) for path in paths]
+        local_paths = [x for x in local_paths if os.path.exists(x)]
+        mgd._transferred('download', len(local_paths), sum(os.path.getsize(x) for x in local_paths))
+
+    async def download_control_files(self, logger, root, target_dir):
+        """Download every control file (CONTROL_FILE_PATTERNS) below root, keeping the folder structure."""
+        paths = mgd.control_file_paths(root)
+        if paths is not None:
+            # Paths are known - no need for rclone to walk the tree
+            await self.download_files(logger, paths, target_dir, source_dir=root)
+            return
+        await self._perform(logger, self.drive._control_files_request(root, target_dir))
+        mgd._transferred('download', *_tree_size(target_dir))
+
+    async def upload_file(self, logger, target_dir, file_to_upload, source_dir):
+        try:
+            await self._perform(logger, self.drive._upload_file_request(target_dir, file_to_upload, source_dir))
+            self.drive._invalidate_listing(target_dir)
+        except Exception as e:
+            logger.make_error_entry('Error uploading file {}'.format(file_to_upload))
+            raise e
+
+
+async def _prepare_run(logger, root, temp_dir, snapshot, control_files, max_operations):
+    drive = AsyncManageGoogleDrive(max_operations=max_operations)
+    mirror = tf.TemporaryDirectory(prefix='control', dir=temp_dir) if control_files else None
+    jobs = [drive.download_control_files(logger, root, mirror.name) if control_files else None,
+            drive.list_tree(logger, root) if snapshot else None]
+    results = await asyncio.gather(*[job for job in jobs if job], return_exceptions=True)
+    fetched, tree = [results.pop(0) if job else None for job in jobs]
+    if control_files:
+        if isinstance(fetched, Exception):
+            logger.make_error_entry(f"Unable to prefetch control files of {root}: {fetched}")
+            mirror.cleanup()
+        else:
+            mgd.set_control_mirror(root, mirror)
+    if snapshot:
+        if isinstance(tree, Exception):
+            logger.make_error_entry(f"Unable to build drive snapshot of {root}: {tree}")
+        else:
+            mgd.set_snapshot(tree)
+            logger.make_info_entry(f"Drive snapshot of {root} holds {len(tree.entries)} entries")
+    return control_files and not isinstance(fetched, Exception)
+
+
+def prepare_run(logger, root, temp_dir, snapshot=True, control_files=True, max_operations=4):
+    """Take the whole tree snapshot and/or prefetch the control files of root at the same time.
+
+    The snapshot then answers folder listings for the rest of the run (manage_google_drive.get_snapshot)
+    and control_file finds the local copy of a control file.  Returns True if the control files were fetched."""
+    return asyncio.run(_prepare_run(logger, root, temp_dir, snapshot, control_files, max_operations))
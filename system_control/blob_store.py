@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+
+FICLONE = 0x40049409  # ioctl to reflink a file on filesystems that support it (btrfs, xfs)
+
+
+class BlobStore(object):
+    """Persistent store of downloaded drive files keyed by their content hash.
+
+    A file that appears in several folders, or is unchanged from one run to the next, is fetched
+    and stored once.  Working directories are filled with copies (reflinks where possible) from the store.
+    When the store grows beyond max_bytes the least recently used blobs are removed."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def blob_key(entry, remote_path):
+        """Drive hash of an lsjson entry.  Google native documents have none so key on path, size and modtime."""
+        hashes = entry.get('Hashes') or {}
+        for hash_type in ('md5', 'sha1', 'sha256'):
+            if hash_type in hashes:
+                return hash_type + '-' + hashes[hash_type]
+        unhashed = f"{remote_path}\0{entry.get('Size')}\0{entry.get('ModTime')}"
+        return 'path-' + hashlib.sha256(unhashed.encode('utf-8')).hexdigest()
+
+    def blob_path(self, key):
+        name = key.split('-', 1)[-1]
+        return os.path.join(self.root, name[:2], key)
+
+    def contains(self, key):
+        return os.path.exists(self.blob_path(key))
+
+    def add(self, key, source_path):
+        """Move a downloaded file into the store and return its path in the store."""
+        blob = self.blob_path(key)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.remove(source_path)
+        else:
+            os.replace(source_path, blob)
+        return blob
+
+    def copy_to(self, key, target_path):
+        """Place a copy of the blob at target_path - a reflink (no data copied) if the filesystem allows it.
+
+        Never a hard link: later steps write over files in the working directory in place, which would
+        change the blob for every other path with the same content and for later runs."""
+        blob = self.blob_path(key)
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+        if not self._reflink(blob, target_path):
+            shutil.copy2(blob, target_path)
+        os.utime(blob)  # Recently used - kept longest on eviction
+
+    @staticmethod
+    def _reflink(source, target):
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return True
+        except OSError:
+            if os.path.exists(target):
+                os.remove(target)
+            return False
+
+    def evict(self):
+        """Remove least recently used blobs until the store is within max_bytes.  Returns bytes removed."""
+        with self.lock:
+            blobs = []
+            total = 0
+            for root, dirs, files in os.walk(self.root):
+                for file in files:
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    blobs.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            removed = 0
+            for mtime, size, path in sorted(blobs):
+                if total - removed <= self.max_bytes:
+                    break
+                os.remove(path)
+                removed += size
+            return removed
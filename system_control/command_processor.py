@@ -3,15 +3,22 @@ import pathlib as pl
 import tempfile as tf
 import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 
 import yaml as YAML
 from yaml.scanner import ScannerError
 
 import config_private as cp
+import new_content
 from new_content.process_story_content import ProcessStoryContent as PSC
+from new_content.docx_conversion import get_docx_conversion
 from new_content.relocate_info import RelocateInformation as RI
 from system_control import manage_google_drive as mgd
 from system_control.exceptions import SstCommandDefinitionException as CDEx
+from system_control.fingerprint_journal import file_fingerprint, story_fingerprint
+from utilities.run_log_command import BufferedLogger, ErrorCountingLogger, log_context, log_phase
+from utilities import metrics, profiling, tracing
 
 
 class SystemUser(object):
@@ -27,17 +34,17 @@ class SystemUser(object):
     def _load_config_users(self):
         manage_drive = mgd.ManageGoogleDrive()
 
-        temps = tf.TemporaryDirectory(prefix='user', dir=self.temp_dir)
-
         # First, pick up configuration yaml file
         user_config = 'config_users.yaml'
         try:
             top_level = self.config.get_configuration_parameter("driveSSTManagement", group="drive paths")
-            manage_drive.download_file(self.logger, top_level, user_config, temps.name)
-            with open(pl.Path(temps.name) / user_config, 'r', encoding='utf-8') as fd:
-                res = YAML.safe_load_all(fd)
-                docs = [doc for doc in res]
-                fd.close()
+            user_config_path = mgd.control_file(top_level, user_config)     # Prefetched by the system manager
+            if user_config_path:
+                fd = open(user_config_path, 'r', encoding='utf-8')
+            else:
+                fd = manage_drive.open_remote(self.logger, top_level + '/' + user_config, text=True)
+            with fd:
+                docs = [doc for doc in YAML.safe_load_all(fd)]
             user_data = dict()
             for doc in docs:
                 if doc:
@@ -64,24 +71,51 @@ class SystemUser(object):
         return res
 
 
+class FolderContext(object):
+    """State that applies while processing one folder of commands.
+
+    current_folder is the full drive path of the folder, folder its name (leaf node).  context holds
+    the identity commands in effect for the folder (inherited from its parents), identities those
+    issued in the folder and below.  Children get their own context so they can run concurrently."""
+
+    def __init__(self, current_folder, top_folder, logger, context=None):
+        self.current_folder = current_folder
+        self.folder = current_folder.split('/')[-1]
+        self.top_folder = top_folder
+        self.logger = logger
+        self.context = list(context or [])
+        self.identities = []
+        self.in_worker = False
+
+    def child(self, folder):
+        child = FolderContext(self.current_folder + '/' + folder, self.top_folder, self.logger, context=self.context)
+        child.in_worker = self.in_worker
+        return child
+
+
 class ManageFolders(object):
     """Manage top level directories on SSTManagement"""
 
-    def __init__(self, config, logger, users, command_prefix):
+    def __init__(self, config, logger, users, command_prefix, journal=None, force_reprocess=False):
         self.config = config
         self.logger = logger
         self.temp_dir = config.get_configuration_parameter('tempDirectory')
         self.sst_directory = config.get_configuration_parameter('SSTDirectory')
         self.support_directory = config.get_configuration_parameter('supportDirectory')
-        # Note: local_temp is reused - it must be emptied before loading a new command file (get_commands)
+        # local_temp is only used by get_command_file - get_commands reads the control files of prepare_run,
+        # the prefetched copies below or opens the file on drive
         self.local_temp = tf.TemporaryDirectory(dir=self.temp_dir, prefix='cmd')
+        # commands.txt of sibling folders are fetched together before processing them (_prefetch_commands)
+        self.prefetch_temp = tf.TemporaryDirectory(dir=self.temp_dir, prefix='cmds')
         self.users = users
         self.command_prefix = command_prefix  # Prefix to append to top level commands.txt to allow multiple users
         self.manage_drive = mgd.ManageGoogleDrive()
         self.top_folder = config.get_configuration_parameter("driveSSTManagement", group="drive paths")
-        # self.current_folder is the full path to the folder being processed (leaf node, a.k.a. folder)
-        # folder is used as the name of the specific folder (leaf node) being processed.
-        self.current_folder = self.top_folder
+        # The folder being processed, and anything that changes while processing it, is held in a
+        # FolderContext passed to each command so that independent folders can be processed concurrently.
+        max_workers = config.get_configuration_parameter('maxFolderWorkers', group='performance')
+        self.max_workers = int(max_workers) if max_workers else 1
+        self.executor = None
         self.valid_command_sets = ["top", "content", "story", "transfer_files", "transfer_to_support", "update_pages"]
         self.valid_commands = \
             {"top": ["identity", "change_folder", "process_single_folder"],
@@ -110,65 +144,106 @@ class ManageFolders(object):
              }
         # Note:  this is a potential bug if the same subcommand exists in two different commands with different attrs
         self.subcommand_definitions = \
-            {"identity": ['person', 'send_log'],
+            {"identity": ['person', 'send_log', 'full_log'],
              "process_single_folder": ['folder', 'folder_type'],
              "change_folder": ['folder'],
              "move_files": ['target_directory'],
              }
         self.context = []
         self.futures = []
-
-    def validate_command_file(self, directory, file):
-        """Read and check command file for possible errors."""
-        err = self.logger.make_error_entry
-        filepath = pl.Path(directory) / file
+        # Story folders whose inputs, templates and processing code are unchanged since their last successful
+        # run are skipped unless force_reprocess is set.
+        self.journal = journal
+        self.force_reprocess = force_reprocess
+        self.processed_stories = []
+        self.skipped_stories = []
+        # (folder, fingerprint, outputs, queued conversions) of story folders processed without errors - journalled
+        # once their documents have been converted without errors too (_record_stories)
+        self.completed_stories = []
+        if journal:
+            code_dir = pl.Path(new_content.__file__).parent
+            self.code_fingerprint = file_fingerprint([str(x) for x in code_dir.glob('*.py')] +
+                                                     [str(x) for x in code_dir.glob('templates/*.mako')])
+
+    def validate_command_file(self, directory, file, logger=None, lines=None):
+        """Read and check command file for possible errors.  lines is its content if already read."""
+        logger = logger or self.logger
+        err = logger.make_error_entry
+        if lines is None:
+            with open(pl.Path(directory) / file) as cmd_file:
+                lines = cmd_file.readlines()
         try:
-            with open(filepath) as cmd_file:
-                self.logger.make_info_entry(f"Validating file: {file}.")
-                cmd_set = None
-                curr_cmd = None
-                for line_no, line in enumerate(cmd_file.readlines()):
-                    line_strip = line.strip()
-                    if len(line_strip) < 3:
-                        break
-                    if line_strip[0] == '#':
-                        break
-                    first_tab = line.find('\t')
-                    if first_tab != -1:
-                        err(f"File contains at least one tab at position {first_tab}")
-                    if line.startswith("---"):
-                        curr_cmd = None
+            logger.make_info_entry(f"Validating file: {file}.")
+            cmd_set = None
+            curr_cmd = None
+            for line_no, line in enumerate(lines):
+                line_strip = line.strip()
+                if len(line_strip) < 3:
+                    break
+                if line_strip[0] == '#':
+                    break
+                first_tab = line.find('\t')
+                if first_tab != -1:
+                    err(f"File contains at least one tab at position {first_tab}")
+                if line.startswith("---"):
+                    curr_cmd = None
+                else:
+                    line_parts = line.split('#')[0].split(':')
+                    el = line_parts[0]
+                    if len(line_parts) < 2:
+                        err(f"Command_set does not contain a specific command_set ")
+                        raise CDEx(f"No command_set found")
+                    el2 = line_parts[1].strip().lower()
+                    if not curr_cmd:  # Validate command_set
+                        if not cmd_set:
+                            if el != 'command_set':
+                                err(f"'Command_set' not found in file.")
+                                raise CDEx("Missing Command Set")
+                            if el2 not in self.valid_command_sets:
+                                err(f"{el2} in line {line_no}' is not a valid command_set")
+                                raise CDEx(f"Unrecognized Command Set")
+                            cmd_set = el2
+                        else:  # must be a command appropriate for the command_set
+                            if el != 'command':
+                                err(f"{el} is not a part of command {cmd_set}")
+                                raise CDEx(f"Invalid command for this command set")
+                            if el2 not in self.valid_commands[cmd_set]:
+                                err(f"{el2} in line {line_no} is not a valid command for command_set {cmd_set}")
+                                raise CDEx(f"Invalid command for this command set")
+                            curr_cmd = el2
                     else:
-                        line_parts = line.split('#')[0].split(':')
-                        el = line_parts[0]
-                        if len(line_parts) < 2:
-                            err(f"Command_set does not contain a specific command_set ")
-                            raise CDEx(f"No command_set found")
-                        el2 = line_parts[1].strip().lower()
-                        if not curr_cmd:  # Validate command_set
-                            if not cmd_set:
-                                if el != 'command_set':
-                                    err(f"'Command_set' not found in file.")
-                                    raise CDEx("Missing Command Set")
-                                if el2 not in self.valid_command_sets:
-                                    err(f"{el2} in line {line_no}' is not a valid command_set")
-                                    raise CDEx(f"Unrecognized Command Set")
-                                cmd_set = el2
-                            else:  # must be a command appropriate for the command_set
-                                if el != 'command':
-                                    err(f"{el} is not a part of command {cmd_set}")
-                                    raise CDEx(f"Invalid command for this command set")
-                                curr_cmd = el2
-                        else:
-                            if not self._check_function_in_subcommand_definitions(curr_cmd, el):
-                                err(f"{el} is not valid in this command: {curr_cmd}")
-                                raise CDEx(f"Invalid subcommand")
+                        if not self._check_function_in_subcommand_definitions(curr_cmd, el):
+                            err(f"{el} is not valid in this command: {curr_cmd}")
+                            raise CDEx(f"Invalid subcommand")
         except CDEx as e:
-            cmd_file.close()
             return False
-        cmd_file.close()
         return True
 
+    def validate_command_tree(self):
+        """Check every command file of the tree before any of them is processed, logging those that are invalid.
+
+        Uses the control files fetched by prepare_run (async_google_drive).  The tree may hold folders the run
+        never reaches, so nothing is stopped here - an invalid file stops the run when get_commands reads it,
+        as it always has.  Returns the folders with invalid command files."""
+        top_folder = self.top_folder.strip('/')
+        top_file = self.command_prefix + 'commands.txt'
+        if self.command_prefix == 'use_config_private':
+            top_folder = (top_folder + '/' + cp.command_path).strip('/')
+            top_file = cp.command_file
+        invalid = []
+        for directory, file, local_path in mgd.control_files():
+            if 'ignore' in directory[len(top_folder):].split('/'):
+                continue
+            if directory == top_folder:
+                if file != top_file:
+                    continue
+            elif file != 'commands.txt':
+                continue
+            if not self.validate_command_file(os.path.dirname(local_path), file):
+                self.logger.make_error_entry(f"Invalid command file: {directory}/{file}")
+                invalid.append(directory)
+        return invalid
+
     def _check_function_in_subcommand_definitions(self, cmd, sub_cmd):
         if cmd not in self.subcommand_definitions.keys():
             return False
@@ -178,59 +253,54 @@ class ManageFolders(object):
 
     def get_folder_names(self, folder):
         """Retrieve list of the names of the contained folders from drive within a given source folder."""
-        dir_list = self.manage_drive.directory_list_directories(self.logger, folder).decode('utf-8')
-        dirs = []
-        for line in dir_list.split('\n'):
-            elements = line.split()
-            if type(elements) is list and len(elements) > 0:
-                dirs.append(elements[-1])
-        return dirs
+        return self.manage_drive.directory_list_directories(self.logger, folder)
 
     def get_folder_content(self, folder):
         """Download a specified folder into a new temporary directory and return the directory. """
         pass
 
-    def get_file_names(self, folder):
+    def get_file_names(self, folder, logger=None):
         """Retrieve list of names of contained files in specific folder from drive."""
-        files = self.manage_drive.directory_list_files(self.logger, folder)
+        files = self.manage_drive.directory_list_files(logger or self.logger, folder)
         return files
 
-    def get_commands(self, folder):
+    def get_commands(self, folder, fctx):
         """Load commands.txt as yaml list of documents (dictionaries)."""
+        logger = fctx.logger
         try:
             filename = "commands.txt"
             filepath = filename
-            if folder == self.top_folder:
+            if folder == fctx.top_folder:
                 if self.command_prefix == 'use_config_private':         # Hack to support old still till all changed.
                     filename = cp.command_file
-                    if self.current_folder.endswith('/'):
-                        self.current_folder = self.current_folder + cp.command_path
+                    if fctx.current_folder.endswith('/'):
+                        fctx.current_folder = fctx.current_folder + cp.command_path
                     else:
-                        self.current_folder = self.current_folder + '/' + cp.command_path
+                        fctx.current_folder = fctx.current_folder + '/' + cp.command_path
                 else:
                     filename = self.command_prefix + filename
-            # We must clear the temp directory before downloading - this soln is more general than needed
-            # but works in all cases
-            for root, dirs, files in os.walk(self.local_temp.name):
-                for f in files:
-                    os.unlink(os.path.join(root, f))
-                for d in dirs:
-                    shutil.rmtree(os.path.join(root, d))
-            self.manage_drive.download_file(self.logger, self.current_folder, filename, self.local_temp.name)
-            if not self.validate_command_file(self.local_temp.name, filename):
-                self.logger.make_error_entry(f"Invalid command file in folder: {folder}")
+            # Read from the prefetched copies if there is one, else straight from drive
+            local_path = mgd.control_file(fctx.current_folder, filename)
+            prefetched = self._prefetched_path(fctx.current_folder, filename)
+            if not local_path and os.path.exists(prefetched):
+                local_path = prefetched
+            if local_path:
+                with open(local_path, 'r', encoding='utf-8') as fd:
+                    content = fd.read()
+            else:
+                with self.manage_drive.open_remote(logger, fctx.current_folder + '/' + filename, text=True) as fd:
+                    content = fd.read()
+            if not self.validate_command_file(None, filename, logger=logger, lines=content.splitlines(True)):
+                logger.make_error_entry(f"Invalid command file in folder: {folder}")
                 raise CDEx("Invalid Command File")
-            with open(pl.Path(self.local_temp.name) / filename, 'r', encoding='utf-8') as fd:
-                res = YAML.safe_load_all(fd)
-                docs = [doc for doc in res]
-                fd.close()
-                if not docs[-1]:   # Remove empty terminating line if it exists
-                    docs.pop()
+            docs = [doc for doc in YAML.safe_load_all(content)]
+            if not docs[-1]:   # Remove empty terminating line if it exists
+                docs.pop()
             return docs
         except ScannerError as e:
-            self.logger.make_error_entry(f"YAML error reading commands.txt: error: {e.args}\n\tBeware of tab chars")
+            logger.make_error_entry(f"YAML error reading commands.txt: error: {e.args}\n\tBeware of tab chars")
         except Exception as e:
-            self.logger.make_error_entry(f"Error retreiving commands.txt in folder {folder} with error: {e.args}")
+            logger.make_error_entry(f"Error retreiving commands.txt in folder {folder} with error: {e.args}")
             raise e
 
     def get_command_file(self, folder):
@@ -249,26 +319,121 @@ class ManageFolders(object):
             raise e
 
     def process_commands_top(self):
-        self.process_commands(self.top_folder)
-
-    def process_commands(self, folder):
-        """Open and initiate processing of a folder containing commands.txt"""
-        cmds = self._get_command_set(folder)
+        fctx = FolderContext(self.top_folder, self.top_folder, self.logger)
+        if self.max_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='folder')
+        try:
+            self.process_commands(self.top_folder, fctx)
+        finally:
+            if get_docx_conversion():
+                # Documents queued by the story folders - their entries follow the folders' own
+                with log_phase(self.logger, 'docx_conversion'):
+                    get_docx_conversion().wait(self.logger)
+            if self.journal:
+                self._record_stories()
+            if self.executor:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self.context = fctx.identities
+            self.top_folder = fctx.top_folder
+
+    def process_commands(self, folder, fctx):
+        """Open and initiate processing of a folder containing commands.txt
+
+        folder is the name of the folder (leaf node), fctx holds its full path and the state that
+        applies while processing it.  Entries logged meanwhile are tagged with the folder path."""
+        with log_context(folder=fctx.current_folder, command=None, phase=None), \
+                tracing.span(fctx.current_folder, category='folder', folder=fctx.current_folder), \
+                profiling.profile('folder', folder=fctx.current_folder):
+            start = time.monotonic()
+            try:
+                self._process_folder_commands(folder, fctx)
+            finally:
+                # Includes the folder's subfolders
+                metrics.observe('folder_duration_seconds', time.monotonic() - start,
+                                help_text="Time to process the commands of a folder")
+
+    def _process_folder_commands(self, folder, fctx):
+        cmds = self._get_command_set(folder, fctx)
         command_set = cmds[0]['command_set'].lower()
         if command_set not in self.valid_command_sets:
-            self.logger(f"Invalid command set: {command_set} for folder: {folder}")
+            fctx.logger.make_error_entry(f"Invalid command set: {command_set} for folder: {folder}")
             raise CDEx(f"Invalid command set: {command_set}")
         valid_commands = self.valid_commands[command_set]
-        for command in self._generate_commands(cmds[1:], valid_commands):
+        # Consecutive process_single_folder commands are independent and are run together
+        pending_folders = []
+        for command in self._generate_commands(cmds[1:], valid_commands, fctx.logger):
             print(f"Command {command}  in folder {folder} to be executed.")  # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
             # 'command' has already been checked for existence in the generator
             command_name = command['command']
             key = (command_set, command_name)
             if key not in self.command_subcommands:
-                self.logger.make_error_entry(f"Command: {command} not valid for command_set: {command_set} in folder: {folder}")
+                self._run_folders(pending_folders, fctx)
+                fctx.logger.make_error_entry(f"Command: {command} not valid for command_set: {command_set} in folder: {folder}")
                 raise CDEx(f"Invalid command: {command} - not supported")
             cmd = self.command_subcommands[key]
-            cmd(command)
+            if cmd == self._command_single_folder:
+                try:
+                    pending_folders.append(self._single_folder_context(command, fctx))
+                except Exception:
+                    self._run_folders(pending_folders, fctx)  # Errors surface in the order they would sequentially
+                    raise
+                continue
+            self._run_folders(pending_folders, fctx)
+            pending_folders = []
+            with log_phase(fctx.logger, 'command', command=command_name):
+                cmd(command, fctx)
+        self._run_folders(pending_folders, fctx)
+
+    def _prefetched_path(self, folder, filename):
+        return os.path.join(self.prefetch_temp.name, folder.strip('/'), filename)
+
+    def _prefetch_commands(self, child_contexts, fctx):
+        """Download the commands.txt of a set of folders in one transfer.
+
+        Folders without one are skipped by rclone - get_commands then reports the error as before."""
+        paths = [child.current_folder.strip('/') + '/commands.txt' for child in child_contexts
+                 if not mgd.control_file(child.current_folder, 'commands.txt')]
+        try:
+            self.manage_drive.download_files(fctx.logger, paths, self.prefetch_temp.name)
+        except Exception as e:
+            # Not fatal - each folder downloads its own file
+            fctx.logger.make_error_entry(f"Unable to prefetch command files in {fctx.current_folder}: {e.args}")
+
+    def _run_folders(self, child_contexts, fctx):
+        """Process a set of independent child folders, in parallel if a worker pool is available.
+
+        Each child logs into its own buffer.  Buffers are written to the parent's log in folder order
+        and the first failure (in folder order) is raised, as it would have been sequentially.  Nested
+        folders run within the worker processing their parent."""
+        if not child_contexts:
+            return
+        if len(child_contexts) > 1:
+            self._prefetch_commands(child_contexts, fctx)
+        if not self.executor or fctx.in_worker or len(child_contexts) == 1:
+            for child in child_contexts:
+                self.process_commands(child.folder, child)
+                fctx.identities.extend(child.identities)
+            return
+        for child in child_contexts:
+            child.logger = BufferedLogger()
+            child.in_worker = True
+        futures = [self.executor.submit(self.process_commands, child.folder, child) for child in child_contexts]
+        failure = None
+        for child, future in zip(child_contexts, futures):
+            if failure:
+                future.cancel()  # Sequentially, folders after a failure would not have been started
+            try:
+                future.result()
+            except CancelledError:
+                continue
+            except Exception as e:
+                if not failure:
+                    failure = e
+            child.logger.flush_to(fctx.logger)
+            fctx.identities.extend(child.identities)
+        if failure:
+            raise failure
 
     def get_log_requests(self):
         """Find users in context wanting a copy of the log."""
@@ -280,157 +445,200 @@ class ManageFolders(object):
                         res.append(item['person'])
         return res
 
-    def _context_add(self, cmd, **kwargs):
-        self.context.append(cmd)
+    def get_log_folders(self):
+        """Map each user wanting a copy of the log to the folders their identity commands covered.
 
-    def _context_remove(self):
-        self.context.pop()
+        The values are the folders the identity commands were issued in (each covers its subfolders)
+        and whether a full copy of the log was asked for (full_log)."""
+        res = dict()
+        for item in self.context:
+            if item.get('person') and item.get('send_log'):
+                for person in str(item['person']).split(','):
+                    folders, full_log = res.get(person.strip(), ([], False))
+                    if item['folder'] not in folders:
+                        folders.append(item['folder'])
+                    res[person.strip()] = (folders, full_log or bool(item.get('full_log')))
+        return res
+
+    def _context_add(self, cmd, fctx, **kwargs):
+        fctx.context.append(cmd)
+        fctx.identities.append(dict(cmd, folder=fctx.current_folder))
+
+    def _context_remove(self, fctx):
+        fctx.context.pop()
 
     def _context_find(self, item):
         return item
 
-    def _get_command_set(self, folder):
+    def _get_command_set(self, folder, fctx):
         """Retrieve command set for a folder as a list
         """
-        cmds = self.get_commands(folder)
+        cmds = self.get_commands(folder, fctx)
         if not cmds:
-            self.logger.make_error_entry(f"There is no commands.txt file in {folder}")
+            fctx.logger.make_error_entry(f"There is no commands.txt file in {folder}")
             raise CDEx("Missing commands.txt")
         try:
             _ = cmds[0]["command_set"]
         except KeyError as e:
-            self.logger.make_error_entry(f"No command_set key found in folder: {folder}")
+            fctx.logger.make_error_entry(f"No command_set key found in folder: {folder}")
             raise e
         return cmds
 
-    def _generate_commands(self, command_list, allowable_commands):
+    def _generate_commands(self, command_list, allowable_commands, logger):
         """Create generator for list of allowable commands."""
         for command_dict in command_list:
             cmd = command_dict["command"].lower()
             if cmd not in allowable_commands:
-                self.logger.make_error_entry(f"Invalid  command: {cmd} not in {allowable_commands}")
+                logger.make_error_entry(f"Invalid  command: {cmd} not in {allowable_commands}")
                 raise CDEx(f"Invalid command: {cmd}")
             yield command_dict
 
-    def _get_command_attribute(self, attribute, command, default=None):
+    def _get_command_attribute(self, attribute, command, default=None, logger=None):
         try:
             res = command[attribute]
             return res
         except KeyError as e:
             if default:
                 return default
-            self.logger.make_error_entry(f"Expected {attribute} in command: {command}")
+            (logger or self.logger).make_error_entry(f"Expected {attribute} in command: {command}")
             raise e
 
-    def _command_identity(self, command):
+    def _command_identity(self, command, fctx):
         """Process identity command.
 
         If person(s) specified - must be known to system, else default to sys admin.
         If send_log specified as True - create future to send log to specified person."""
         if "person" in command:
             persons = self.users.get_persons(command['person'])
-        self._context_add(command, users=persons)
+        self._context_add(command, fctx, users=persons)
 
-    def _command_all(self, command):
+    def _command_all(self, command, fctx):
         """Process all folders in containing folder."""
-        content = self.manage_drive.directory_list_directories(self.logger, self.current_folder)
-        for item in content:
-            if item != 'ignore':
-                current_folder = self.current_folder
-                self.current_folder += '/' + item
-                self.process_commands(item)
-                self.current_folder = current_folder
-
-    def _command_single_folder(self, command, folder=None, folder_type=None):
-        # Keyword args are to allow the 'All' command to use this code and provide otherwise missing values.
-        # folder represents a leaf node not yet appended to self.current_folder
-        try:
-            if not folder:
-                folder = self._get_command_attribute("folder", command)
-            if not folder_type:
-                folder_type = self._get_command_attribute("folder_type", command)
-            current_folder = self.current_folder
-            self.current_folder += '/' + folder
-            # Allow for use of either underscore or dash
-            # Note: site_content implies processing a single folder in the case where
-            #       there may be other folders that are to be skipped (e.g., at top level)
-            if folder_type == "site_content" or folder_type == 'site-content':
-                self.process_commands(folder)
-            elif folder_type == "story":  # content for a single story (or part of one)
-                self.process_commands(folder)
-            else:
-                self.logger.make_error_entry(f"Unrecognized folder_type: {folder_type} for folder: {folder}")
-                self.current_folder = current_folder
-                raise CDEx(f"Invalid folder_type: {folder_type}")
-            self.current_folder = current_folder
-        finally:
-            self.current_folder = current_folder
+        content = self.manage_drive.directory_list_directories(fctx.logger, fctx.current_folder)
+        self._run_folders([fctx.child(item) for item in content if item != 'ignore'], fctx)
 
-    def _command_process_story(self, command):
+    def _single_folder_context(self, command, fctx, folder=None, folder_type=None):
+        """Check a process_single_folder command and return the context to process its folder with."""
+        # Keyword args are to allow the 'All' command to use this code and provide otherwise missing values.
+        # folder represents a leaf node not yet appended to fctx.current_folder
+        if not folder:
+            folder = self._get_command_attribute("folder", command, logger=fctx.logger)
+        if not folder_type:
+            folder_type = self._get_command_attribute("folder_type", command, logger=fctx.logger)
+        # Allow for use of either underscore or dash
+        # Note: site_content implies processing a single folder in the case where
+        #       there may be other folders that are to be skipped (e.g., at top level)
+        # A 'story' folder_type is content for a single story (or part of one)
+        if folder_type not in ("site_content", 'site-content', "story"):
+            fctx.logger.make_error_entry(f"Unrecognized folder_type: {folder_type} for folder: {folder}")
+            raise CDEx(f"Invalid folder_type: {folder_type}")
+        return fctx.child(folder)
+
+    def _command_single_folder(self, command, fctx, folder=None, folder_type=None):
+        self._run_folders([self._single_folder_context(command, fctx, folder=folder, folder_type=folder_type)], fctx)
+
+    def _command_process_story(self, command, fctx):
         """Process 'story' content - a page that generates actual web content."""
         # A story may be either a docx file,  a template file, or an md file
         docx_directory = self.config.get_configuration_parameter('docxDirectory')
         sst_directory = self.config.get_configuration_parameter('SSTDirectory')
         image_directory = self.config.get_configuration_parameter('imageDirectory')
         gallery_directory = self.config.get_configuration_parameter('galleryDirectory')
-        process_folder = PSC(self.logger, self.current_folder, self.temp_dir,
-                             docx_directory, sst_directory, image_directory, gallery_directory)
-        process_folder.process_content()
+        fingerprint = None
+        if self.journal:
+            # Inputs are exactly what ProcessStoryContent downloads (the folder and its galleries)
+            entries = self.manage_drive.tree_entries(fctx.logger, fctx.current_folder, max_depth=2)
+            fingerprint = story_fingerprint(entries, self.code_fingerprint)
+            if not self.force_reprocess and self.journal.is_unchanged(fctx.current_folder, fingerprint):
+                fctx.logger.make_info_entry(f"Story folder {fctx.current_folder} unchanged - skipped")
+                self.skipped_stories.append(fctx.current_folder)
+                metrics.count('story_folders_total', help_text="Story folders seen by the command processor",
+                              outcome='skipped')
+                return
+        # Errors are not always raised (e.g. a gallery) - a folder that logged any is processed again next run
+        logger = ErrorCountingLogger(fctx.logger)
+        try:
+            process_folder = PSC(logger, fctx.current_folder, self.temp_dir,
+                                 docx_directory, sst_directory, image_directory, gallery_directory)
+            process_folder.process_content()
+        except Exception:
+            if self.journal:
+                self.journal.forget(fctx.current_folder)
+            raise
+        self.processed_stories.append(fctx.current_folder)
+        metrics.count('story_folders_total', help_text="Story folders seen by the command processor", outcome='processed')
+        if self.journal:
+            if logger.errors:
+                self.journal.forget(fctx.current_folder)
+            else:
+                self.completed_stories.append((fctx.current_folder, fingerprint, process_folder.outputs,
+                                               process_folder.conversions))
+
+    def _record_stories(self):
+        """Journal the story folders completed without errors, once their documents have been converted."""
+        for folder, fingerprint, outputs, conversions in self.completed_stories:
+            if any(conversion.failed is not False for conversion in conversions):
+                self.journal.forget(folder)
+            else:
+                self.journal.record(folder, fingerprint, outputs)
+        self.completed_stories = []
 
-    def _command_transfer_files(self, command):
+    def _command_transfer_files(self, command, fctx):
         """Transfer files to pages directory for processing
 
         Files are transferred without checking or change. This presumes they
         are suitable for nikola processing and have been updated on Drive."""
-        relocator = RI(self.logger, self.current_folder, self.config)
-        target_dir = self._get_command_attribute("target_directory", command)
+        relocator = RI(fctx.logger, fctx.current_folder, self.config)
+        target_dir = self._get_command_attribute("target_directory", command, logger=fctx.logger)
         relocator.move_folder_of_pagefiles(target_dir)
 
-    def _command_transfer_support_files(self, command):
+    def _command_transfer_support_files(self, command, fctx):
         """Transfer files to Support directory for further processing
 
         Files are transferred without checking or change. They will be processed
         by additional Nikola commands."""
         print(f"Command: {command} called")
-        target_dir = self._get_command_attribute("target_directory", command)
-        self.manage_drive.download_directory(self.logger, self.current_folder, self.local_temp.name)
-        all_files = os.listdir(self.local_temp.name)
-        real_target = (self.support_directory + target_dir).replace('//', '/')
-        if not os.path.isdir(real_target):
-            os.mkdir(real_target)
-        for file in all_files:
-            try:
-                if not cp.test_run and file != 'commands.txt':
-                    shutil.copy(self.local_temp.name + '/' + file, real_target + file)
-            except NameError:
-                pass
-
-
-    def _command_change_folder(self, command):
+        target_dir = self._get_command_attribute("target_directory", command, logger=fctx.logger)
+        with tf.TemporaryDirectory(dir=self.temp_dir, prefix='cmd') as local_temp:
+            self.manage_drive.download_directory(fctx.logger, fctx.current_folder, local_temp)
+            all_files = os.listdir(local_temp)
+            real_target = (self.support_directory + target_dir).replace('//', '/')
+            if not os.path.isdir(real_target):
+                os.mkdir(real_target)
+            for file in all_files:
+                try:
+                    if not cp.test_run and file != 'commands.txt':
+                        shutil.copy(local_temp + '/' + file, real_target + file)
+                except NameError:
+                    pass
+
+
+    def _command_change_folder(self, command, fctx):
         """Modify top folder."""
-        added_folder = self._get_command_attribute("folder", command)
-        self.top_folder += '/' + added_folder
-        self.current_folder = self.top_folder
-        print(f"Command: {command} called - top folder now: {self.top_folder}")
+        added_folder = self._get_command_attribute("folder", command, logger=fctx.logger)
+        fctx.top_folder += '/' + added_folder
+        fctx.current_folder = fctx.top_folder
+        print(f"Command: {command} called - top folder now: {fctx.top_folder}")
 
-    def _command_update_pages(self, command):
+    def _command_update_pages(self, command, fctx):
         """Perform file management actions in pages directory."""
         print(f"Command: {command} called")
-        file_names = self.get_file_names(self.current_folder)
-        relocator = RI(self.logger, self.current_folder, self.config)
-        for file in file_names:
-            if file != 'meta.txt' and file != 'commands.txt':
-                relocator.process_page_file_actions(file)
+        file_names = self.get_file_names(fctx.current_folder, logger=fctx.logger)
+        relocator = RI(fctx.logger, fctx.current_folder, self.config)
+        page_files = [file for file in file_names if file != 'meta.txt' and file != 'commands.txt']
+        relocator.fetch_page_files(page_files)
+        for file in page_files:
+            relocator.process_page_file_actions(file)
         pass
 
-    def _command_xxx(self, command):
+    def _command_xxx(self, command, fctx):
         print(f"Command: {command} called")
         pass
 
-    def _command_xxx(self, command):
+    def _command_xxx(self, command, fctx):
         print(f"Command: {command} called")
         pass
 
-    def _command_xxx(self, command):
+    def _command_xxx(self, command, fctx):
         print(f"Command: {command} called")
         pass
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import threading
+import time
+
+
+class DownloadManifest(object):
+    """Record of every drive file we have a local copy of.
+
+    For each remote path the manifest keeps the size, modtime and hash reported by rclone when the
+    file was fetched and where the local copy lives (a mirror of the drive tree under mirror_dir).
+    A download only needs to fetch files whose drive entry no longer matches the manifest."""
+
+    def __init__(self, manifest_file, mirror_dir):
+        self.manifest_file = manifest_file
+        self.mirror_dir = mirror_dir
+        os.makedirs(mirror_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(manifest_file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (remote_path TEXT PRIMARY KEY, size INTEGER, "
+                                "modtime TEXT, hash TEXT, local_path TEXT, fetched REAL)")
+        self.connection.commit()
+
+    @staticmethod
+    def entry_hash(entry):
+        """Hash for an lsjson entry - Google native documents have none so size/modtime must do."""
+        hashes = entry.get('Hashes') or {}
+        for hash_type in ('md5', 'sha1', 'sha256'):
+            if hash_type in hashes:
+                return hashes[hash_type]
+        return None
+
+    def mirror_path(self, remote_path):
+        return os.path.join(self.mirror_dir, remote_path.strip('/'))
+
+    def is_current(self, remote_path, entry):
+        """True if our local copy of remote_path is the version described by the drive entry."""
+        with self.lock:
+            row = self.connection.execute("SELECT size, modtime, hash, local_path FROM files WHERE remote_path = ?",
+                                          (remote_path.strip('/'),)).fetchone()
+        if not row:
+            return False
+        size, modtime, file_hash, local_path = row
+        if size != entry.get('Size') or file_hash != self.entry_hash(entry):
+            return False
+        if file_hash is None and modtime != entry.get('ModTime'):
+            return False
+        return os.path.exists(local_path)
+
+    def local_path(self, remote_path):
+        with self.lock:
+            row = self.connection.execute("SELECT local_path FROM files WHERE remote_path = ?",
+                                          (remote_path.strip('/'),)).fetchone()
+        return row[0] if row else None
+
+    def record(self, remote_path, entry, local_path):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                    (remote_path.strip('/'), entry.get('Size'), entry.get('ModTime'),
+                                     self.entry_hash(entry), local_path, time.time()))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
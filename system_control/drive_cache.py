@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class DriveListingCache(object):
+    """Cache of drive directory listings keyed by remote path.
+
+    Each listing is the list of entries from 'rclone lsjson' (Name, Size, ModTime, IsDir, Hashes...).
+    Listings expire after ttl seconds and the least recently used listing is dropped once max_entries
+    is reached.  Anything we upload invalidates the listing of the folder it was uploaded to."""
+
+    def __init__(self, ttl=900, max_entries=5000, cache_file=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.listings = OrderedDict()  # path -> (time loaded, list of entries)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(path):
+        return str(path).strip('/')
+
+    def get(self, path):
+        """Return cached entries for path or None if not cached or expired."""
+        key = self.normalize(path)
+        with self.lock:
+            if key in self.listings:
+                loaded, entries = self.listings[key]
+                if time.time() - loaded < self.ttl:
+                    self.listings.move_to_end(key)
+                    self.hits += 1
+                    return entries
+                del self.listings[key]
+            self.misses += 1
+            return None
+
+    def put(self, path, entries):
+        key = self.normalize(path)
+        with self.lock:
+            self.listings[key] = (time.time(), entries)
+            self.listings.move_to_end(key)
+            while len(self.listings) > self.max_entries:
+                self.listings.popitem(last=False)
+
+    def invalidate(self, path):
+        """Drop the listing for path and any folder below it."""
+        key = self.normalize(path)
+        with self.lock:
+            for cached in list(self.listings.keys()):
+                if cached == key or cached.startswith(key + '/'):
+                    del self.listings[cached]
+
+    def load(self):
+        """Reload unexpired listings saved by a previous run."""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as fd:
+                saved = json.load(fd)
+        except ValueError:
+            return
+        now = time.time()
+        with self.lock:
+            for key, loaded, entries in saved:
+                if now - loaded < self.ttl:
+                    self.listings[key] = (loaded, entries)
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self.lock:
+            saved = [(key, loaded, entries) for key, (loaded, entries) in self.listings.items()]
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as fd:
+            json.dump(saved, fd)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import threading
+
+
+class DriveSnapshot(object):
+    """In memory index of a drive tree built from one recursive 'rclone lsjson -R --hash' listing.
+
+    Entries are the lsjson dictionaries (Path, Name, Size, ModTime, IsDir, Hashes) with Path relative to
+    the snapshot root.  Directories that we change during the run (uploads) are marked stale and are no
+    longer answered from the snapshot."""
+
+    def __init__(self, root, entries):
+        self.root = self.normalize(root)
+        self.entries = dict()  # full drive path -> entry
+        self.children = {self.root: []}  # full drive path of a directory -> full paths of its children
+        self.stale = set()
+        self.lock = threading.Lock()
+        for entry in entries:
+            path = self.root + '/' + entry['Path'].strip('/')
+            self.entries[path] = entry
+            if entry['IsDir']:
+                self.children.setdefault(path, [])
+        for path in self.entries:
+            parent = path.rsplit('/', 1)[0]
+            if parent in self.children:
+                self.children[parent].append(path)
+
+    @staticmethod
+    def normalize(path):
+        return str(path).strip('/')
+
+    def covers(self, directory):
+        """True if the listing of directory can be answered from the snapshot."""
+        key = self.normalize(directory)
+        if key not in self.children:
+            return False
+        with self.lock:
+            for stale in self.stale:
+                if key == stale or key.startswith(stale + '/'):
+                    return False
+        return True
+
+    def list_entries(self, directory):
+        key = self.normalize(directory)
+        return [self.entries[path] for path in self.children[key]]
+
+    def get_entry(self, path):
+        return self.entries.get(self.normalize(path))
+
+    def walk(self, directory, max_depth=None):
+        """Generate (path relative to directory, entry) for everything below directory to max_depth levels."""
+        key = self.normalize(directory)
+        pending = [(key, 1)]
+        while pending:
+            folder, depth = pending.pop()
+            for path in self.children.get(folder, []):
+                entry = self.entries[path]
+                yield path[len(key) + 1:], entry
+                if entry['IsDir'] and (max_depth is None or depth < max_depth):
+                    pending.append((path, depth + 1))
+
+    def invalidate(self, directory):
+        with self.lock:
+            self.stale.add(self.normalize(directory))
@@ -7,4 +7,13 @@ class SstCommandDefinitionException(Exception):
 
     # __str__ is to print() the value
     def __str__(self):
-        return (repr(self.value))
\ No newline at end of file
+        return (repr(self.value))
+
+class RcloneRemoteControlException(Exception):
+    """Exception returned by a call to the rclone remote control (rcd) API"""
+    def __init__(self, value):
+        self.value = value
+
+    # __str__ is to print() the value
+    def __str__(self):
+        return (repr(self.value))
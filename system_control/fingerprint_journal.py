@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from system_control.download_manifest import DownloadManifest
+
+
+def file_fingerprint(paths):
+    """Hash the content of a list of local files (templates, processor source code)."""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(path.encode('utf-8'))
+        with open(path, 'rb') as fd:
+            digest.update(fd.read())
+    return digest.hexdigest()
+
+
+def story_fingerprint(entries, *other_fingerprints):
+    """Combine drive entries (path, lsjson entry) of a story folder with other fingerprints (templates, code)."""
+    digest = hashlib.sha256()
+    for path, entry in sorted(entries, key=lambda x: x[0]):
+        if entry['IsDir']:
+            continue
+        file_hash = DownloadManifest.entry_hash(entry) or f"{entry.get('Size')}:{entry.get('ModTime')}"
+        digest.update(f"{path}\0{file_hash}\n".encode('utf-8'))
+    for other in other_fingerprints:
+        digest.update(other.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FingerprintJournal(object):
+    """Fingerprint of the inputs of each story folder at its last successful processing.
+
+    A folder whose fingerprint is unchanged and whose outputs are all still in place does not
+    need to be processed again."""
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, fingerprint TEXT, "
+                                "outputs TEXT, completed REAL)")
+        self.connection.commit()
+
+    def is_unchanged(self, folder, fingerprint):
+        with self.lock:
+            row = self.connection.execute("SELECT fingerprint, outputs FROM folders WHERE folder = ?",
+                                          (folder.strip('/'),)).fetchone()
+        if not row or row[0] != fingerprint:
+            return False
+        outputs = json.loads(row[1])
+        if not outputs:
+            return False
+        return all(os.path.exists(output) for output in outputs)
+
+    def record(self, folder, fingerprint, outputs):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)",
+                                    (folder.strip('/'), fingerprint, json.dumps(sorted(set(outputs))), time.time()))
+            self.connection.commit()
+
+    def forget(self, folder):
+        with self.lock:
+            self.connection.execute("DELETE FROM folders WHERE folder = ?", (folder.strip('/'),))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
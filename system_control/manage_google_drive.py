@@ -1,5 +1,17 @@
 #!/usr/bin/env python3
-from utilities.run_log_command import run_shell_command
+from utilities.run_log_command import run_command
+from utilities.tracing import traced, add_to_span
+from utilities import metrics
+from system_control import rclone_rc
+from system_control import transfer_scheduler
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+from system_control.drive_cache import DriveListingCache
+from system_control.drive_snapshot import DriveSnapshot
+from system_control.download_manifest import DownloadManifest
+from system_control.blob_store import BlobStore
+import fnmatch
+import io
+import json
 import shutil
 import os
 import pandas as pd
@@ -7,14 +19,142 @@ import tempfile as tf
 
 # RClone config file in /home/don/.config/rclone/rclone.conf
 
+# Command used to run rclone and the number of files it transfers in parallel when a set of
+# files is fetched together (download_files)
+_rclone_command = 'rclone'
+_transfers = 4
+
+
+def configure_rclone(rclone_command='rclone', transfers=4):
+    global _rclone_command, _transfers
+    _rclone_command = rclone_command
+    _transfers = transfers
+
+
+# Directory listings shared by all ManageGoogleDrive instances for the run (None = no caching)
+_listing_cache = None
+
+
+def configure_listing_cache(ttl=900, max_entries=5000, cache_file=None):
+    """Enable the run wide listing cache, reloading listings saved by an earlier run if cache_file is given."""
+    global _listing_cache
+    _listing_cache = DriveListingCache(ttl=ttl, max_entries=max_entries, cache_file=cache_file)
+    _listing_cache.load()
+    return _listing_cache
+
+
+def save_listing_cache():
+    if _listing_cache:
+        _listing_cache.save()
+
+
+# Whole tree snapshot taken at the start of the run (None = list each folder as it is needed)
+_snapshot = None
+
+
+def get_snapshot():
+    return _snapshot
+
+
+def set_snapshot(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+# Manifest of local copies of drive files (None = always download everything requested)
+_manifest = None
+
+
+def configure_manifest(manifest_file, mirror_dir):
+    """Make downloads incremental: only files new or changed since they were last fetched come from drive."""
+    global _manifest
+    _manifest = DownloadManifest(manifest_file, mirror_dir)
+    return _manifest
+
+
+# Content addressed store of downloaded files (None = keep local copies in the manifest's mirror)
+_blob_store = None
+
+
+def configure_blob_store(root, max_bytes):
+    """Keep the local copies recorded in the manifest in a content addressed store, linked into working directories.
+
+    Only used for downloads made through the manifest (see configure_manifest)."""
+    global _blob_store
+    _blob_store = BlobStore(root, max_bytes)
+    return _blob_store
+
+
+def evict_blob_store(logger):
+    if _blob_store:
+        removed = _blob_store.evict()
+        if removed:
+            logger.make_info_entry(f"Removed {removed} bytes of least recently used files from {_blob_store.root}")
+
+
+# Small files that control processing - fetched for the whole tree at once (async_google_drive.prepare_run)
+CONTROL_FILE_PATTERNS = ['*commands.txt', 'meta.txt', 'metadata.yml', 'config_users.yaml']
+
+# Local mirror of the control files below a drive folder (None = fetch each one as it is needed)
+_control_root = None
+_control_mirror = None
+
+
+def control_file_paths(root):
+    """Paths (relative to root) of the control files below root if the snapshot has them, else None."""
+    if not _snapshot or not _snapshot.covers(root):
+        return None
+    return [path for path, entry in _snapshot.walk(root)
+            if not entry['IsDir'] and any(fnmatch.fnmatch(entry['Name'], x) for x in CONTROL_FILE_PATTERNS)]
+
+
+def set_control_mirror(root, mirror):
+    """Use mirror (a TemporaryDirectory holding the control files below root) for the rest of the run."""
+    global _control_root, _control_mirror
+    _control_root = root.strip('/')
+    _control_mirror = mirror
+
+
+def control_file(directory, filename):
+    """Local copy of a control file in drive directory, None if it was not prefetched."""
+    if not _control_mirror:
+        return None
+    directory = str(directory).strip('/')
+    if directory != _control_root and not directory.startswith(_control_root + '/'):
+        return None
+    local_path = os.path.join(_control_mirror.name, directory[len(_control_root) + 1:], filename)
+    return local_path if os.path.exists(local_path) else None
+
+
+def control_files():
+    """Generate (drive directory, file name, local path) for each prefetched control file."""
+    if not _control_mirror:
+        return
+    for root, dirs, files in os.walk(_control_mirror.name):
+        dirs.sort()
+        relative = os.path.relpath(root, _control_mirror.name)
+        directory = _control_root if relative == '.' else _control_root + '/' + relative
+        for file in sorted(files):
+            yield directory, file, os.path.join(root, file)
+
 
 class ManageGoogleDrive(object):
     def __init__(self):
-        self.cmd_list_files = "rclone ls --max-depth 1 'sst_store:{}'"
-        self.cmd_list_directories = "rclone lsd --max-depth 1 'sst_store:{}'"
-        self.cmd_download_csv_file = "rclone -v --drive-formats csv copy 'sst_store:/'{} {}"
-        self.cmd_download_file_or_directory = "rclone --max-depth {} -v copy  'sst_store:/{}' {}"
-        self.cmd_upload_file_or_directory = "rclone -v copy '{}' 'sst_store:/'{}"
+        rclone = _rclone_command
+        self.cmd_list_entries = rclone + " lsjson --max-depth 1 --hash 'sst_store:{}'"
+        self.cmd_list_tree = rclone + " lsjson -R --max-depth {} --hash 'sst_store:{}'"
+        self.cmd_download_csv_file = rclone + " -v --drive-formats csv copy 'sst_store:/'{} {}"
+        self.cmd_download_file_or_directory = rclone + " --max-depth {} -v copy  'sst_store:/{}' {}"
+        self.cmd_upload_file_or_directory = rclone + " -v copy '{}' 'sst_store:/'{}"
+        self.cmd_download_files = rclone + " -v --transfers {} --files-from-raw '{}' copy 'sst_store:/{}' '{}'"
+        self.cmd_download_matching = rclone + " -v --transfers {} {} copy 'sst_store:/{}' '{}'"
+        self.cmd_cat = rclone + " cat 'sst_store:/{}'"
+        self.cmd_cat_export = rclone + " --drive-export-formats {} cat 'sst_store:/{}'"
+        self.remote = 'sst_store:'
+        # Shared 'rclone rcd' daemon if one was started for this run, else None (one subprocess per call)
+        self.remote_control = rclone_rc.get_remote_control()
+        # Paces, limits and retries drive operations to stay within Google's quotas
+        self.scheduler = transfer_scheduler.get_scheduler()
 
     @staticmethod
     def add_slash(folder):
@@ -25,40 +165,156 @@ class ManageGoogleDrive(object):
         else:
             return folder + '/'
 
+    def _rc_call(self, logger, method, params):
+        """Make a call on the rclone daemon.  Returns None if the call failed so caller can use a subprocess."""
+        try:
+            return self.scheduler.run(logger, f"rclone rc {method}", lambda: self.remote_control.call(method, params))
+        except (RcEx, OSError) as e:
+            logger.make_error_entry(f"rclone rc {method} failed, retrying with rclone subprocess: {e}")
+            return None
+
+    def _run_rclone(self, command_line, logger, result_as_string=False):
+        """Run an rclone command line under the transfer scheduler - it is repeated if drive throttles it.
+
+        Returns the standard output if result_as_string is set (None if rclone failed), else True if rclone
+        succeeded."""
+        result = self.scheduler.run(logger, command_line,
+                                    lambda: run_command(command_line, logger, capture_stdout=result_as_string),
+                                    check=lambda x: x.output_text)
+        if result_as_string:
+            return result.stdout if result.ok else None
+        return result.ok
+
+    def _perform(self, logger, request, listing=False):
+        """Carry out a request on the rclone daemon if there is one, else with an rclone subprocess.
+
+        Returns the lsjson entries for a listing, else the rc reply or True if the subprocess succeeded."""
+        method, params, command_line = request
+        if self.remote_control:
+            res = self._rc_call(logger, method, params)
+            if res is not None:
+                return res['list'] if listing else res
+        res = self._run_rclone(command_line, logger, result_as_string=listing)
+        return self._decode_listing(request, res) if listing else res
+
     @staticmethod
-    def split_directory_listing(result_string):
-        items = result_string.split('\n')
-        res = []
-        for item in items:
-            res.append(item.split(' ')[-1])
-        return res
+    def _decode_listing(request, output):
+        """The entries of the lsjson output of a listing request - OSError naming the folder if rclone failed."""
+        method, params, command_line = request
+        folder = params['remote'] or '/'
+        if not output:
+            raise OSError(f"Listing of drive folder {folder} failed: {command_line}")
+        try:
+            return json.loads(output.decode('utf-8'))
+        except ValueError as e:
+            raise OSError(f"Listing of drive folder {folder} is not valid lsjson output ({e}): {command_line}")
 
-    def directory_list_files(self, logger, directory):
+    # Each operation is built once as (rc method, rc parameters, equivalent rclone command line) so that
+    # ManageGoogleDrive and AsyncManageGoogleDrive (async_google_drive) make exactly the same calls.
+
+    def _list_request(self, directory, recurse=False, max_depth=1):
+        params = {'fs': self.remote, 'remote': directory.strip('/'), 'opt': {'showHash': True}}
+        if not recurse:
+            return 'operations/list', params, self.cmd_list_entries.format(directory)
+        params['opt']['recurse'] = True
+        params['_config'] = {'MaxDepth': max_depth}
+        return 'operations/list', params, self.cmd_list_tree.format(max_depth, directory)
+
+    def _download_directory_request(self, dir_to_download, target_dir, max_depth):
+        params = {'srcFs': self.remote + '/' + dir_to_download, 'dstFs': str(target_dir),
+                  '_config': {'MaxDepth': max_depth}, '_filter': {'ExcludeRule': ['/ignore/**']}}
+        command_line = self.cmd_download_file_or_directory.format(max_depth, dir_to_download, target_dir)
+        return 'sync/copy', params, command_line + " --exclude=/ignore/**"
+
+    def _download_file_request(self, source_dir, file_to_download, target_dir):
+        params = {'srcFs': self.remote, 'srcRemote': self.add_slash(source_dir).lstrip('/') + file_to_download,
+                  'dstFs': str(target_dir), 'dstRemote': file_to_download}
+        # Note:  this used to have outfile=file_to_download specified which was dumping a file
+        #  in the cwd or throwing an error if not possible.  Was there a real, intended use for that??
+        command_line = self.cmd_download_file_or_directory.format(1, self.add_slash(source_dir) + file_to_download,
+                                                                  target_dir)
+        return 'operations/copyfile', params, command_line
+
+    @staticmethod
+    def _write_files_from(paths):
+        """Write the list of paths for --files-from-raw to a temporary file and return its name."""
+        with tf.NamedTemporaryFile('w', prefix='files_from', suffix='.txt', delete=False) as files_from:
+            files_from.write('\n'.join(path.strip('/') for path in paths) + '\n')
+        return files_from.name
+
+    def _download_files_request(self, files_from, target_dir, source_dir):
+        params = {'srcFs': self.remote + source_dir, 'dstFs': str(target_dir),
+                  '_config': {'Transfers': _transfers}, '_filter': {'FilesFromRaw': [files_from]}}
+        return 'sync/copy', params, self.cmd_download_files.format(_transfers, files_from, source_dir, target_dir)
+
+    def _control_files_request(self, root, target_dir):
+        params = {'srcFs': self.remote + root, 'dstFs': str(target_dir),
+                  '_config': {'Transfers': _transfers}, '_filter': {'IncludeRule': CONTROL_FILE_PATTERNS}}
+        includes = ' '.join(f"--include '{x}'" for x in CONTROL_FILE_PATTERNS)
+        return 'sync/copy', params, self.cmd_download_matching.format(_transfers, includes, root.strip('/'), target_dir)
+
+    def _upload_file_request(self, target_dir, file_to_upload, source_dir):
+        params = {'srcFs': str(source_dir), 'srcRemote': file_to_upload,
+                  'dstFs': self.remote, 'dstRemote': self.add_slash(target_dir).lstrip('/') + file_to_upload}
+        command_line = self.cmd_upload_file_or_directory.format(self.add_slash(source_dir) + file_to_upload, target_dir)
+        return 'operations/copyfile', params, command_line
+
+    @staticmethod
+    def _invalidate_listing(directory):
+        if _listing_cache:
+            _listing_cache.invalidate(directory)
+        if _snapshot:
+            _snapshot.invalidate(directory)
+
+    @traced(category='drive')
+    def list_tree(self, logger, root, max_depth=-1):
+        """Return a DriveSnapshot of everything below root (to max_depth, -1 = all) from a single recursive listing."""
+        entries = self._perform(logger, self._list_request(root, recurse=True, max_depth=max_depth), listing=True)
+        return DriveSnapshot(root, entries)
+
+    def tree_entries(self, logger, directory, max_depth=1):
+        """Return (path relative to directory, entry) for everything below directory to max_depth levels."""
+        if _snapshot and _snapshot.covers(directory):
+            return list(_snapshot.walk(directory, max_depth))
+        return list(self.list_tree(logger, directory, max_depth=max_depth).walk(directory))
+
+    @staticmethod
+    def _known_entries(directory):
+        """Entries of directory if they can be had without going to drive, else None."""
+        if _snapshot and _snapshot.covers(directory):
+            return _snapshot.list_entries(directory)
+        if _listing_cache:
+            return _listing_cache.get(directory)
+        return None
+
+    @traced(category='drive')
+    def list_entries(self, logger, directory):
+        """Return the 'rclone lsjson' entries (Name, Size, ModTime, IsDir, Hashes) of a drive directory.
+
+        Listings are served from the run's listing cache when possible.  Files and directories come
+        from a single listing so a folder costs one drive round trip however it is asked about."""
+        if _snapshot and _snapshot.covers(directory):
+            return _snapshot.list_entries(directory)
+        if _listing_cache:
+            entries = _listing_cache.get(directory)
+            if entries is not None:
+                return entries
         try:
-            ls_cmd = self.cmd_list_files.format(directory)
-            res = run_shell_command(ls_cmd, logger, result_as_string=True)
-            tmp = res.decode('utf-8')
-            res = self.split_directory_listing(tmp)
-            if res[-1] == '':
-                res.pop()
-            return res
+            entries = self._perform(logger, self._list_request(directory), listing=True)
         except Exception as e:
             logger.make_error_entry(f'Error listing files in directory: {directory}')
             raise e
+        if _listing_cache:
+            _listing_cache.put(directory, entries)
+        return entries
+
+    def directory_list_files(self, logger, directory):
+        return [entry['Name'] for entry in self.list_entries(logger, directory) if not entry['IsDir']]
 
     def directory_list_directories(self, logger, directory):
-        try:
-            ls_cmd = self.cmd_list_directories.format(directory)
-            res = run_shell_command(ls_cmd, logger, result_as_string=True)
-            res = res.decode('utf-8')
-            res = self.split_directory_listing(res)
-            if res[-1] == '':
-                res.pop()
-            return res
-        except Exception as e:
-            logger.make_error_entry(f'Error listing files in directory: {directory}')
-            raise e
+        return [entry['Name'] for entry in self.list_entries(logger, directory) if entry['IsDir']]
 
+    @traced(category='drive')
     def download_csv_file(self, logger, file, download_dir, dummy_source=None):
         '''Download Google Spreadsheet as csv file.'''
         try:
@@ -66,42 +322,175 @@ class ManageGoogleDrive(object):
                 shutil.copy(dummy_source, download_dir)
             else:
                 download_files_cmd = self.cmd_download_csv_file.format(file, download_dir)
-                run_shell_command(download_files_cmd, logger)
+                self._run_rclone(download_files_cmd, logger)
         except Exception as e:
             logger.make_error_entry('Error downloading spreadsheet {}'.format(file))
             raise e
 
+    @traced(category='drive')
+    def open_remote(self, logger, remote_path, text=False, export_format=None):
+        """Return a readable stream (binary, or text if text is set) of a small drive file.
+
+        The file is read into memory (rclone cat, or a GET on the daemon) rather than written to disk.
+        Google documents are exported in flight as export_format (e.g. 'csv' for a Sheet).
+        Raises FileNotFoundError if the file cannot be read."""
+        remote_path = remote_path.strip('/')
+        data = None
+        if self.remote_control and not export_format:
+            try:
+                data = self.scheduler.run(logger, f"rclone rc serve {remote_path}",
+                                          lambda: self.remote_control.get(self.remote, remote_path))
+            except (RcEx, OSError) as e:
+                logger.make_error_entry(f"rclone rc serve of {remote_path} failed, retrying with rclone subprocess: {e}")
+        if data is None:
+            if export_format:
+                cat_cmd = self.cmd_cat_export.format(export_format, remote_path)
+            else:
+                cat_cmd = self.cmd_cat.format(remote_path)
+            result = self.scheduler.run(logger, cat_cmd, lambda: run_command(cat_cmd, logger, capture_stdout=True),
+                                        check=lambda x: x.output_text)
+            if not result.ok:
+                logger.make_error_entry(f'Error reading file {remote_path}')
+                raise FileNotFoundError(f"Unable to read {remote_path} from drive")
+            data = result.stdout
+        _transferred('download', 1, len(data))
+        stream = io.BytesIO(data)
+        return io.TextIOWrapper(stream, encoding='utf-8') if text else stream
+
+    @traced(category='drive')
     def download_directory(self, logger, dir_to_download, target_dir, max_depth=1):
         """Download contents of specified directory to local directory.
         """
+        if _manifest:
+            try:
+                self._download_directory_incremental(logger, dir_to_download, target_dir, max_depth)
+                return
+            except Exception as e:
+                logger.make_error_entry(f"Incremental download of {dir_to_download} failed, "
+                                        f"downloading whole directory: {e}")
         try:
-            download_files_cmd = self.cmd_download_file_or_directory.format(max_depth, dir_to_download, target_dir)
-            run_shell_command(download_files_cmd, logger, ignore='/ignore/**')
+            self._perform(logger, self._download_directory_request(dir_to_download, target_dir, max_depth))
         except Exception as e:
             logger.make_error_entry('Error downloading file directory {}'.format(dir_to_download))
             raise e
 
+    def _download_directory_incremental(self, logger, dir_to_download, target_dir, max_depth):
+        """Fetch only new or changed files into the mirror then copy the directory from the mirror."""
+        source = dir_to_download.strip('/')
+        files = [(path, entry) for path, entry in self.tree_entries(logger, source, max_depth=max_depth)
+                 if not entry['IsDir'] and path.split('/')[0] != 'ignore']
+        changed = [(source + '/' + path, entry) for path, entry in files
+                   if not _manifest.is_current(source + '/' + path, entry)]
+        fetched = self._fetch_into_mirror(logger, changed)
+        for path, entry in files:
+            self._copy_from_mirror(source + '/' + path, os.path.join(str(target_dir), path))
+        logger.make_info_entry(f"Downloaded {dir_to_download}: {fetched} of {len(files)} files fetched from drive")
+
+    def _fetch_into_mirror(self, logger, items):
+        """Make local copies of a list of (remote path, entry) and record them in the manifest.
+
+        All files not already held locally are fetched in one transfer.  Returns the number fetched."""
+        to_fetch = []
+        for remote_path, entry in items:
+            if _blob_store:
+                # Same content already fetched for another path (or an earlier version of this one)
+                key = _blob_store.blob_key(entry, remote_path)
+                if _blob_store.contains(key):
+                    _manifest.record(remote_path, entry, _blob_store.blob_path(key))
+                    continue
+            to_fetch.append((remote_path, entry))
+        if not to_fetch:
+            return 0
+        self.download_files(logger, [remote_path for remote_path, entry in to_fetch], _manifest.mirror_dir)
+        for remote_path, entry in to_fetch:
+            local_path = _manifest.mirror_path(remote_path)
+            if not os.path.exists(local_path):
+                raise FileNotFoundError(f"{remote_path} was not downloaded")
+            if _blob_store:
+                local_path = _blob_store.add(_blob_store.blob_key(entry, remote_path), local_path)
+            _manifest.record(remote_path, entry, local_path)
+        return len(to_fetch)
+
+    @staticmethod
+    def _copy_from_mirror(remote_path, target_path):
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        local_path = _manifest.local_path(remote_path)
+        if not local_path or not os.path.exists(local_path):
+            # Callers fall back to downloading from drive
+            raise FileNotFoundError(f"No local copy of {remote_path}")
+        if _blob_store and local_path.startswith(_blob_store.root):
+            _blob_store.copy_to(os.path.basename(local_path), target_path)
+        else:
+            shutil.copy2(local_path, target_path)
+
+    @traced(category='drive')
     def download_file(self, logger, source_dir, file_to_download, target_dir):
+        if _manifest:
+            # Only worth it when the drive entry is already known - otherwise it costs an extra listing
+            entries = self._known_entries(source_dir) or []
+            entry = next((x for x in entries if x['Name'] == file_to_download and not x['IsDir']), None)
+            if entry:
+                remote_path = self.add_slash(source_dir).strip('/') + '/' + file_to_download
+                try:
+                    if not _manifest.is_current(remote_path, entry):
+                        self._fetch_into_mirror(logger, [(remote_path, entry)])
+                    self._copy_from_mirror(remote_path, os.path.join(str(target_dir), file_to_download))
+                    return
+                except Exception as e:
+                    logger.make_error_entry(f"Unable to use local copy of {remote_path}: {e}")
+        self._fetch_file(logger, source_dir, file_to_download, target_dir)
+
+    def _fetch_file(self, logger, source_dir, file_to_download, target_dir):
         try:
-            download_files_cmd = self.cmd_download_file_or_directory.format(1, self.add_slash(source_dir) +
-                                                                            file_to_download, target_dir)
-            # Note:  this used to have outfile=file_to_download specified which was dumping a file
-            #  in the cwd or throwing an error if not possible.  Was there a real, intended use for that??
-            run_shell_command(download_files_cmd, logger)
+            self._perform(logger, self._download_file_request(source_dir, file_to_download, target_dir))
         except Exception as e:
             logger.make_error_entry('Error downloading file  {}'.format(file_to_download))
             raise e
+        local_path = os.path.join(str(target_dir), file_to_download)
+        if os.path.exists(local_path):
+            _transferred('download', 1, os.path.getsize(local_path))
+
+    @traced(category='drive')
+    def download_files(self, logger, paths, target_dir, source_dir=''):
+        """Download a list of files (paths relative to source_dir) in a single transfer.
+
+        Each file is placed at the same relative path below target_dir.  rclone runs the
+        transfers in parallel (see configure_rclone).  Files that do not exist are skipped."""
+        if not paths:
+            return
+        source_dir = source_dir.strip('/')
+        files_from = self._write_files_from(paths)
+        try:
+            self._perform(logger, self._download_files_request(files_from, target_dir, source_dir))
+        except Exception as e:
+            logger.make_error_entry(f'Error downloading {len(paths)} files from {source_dir}')
+            raise e
+        finally:
+            os.remove(files_from)
+        local_paths = [os.path.join(str(target_dir), path.strip('/')) for path in paths]
+        local_paths = [x for x in local_paths if os.path.exists(x)]
+        _transferred('download', len(local_paths), sum(os.path.getsize(x) for x in local_paths))
 
+    @traced(category='drive')
     def upload_file(self, logger, target_dir, file_to_upload, source_dir):
         try:
-            upload_files_cmd = self.cmd_upload_file_or_directory.format(self.add_slash(source_dir) +
-                                                                        file_to_upload, target_dir)
-            run_shell_command(upload_files_cmd, logger)
+            self._perform(logger, self._upload_file_request(target_dir, file_to_upload, source_dir))
+            self._invalidate_listing(target_dir)
+            local_path = os.path.join(str(source_dir), file_to_upload)
+            if os.path.exists(local_path):
+                _transferred('upload', 1, os.path.getsize(local_path))
         except Exception as e:
             logger.make_error_entry('Error downloading file  {}'.format(file_to_upload))
             raise e
 
 
+def _transferred(direction, files, size):
+    """Account for files moved to or from the drive in the current trace span and the run metrics."""
+    add_to_span(transferred=size)
+    metrics.count('drive_files_total', files, help_text="Files transferred to or from the drive", direction=direction)
+    metrics.count('drive_bytes_total', size, help_text="Bytes transferred to or from the drive", direction=direction)
+
+
 def copytree(src, dst, symlinks=False, ignore=None):
     for item in os.listdir(src):
         s = os.path.join(src, item)
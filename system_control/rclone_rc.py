@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import atexit
+import http.client
+import json
+import shlex
+import subprocess
+import threading
+import time
+import urllib.parse
+
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+
+# RClone config file in /home/don/.config/rclone/rclone.conf
+
+
+class RcloneRemoteControl(object):
+    """Drive a single long running 'rclone rcd' over its local HTTP API.
+
+    Each rclone subprocess re-reads the config, refreshes the OAuth token and builds a new drive
+    client.  The daemon does that once and every call after that is a POST on a reused connection."""
+
+    def __init__(self, logger, rc_address='localhost:5572', rclone_command='rclone'):
+        self.logger = logger
+        self.rc_address = rc_address
+        self.rclone_command = rclone_command
+        host, port = rc_address.rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+        self.process = None
+        # http.client connections cannot be shared between threads - each thread keeps its own
+        self.local = threading.local()
+
+    def start(self, timeout=20):
+        """Start the daemon and wait for it to answer.  Return False if it cannot be started."""
+        # --rc-serve lets files be read with a plain GET (see get)
+        command = shlex.split(self.rclone_command) + ['rcd', '--rc-no-auth', '--rc-serve', f'--rc-addr={self.rc_address}']
+        self.logger.make_info_entry(f"Starting rclone remote control: {' '.join(command)}")
+        try:
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            self.logger.make_error_entry(f"Unable to start rclone rcd: {e}")
+            return False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.logger.make_error_entry(f"rclone rcd exited at startup with code {self.process.returncode}")
+                self.process = None
+                return False
+            try:
+                self.call('rc/noop')
+                return True
+            except (OSError, http.client.HTTPException, RcEx):
+                time.sleep(0.2)
+        self.logger.make_error_entry(f"rclone rcd did not answer on {self.rc_address} within {timeout} seconds")
+        self.stop()
+        return False
+
+    def _request(self, verb, path, body=None, headers=None):
+        """Send a request on this thread's connection and return (response, data)."""
+        for attempt in range(2):
+            try:
+                connection = getattr(self.local, 'connection', None)
+                if not connection:
+                    connection = http.client.HTTPConnection(self.host, self.port)
+                    self.local.connection = connection
+                connection.request(verb, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                return response, response.read()
+            except (OSError, http.client.HTTPException):
+                # The daemon closes idle keep-alive connections - reconnect once before giving up
+                self.close_connection()
+                if attempt:
+                    raise
+
+    def call(self, method, params=None):
+        """POST a call to the daemon and return the decoded JSON reply."""
+        body = json.dumps(params or {})
+        response, data = self._request('POST', '/' + method, body=body, headers={'Content-Type': 'application/json'})
+        try:
+            result = json.loads(data) if data else {}
+        except ValueError:
+            result = {'error': data[:200]}
+        if response.status != 200:
+            raise RcEx(f"rclone rc {method} failed with status {response.status}: {result.get('error')}")
+        return result
+
+    def get(self, fs, remote_path):
+        """Return the content of a file on a remote (fs, e.g. 'sst_store:')."""
+        path = '/[' + fs + ']/' + urllib.parse.quote(remote_path.strip('/'))
+        response, data = self._request('GET', path)
+        if response.status != 200:
+            raise RcEx(f"rclone rc serve of {remote_path} failed with status {response.status}")
+        return data
+
+    def close_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection:
+            connection.close()
+            self.local.connection = None
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            try:
+                self.call('core/quit')
+            except (OSError, http.client.HTTPException, RcEx):
+                pass
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.close_connection()
+        self.process = None
+
+
+# One daemon serves the whole run - ManageGoogleDrive instances are created freely and pick it up here.
+_remote_control = None
+
+
+def start_remote_control(logger, rc_address='localhost:5572', rclone_command='rclone'):
+    """Start the shared rclone daemon.  Returns None (subprocess fallback) if it cannot be started."""
+    global _remote_control
+    if _remote_control:
+        return _remote_control
+    remote_control = RcloneRemoteControl(logger, rc_address=rc_address, rclone_command=rclone_command)
+    if remote_control.start():
+        _remote_control = remote_control
+        atexit.register(stop_remote_control)
+    else:
+        logger.make_error_entry("rclone remote control unavailable - using one rclone process per drive call")
+    return _remote_control
+
+
+def get_remote_control():
+    return _remote_control
+
+
+def stop_remote_control():
+    global _remote_control
+    if _remote_control:
+        _remote_control.stop()
+        _remote_control = None
@@ -3,15 +3,19 @@ import os
 
 from system_control import command_processor as cmd_proc
 from system_control import config_control as conf
-from utilities.run_log_command import OvernightLogger
-from utilities.send_email import ManageEmail
+from system_control import manage_google_drive as mgd
+from system_control.async_google_drive import prepare_run
+from system_control.fingerprint_journal import FingerprintJournal
+from utilities.run_log_command import OvernightLogger, current_run_id, current_run_log, flush_logs, log_phase
+from utilities.run_log_store import RunLogStore, run_log_db
+from utilities.send_email import start_mail_worker
 import config_private as pvt
 
 
 class SystemManager(object):
     """Top level controller for managing content on website."""
 
-    def __init__(self):
+    def __init__(self, force_reprocess=False):
         try:
             # Use environment variable to determine user for accessing config file
             # machine dependencies.  When running in PyCharm, define in run configuration.
@@ -29,14 +33,38 @@ class SystemManager(object):
         self.logs_directory = self.config.get_configuration_parameter('logsDirectory')
         self.temp_dir = self.config.get_configuration_parameter('tempDirectory')
         self.logger = OvernightLogger('SSTcontent', self.logs_directory)
-        self.system_users = cmd_proc.SystemUser(self.temp_dir, self.logger, self.config)
+        self.system_users = None   # Loaded from the prefetched config_users.yaml (run_command_processor)
         self.smtp_server = self.config.get_configuration_parameter('smtpServer', group='email')
         self.smtp_port = self.config.get_configuration_parameter('smtpPort', group='email')
+        self.force_reprocess = force_reprocess
+        self.journal = None
+        if self.config.get_configuration_parameter('skipUnchangedStories', group='cache') == 'yes':
+            self.journal = FingerprintJournal(self.temp_dir + 'story_fingerprints.sqlite')
 
     def run_command_processor(self):
-        dirs = cmd_proc.ManageFolders(self.config, self.logger, self.system_users, self.commands_prefix)
-        dirs.process_commands_top()
-        users_wanting_logs = dirs.get_log_requests()
+        top_folder = self.config.get_configuration_parameter("driveSSTManagement", group="drive paths")
+        # One recursive listing answers every folder listing made while processing commands (driveSnapshot) and
+        # commands.txt, meta.txt, ... of the whole tree come in one transfer rather than one download per folder
+        # (prefetchControlFiles).  Both are started together.
+        snapshot = self.config.get_configuration_parameter('driveSnapshot', group='cache') == 'yes'
+        prefetch = self.config.get_configuration_parameter('prefetchControlFiles', group='cache') == 'yes'
+        max_operations = self.config.get_configuration_parameter('asyncDriveOperations', group='performance')
+        control_files = False
+        if snapshot or prefetch:
+            with log_phase(self.logger, 'prepare'):
+                control_files = prepare_run(self.logger, top_folder, self.temp_dir, snapshot=snapshot,
+                                            control_files=prefetch,
+                                            max_operations=int(max_operations) if max_operations else 4)
+        self.system_users = cmd_proc.SystemUser(self.temp_dir, self.logger, self.config)
+        dirs = cmd_proc.ManageFolders(self.config, self.logger, self.system_users, self.commands_prefix,
+                                      journal=self.journal, force_reprocess=self.force_reprocess)
+        if control_files:
+            with log_phase(self.logger, 'validate'):
+                dirs.validate_command_tree()
+        with log_phase(self.logger, 'commands'):
+            dirs.process_commands_top()
+        self._report_stories(dirs)
+        users_wanting_logs = dirs.get_log_folders()
         try:
             if pvt.email_logs:
                 if users_wanting_logs:
@@ -44,18 +72,68 @@ class SystemManager(object):
         except NameError:
             pass
 
-    def _email_logs(self, users):
-        system_users_wanting_logs = []
-        names = []
-        for user in self.system_users.user_data:
-            if self.system_users.user_data[user]['mailLogs']:
-                system_users_wanting_logs.append(user)
-                names.append(user)
-        mgr = ManageEmail(pvt.username, pvt.password, self.smtp_server, self.smtp_port)
-        for user in users:
-            if user in names:
-                mgr.add_recipient(self.system_users.user_data[user]['emailAddress'])
-        mgr.set_subject("Log result of running test")
-        mgr.add_attachment(self.logs_directory + 'SSTcontent.log')
-        mgr.set_body("THis is the body")
-        mgr.send_email()
+    def _report_stories(self, dirs):
+        self.logger.make_info_entry(f"Story folders processed: {len(dirs.processed_stories)}, "
+                                    f"skipped as unchanged: {len(dirs.skipped_stories)}")
+        for folder in sorted(dirs.processed_stories):
+            self.logger.make_info_entry(f"    processed: {folder}")
+        for folder in sorted(dirs.skipped_stories):
+            self.logger.make_info_entry(f"    skipped:   {folder}")
+
+    def _email_logs(self, requests):
+        """Queue a digest of the run for each user asking for logs.
+
+        requests maps a user to the folders their identity commands covered and whether they asked for
+        the full log (see ManageFolders.get_log_folders).  Each digest holds the errors and command timings
+        of those folders only; the full log is attached, gzipped, only when asked for or if there is no
+        run log index to take the digest from.  The mail worker sends them while the run goes on."""
+        worker = start_mail_worker(pvt.username, pvt.password, self.smtp_server, int(self.smtp_port), self.logger,
+                                   starttls=self.config.get_configuration_parameter('useStartTls', group='email') != 'no')
+        run_id = current_run_id()
+        store = None
+        if run_id:
+            flush_logs()
+            store = RunLogStore(run_log_db(self.logs_directory))
+            store.ingest(run_id, current_run_log())
+        try:
+            for user, (folders, full_log) in requests.items():
+                user_data = self.system_users.user_data.get(user)
+                if not user_data or not user_data['mailLogs']:
+                    continue
+                mail = worker.new_email()
+                mail.add_recipient(user_data['emailAddress'])
+                if store:
+                    subject, body = self._log_digest(store, run_id, folders)
+                else:
+                    subject, body = "Log result of sst_utils run", "The log of the run is attached."
+                mail.set_subject(subject)
+                mail.set_body(body)
+                if full_log or not store:
+                    mail.add_attachment(self.logs_directory + 'SSTcontent.log', compress=True)
+                worker.submit(mail)
+        finally:
+            if store:
+                store.close()
+
+    @staticmethod
+    def _log_digest(store, run_id, folders, max_errors=50, max_timings=10):
+        """Subject and body of a digest of the errors and timings of folders in a run."""
+        lines = []
+        error_count = 0
+        for folder in folders:
+            errors = store.run_folder_records(run_id, folder, level='ERROR')
+            timings = store.run_folder_timings(run_id, folder)
+            error_count += len(errors)
+            lines.append(f"{folder}: {len(errors)} errors, {len(timings)} commands "
+                         f"taking {sum(x[2] for x in timings):.1f}s")
+            for ts, level, error_folder, command, message in errors[:max_errors]:
+                lines.append(f"    {error_folder} {command or '-'}: {message}")
+            if len(errors) > max_errors:
+                lines.append(f"    ... {len(errors) - max_errors} more errors")
+            if timings:
+                lines.append("  Slowest commands:")
+                for timed_folder, command, duration in timings[:max_timings]:
+                    lines.append(f"    {duration:8.1f}s  {command}  {timed_folder}")
+            lines.append('')
+        subject = f"sst_utils run {run_id}: {error_count} errors in your folders"
+        return subject, '\n'.join(lines)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import asyncio
+import random
+import re
+import threading
+import time
+
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+
+# Google Drive reports exceeding a quota as 403 rateLimitExceeded/userRateLimitExceeded (sometimes 429)
+THROTTLE_PATTERN = re.compile(r'rateLimitExceeded|userRateLimitExceeded|quotaExceeded|Rate Limit Exceeded|'
+                              r'Error 429|status 429|Too Many Requests', re.IGNORECASE)
+# Failures that usually succeed when repeated a little later
+TRANSIENT_PATTERN = re.compile(r'backendError|internalError|Error 50[0234]|status 50[0234]|'
+                               r'connection reset|TLS handshake timeout|i/o timeout', re.IGNORECASE)
+# Only error lines are checked - listings include file names that could match the patterns
+ERROR_LINE = re.compile(r'ERROR|NOTICE|googleapi|failed', re.IGNORECASE)
+
+
+class TransferScheduler(object):
+    """Pace and limit the drive operations of the whole run.
+
+    Concurrency adapts AIMD style: each success raises the limit by about one per window of calls,
+    a rate limit reply halves it.  A token bucket caps the rate at which operations are started.
+    Operations that are throttled or fail transiently are retried after a jittered exponential backoff."""
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, rate=10.0, burst=10, max_retries=6,
+                 base_delay=1.0, max_delay=64.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.active = 0
+        self.condition = threading.Condition()
+        self.last_decrease = 0
+        # Statistics for the end of run report
+        self.started = time.monotonic()
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttle_events = 0
+        self.transient_events = 0
+        self.busy_time = 0.0
+        self.lowest_limit = self.limit
+
+    @staticmethod
+    def classify(output):
+        """'throttled', 'transient' or None for the output (or error message) of an operation."""
+        if not output:
+            return None
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', errors='replace')
+        output = '\n'.join(line for line in str(output).splitlines() if ERROR_LINE.search(line))
+        if THROTTLE_PATTERN.search(output):
+            return 'throttled'
+        if TRANSIENT_PATTERN.search(output):
+            return 'transient'
+        return None
+
+    def _take_token(self):
+        """Wait for a token - called with the condition held."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            self.condition.wait((1 - self.tokens) / self.rate)
+
+    def _acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self._take_token()
+            self.active += 1
+            self.calls += 1
+
+    def _release(self, outcome, elapsed):
+        with self.condition:
+            self.active -= 1
+            self.busy_time += elapsed
+            if outcome == 'throttled':
+                self.throttle_events += 1
+                # Several calls in flight see the same limit - only back off once per interval
+                now = time.monotonic()
+                if now - self.last_decrease > self.base_delay:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.lowest_limit = min(self.lowest_limit, self.limit)
+                    self.last_decrease = now
+            elif outcome == 'transient':
+                self.transient_events += 1
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def backoff(self, attempt):
+        """Full jitter: a random wait up to an exponentially growing ceiling."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, logger, description, operation, check=None):
+        """Run operation (a callable) under the scheduler and return its result.
+
+        The result (or the text check returns for it), or the message of an rclone remote control error,
+        is checked for rate limit and transient failures and the operation repeated.  When retries are
+        exhausted the last result is returned (or the error raised) for the caller to handle as before."""
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.monotonic()
+            result = error = None
+            try:
+                result = operation()
+                outcome = self.classify(check(result) if check else result)
+            except RcEx as e:
+                error = e
+                outcome = self.classify(str(e))
+            except Exception:
+                self._fail(time.monotonic() - start)
+                raise
+            self._release(outcome, time.monotonic() - start)
+            delay = self._retry_delay(logger, description, attempt, outcome, error)
+            if delay is None:
+                return result
+            attempt += 1
+            time.sleep(delay)
+
+    async def run_async(self, logger, description, operation, check=None):
+        """Coroutine version of run - operation is a coroutine function.
+
+        Waiting for a slot happens on an executor thread so the same limits apply to threads and
+        coroutines.  If the coroutine is cancelled the slot is given back - once the executor thread
+        has taken it when the coroutine was still waiting."""
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while True:
+            acquired = loop.run_in_executor(None, self._acquire)
+            try:
+                # Shielded - the thread cannot be stopped, so the slot it takes must be given back
+                await asyncio.shield(acquired)
+            except asyncio.CancelledError:
+                acquired.add_done_callback(self._give_back_slot)
+                raise
+            start = time.monotonic()
+            result = error = None
+            try:
+                result = await operation()
+                outcome = self.classify(check(result) if check else result)
+            except asyncio.CancelledError:
+                self._cancelled(time.monotonic() - start)
+                raise
+            except RcEx as e:
+                error = e
+                outcome = self.classify(str(e))
+            except Exception:
+                self._fail(time.monotonic() - start)
+                raise
+            self._release(outcome, time.monotonic() - start)
+            delay = self._retry_delay(logger, description, attempt, outcome, error)
+            if delay is None:
+                return result
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _give_back_slot(self, acquired):
+        """Done callback of the slot taken for a coroutine that was cancelled while waiting for it."""
+        if not acquired.cancelled() and acquired.exception() is None:
+            self._cancelled(0.0)
+
+    def _cancelled(self, elapsed):
+        """Give back the slot of an operation that was cancelled - the concurrency limit is not changed."""
+        with self.condition:
+            self.active -= 1
+            self.busy_time += elapsed
+            self.condition.notify_all()
+
+    def _fail(self, elapsed):
+        self._release(None, elapsed)
+        with self.condition:
+            self.failed += 1
+
+    def _retry_delay(self, logger, description, attempt, outcome, error):
+        """Seconds to wait before repeating an attempt, None if it is not to be repeated.
+
+        Raises error if the attempt failed with an rclone remote control error that is not retried."""
+        if outcome is None and error is None:
+            with self.condition:
+                self.succeeded += 1
+            return None
+        if outcome is None or attempt >= self.max_retries:
+            with self.condition:
+                self.failed += 1
+            if outcome:
+                logger.make_error_entry(f"{description}: still {outcome} after {attempt} retries - giving up")
+            if error:
+                raise error
+            return None
+        delay = self.backoff(attempt)
+        with self.condition:
+            self.retries += 1
+        logger.make_info_entry(f"{description}: {outcome}, retry {attempt + 1} in {delay:.1f}s "
+                               f"(concurrency limit {int(self.limit)})")
+        return delay
+
+    def report(self, logger):
+        elapsed = time.monotonic() - self.started
+        logger.make_info_entry(f"Drive operations: {self.calls} calls ({self.succeeded} succeeded, {self.failed} failed, "
+                               f"{self.retries} retries) in {elapsed:.1f}s - {self.calls / max(elapsed, 0.001):.2f} calls/s, "
+                               f"{self.busy_time:.1f}s busy")
+        logger.make_info_entry(f"Drive throttling: {self.throttle_events} rate limit and {self.transient_events} "
+                               f"transient errors, concurrency limit {int(self.limit)} (lowest {int(self.lowest_limit)}, "
+                               f"max {self.max_concurrency})")
+
+
+# All drive operations of the run share one scheduler - ManageGoogleDrive instances pick it up here.
+_scheduler = TransferScheduler()
+
+
+def configure_scheduler(**kwargs):
+    global _scheduler
+    _scheduler = TransferScheduler(**kwargs)
+    return _scheduler
+
+
+def get_scheduler():
+    return _scheduler
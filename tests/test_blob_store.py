@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+from system_control.blob_store import BlobStore
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BlobStore(os.path.join(self.directory.name, 'blobs'), max_bytes=250)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _download(self, name, size=100):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as fd:
+            fd.write(b'x' * size)
+        return path
+
+    def test_blob_key(self):
+        self.assertEqual(BlobStore.blob_key({'Hashes': {'md5': 'abc'}}, 'a.docx'), 'md5-abc')
+        unhashed = BlobStore.blob_key({'Size': 1, 'ModTime': 't'}, 'a.docx')
+        self.assertTrue(unhashed.startswith('path-'))
+        self.assertNotEqual(unhashed, BlobStore.blob_key({'Size': 1, 'ModTime': 't'}, 'b.docx'))
+
+    def test_add_stores_content_once(self):
+        first = self.store.add('md5-abc', self._download('one'))
+        second = self.store.add('md5-abc', self._download('two'))
+        self.assertEqual(first, second)
+        self.assertTrue(self.store.contains('md5-abc'))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, 'two')))
+
+    def test_copy_to_is_not_linked_to_the_blob(self):
+        blob = self.store.add('md5-abc', self._download('one'))
+        target = os.path.join(self.directory.name, 'work.docx')
+        self.store.copy_to('md5-abc', target)
+        self.assertEqual(os.stat(blob).st_nlink, 1)
+        # Writing over the working copy in place leaves the blob as it was
+        with open(target, 'w') as fd:
+            fd.write('changed')
+        with open(blob, 'rb') as fd:
+            self.assertEqual(fd.read(), b'x' * 100)
+
+    def test_copy_to_replaces_existing_target(self):
+        self.store.add('md5-abc', self._download('one'))
+        target = self._download('work.docx', size=3)
+        self.store.copy_to('md5-abc', target)
+        self.assertEqual(os.path.getsize(target), 100)
+
+    def test_evict_removes_least_recently_used(self):
+        for number, key in enumerate(('md5-aa', 'md5-bb', 'md5-cc')):
+            blob = self.store.add(key, self._download(key))
+            os.utime(blob, (1000 + number, 1000 + number))
+        self.store.copy_to('md5-aa', os.path.join(self.directory.name, 'used'))    # aa is now the newest
+        self.assertEqual(self.store.evict(), 100)
+        self.assertEqual([self.store.contains(key) for key in ('md5-aa', 'md5-bb', 'md5-cc')], [True, False, True])
+        self.assertEqual(self.store.evict(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from new_content import conversion_cache
+from new_content.conversion_cache import ConversionCache
+from new_content.validate_shortcodes import PANDOC_FORMAT, ValidateShortcodes
+from utilities.run_log_command import BufferedLogger
+
+
+def fake_pandoc(directory, version='pandoc 3.1.0'):
+    """A pandoc that reports version and converts by writing a line of markdown - each conversion is logged."""
+    path = os.path.join(directory, 'pandoc')
+    with open(path, 'w') as fd:
+        fd.write(f'#!/bin/sh\n'
+                 f'if [ "$1" = "--version" ]; then echo "{version}"; exit 0; fi\n'
+                 f'echo "$1" >> "{directory}/conversions.log"\n'
+                 f'printf "Converted \\342\\200\\234%s\\342\\200\\235\\n" "$(basename "$1")" > "$3"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class TestConversionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logger = BufferedLogger()
+        self.pandoc = fake_pandoc(self.directory.name)
+        self.cache = ConversionCache(os.path.join(self.directory.name, 'cache'), 1000, pandoc_command=self.pandoc)
+        self.docx = self.write('story.docx', b'docx content')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as fd:
+            fd.write(content)
+        return path
+
+    def write_dir(self, name):
+        path = os.path.join(self.directory.name, name)
+        os.makedirs(path)
+        return path
+
+    def test_key_follows_content_options_and_pandoc_version(self):
+        key = self.cache.key(self.logger, self.docx, PANDOC_FORMAT)
+        self.assertEqual(key, self.cache.key(self.logger, self.write('copy.docx', b'docx content'), PANDOC_FORMAT))
+        self.assertNotEqual(key, self.cache.key(self.logger, self.write('other.docx', b'changed'), PANDOC_FORMAT))
+        self.assertNotEqual(key, self.cache.key(self.logger, self.docx, '-t gfm'))
+        newer = ConversionCache(self.cache.root, 1000,
+                                pandoc_command=fake_pandoc(self.write_dir('newer'), version='pandoc 3.2'))
+        self.assertNotEqual(key, newer.key(self.logger, self.docx, PANDOC_FORMAT))
+
+    def test_no_key_without_pandoc(self):
+        cache = ConversionCache(self.cache.root, 1000, pandoc_command='/nonexistent/pandoc')
+        self.assertIsNone(cache.key(self.logger, self.docx, PANDOC_FORMAT))
+
+    def test_miss_then_hit(self):
+        key = self.cache.key(self.logger, self.docx, PANDOC_FORMAT)
+        target = os.path.join(self.directory.name, 'story.md')
+        self.assertFalse(self.cache.fetch(key, target))
+        self.cache.store(key, self.write('converted.md', b'# Story\n'))
+        self.assertTrue(self.cache.fetch(key, target))
+        with open(target, 'rb') as fd:
+            self.assertEqual(fd.read(), b'# Story\n')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_evict_least_recently_used(self):
+        for number, key in enumerate(('aa1', 'bb2', 'cc3')):
+            self.cache.store(key, self.write(key, b'x' * 400))
+            os.utime(self.cache.entry_path(key), (1000 + number, 1000 + number))
+        self.cache.fetch('aa1', os.path.join(self.directory.name, 'used.md'))
+        self.assertEqual(self.cache.evict(), 400)
+        self.assertEqual([os.path.exists(self.cache.entry_path(key)) for key in ('aa1', 'bb2', 'cc3')],
+                         [True, False, True])
+
+
+class TestCleanDocxCache(unittest.TestCase):
+    """clean_docx runs pandoc only for documents whose content it has not converted before."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        fake_pandoc(self.directory.name)
+        patcher = mock.patch.dict(os.environ, PATH=self.directory.name + os.pathsep + os.environ['PATH'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        conversion_cache.configure_conversion_cache(os.path.join(self.directory.name, 'cache'), 10 ** 6)
+
+    def tearDown(self):
+        conversion_cache._conversion_cache = None
+        self.directory.cleanup()
+
+    def convert(self, folder, content=b'docx content'):
+        os.makedirs(os.path.join(self.directory.name, folder))
+        docx = os.path.join(self.directory.name, folder, 'story.docx')
+        with open(docx, 'wb') as fd:
+            fd.write(content)
+        logger = BufferedLogger()
+        validator = ValidateShortcodes(docx, 'docx', logger)
+        validator.clean_docx()
+        self.assertEqual([entry for level, entry, fields in logger.entries if level >= 40], [])
+        with open(validator.filepath) as fd:
+            return validator.filepath, fd.read()
+
+    def conversions(self):
+        with open(os.path.join(self.directory.name, 'conversions.log')) as fd:
+            return len(fd.readlines())
+
+    def test_unchanged_document_is_not_converted_again(self):
+        first_path, first = self.convert('run1')
+        second_path, second = self.convert('run2')
+        self.assertEqual(first, 'Converted "story.docx"\n')     # Smart quotes replaced, as pandoc output is
+        self.assertEqual((second, second_path), (first, os.path.join(self.directory.name, 'run2', 'story.md')))
+        self.assertEqual(self.conversions(), 1)
+        self.assertEqual(conversion_cache.get_conversion_cache().hits, 1)
+
+    def test_changed_document_is_converted(self):
+        self.convert('run1')
+        self.convert('run2', content=b'changed content')
+        self.assertEqual(self.conversions(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
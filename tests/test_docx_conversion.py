@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import logging
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from new_content import docx_conversion
+from new_content.docx_conversion import DocxConversionService
+from utilities.run_log_command import BufferedLogger, log_context
+
+
+def fake_pandoc(directory):
+    """A pandoc that fails on documents named broken*, and writes one line of markdown for the others."""
+    path = os.path.join(directory, 'pandoc')
+    with open(path, 'w') as fd:
+        fd.write('#!/bin/sh\n'
+                 'case "$(basename "$1")" in broken*) echo "pandoc: cannot parse $1" >&2; exit 64;; esac\n'
+                 'printf "Converted %s\\n" "$(basename "$1")" > "$3"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+class TestDocxConversionService(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        fake_pandoc(self.directory.name)
+        patcher = mock.patch.dict(os.environ, PATH=self.directory.name + os.pathsep + os.environ['PATH'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DocxConversionService(max_workers=2)
+        self.logger = BufferedLogger()
+
+    def tearDown(self):
+        self.service.executor.shutdown(wait=True)
+        self.directory.cleanup()
+
+    def docx(self, name):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as fd:
+            fd.write(b'docx')
+        return path
+
+    def errors(self):
+        return [entry for level, entry, fields in self.logger.entries if level == logging.ERROR]
+
+    def test_documents_are_converted(self):
+        conversions = [self.service.submit(self.docx(f'story{n}.docx'), 'stories/') for n in range(3)]
+        self.assertEqual(self.service.wait(self.logger), 0)
+        self.assertEqual([x.failed for x in conversions], [False, False, False])
+        for n in range(3):
+            with open(os.path.join(self.directory.name, f'story{n}.md')) as fd:
+                self.assertEqual(fd.read(), f'Converted story{n}.docx\n')
+        self.assertEqual(self.errors(), [])
+        self.assertEqual(self.logger.entries[-1][1], 'Converted 3 documents (2 at a time), 0 with errors')
+
+    def test_failed_pandoc_is_reported_for_the_document(self):
+        with log_context(folder='SSTmanagement/stories/two'):
+            broken = self.service.submit(self.docx('broken.docx'), 'stories/two/')
+        good = self.service.submit(self.docx('good.docx'), 'stories/one/')
+        self.assertEqual(self.service.wait(self.logger), 1)
+        self.assertEqual((broken.failed, good.failed), (True, False))
+        errors = [(entry, fields.get('folder')) for level, entry, fields in self.logger.entries
+                  if level == logging.ERROR]
+        self.assertTrue(errors[0][0].startswith('Subprocess exited with code 64'))
+        self.assertIn("Error running pandoc", errors[1][0])
+        self.assertEqual(errors[-1], ('Document stories/two/broken.docx has 2 errors', 'SSTmanagement/stories/two'))
+        self.assertEqual(self.logger.entries[-1][1], 'Converted 2 documents (2 at a time), 1 with errors')
+
+    def test_conversion_that_raises(self):
+        with mock.patch('new_content.validate_shortcodes.ValidateShortcodes.clean_docx',
+                        side_effect=RuntimeError('out of memory')):
+            conversion = self.service.submit(self.docx('story.docx'), 'stories/', keep=object())
+            self.assertEqual(self.service.wait(self.logger), 1)
+        self.assertIsNone(conversion.keep)
+        self.assertEqual(self.errors(), ["Conversion of stories/story.docx failed: ('out of memory',)",
+                                         'Document stories/story.docx has 1 errors'])
+
+    def test_results_are_logged_in_the_order_queued(self):
+        for name in ('b.docx', 'a.docx', 'c.docx'):
+            self.service.submit(self.docx(name), 'stories/')
+        self.service.wait(self.logger)
+        checked = [entry.split('/')[-1] for level, entry, fields in self.logger.entries
+                   if entry.startswith('Checking document')]
+        self.assertEqual(checked, ['b.docx', 'a.docx', 'c.docx'])
+
+    def test_stop_waits_for_queued_documents(self):
+        service = docx_conversion.configure_docx_conversion(max_workers=1)
+        conversion = service.submit(self.docx('story.docx'), 'stories/')
+        docx_conversion.stop_docx_conversion(self.logger)
+        self.assertIsNone(docx_conversion.get_docx_conversion())
+        self.assertFalse(conversion.failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+from system_control.download_manifest import DownloadManifest
+
+
+class TestDownloadManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.manifest = DownloadManifest(os.path.join(self.directory.name, 'manifest.sqlite'),
+                                         os.path.join(self.directory.name, 'mirror'))
+
+    def tearDown(self):
+        self.manifest.close()
+        self.directory.cleanup()
+
+    def _local_copy(self, remote_path, content=b'content'):
+        local_path = self.manifest.mirror_path(remote_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as fd:
+            fd.write(content)
+        return local_path
+
+    def test_entry_hash_prefers_md5(self):
+        self.assertEqual(DownloadManifest.entry_hash({'Hashes': {'sha1': 's', 'md5': 'm'}}), 'm')
+        self.assertEqual(DownloadManifest.entry_hash({'Hashes': {'sha256': 'x'}}), 'x')
+        self.assertIsNone(DownloadManifest.entry_hash({'Size': 3}))
+
+    def test_mirror_path_follows_drive_tree(self):
+        self.assertEqual(self.manifest.mirror_path('/stories/a.docx'),
+                         os.path.join(self.directory.name, 'mirror', 'stories/a.docx'))
+
+    def test_unknown_file_is_not_current(self):
+        self.assertFalse(self.manifest.is_current('stories/a.docx', {'Size': 7}))
+        self.assertIsNone(self.manifest.local_path('stories/a.docx'))
+
+    def test_hashed_entry_is_current_until_size_or_hash_change(self):
+        entry = {'Size': 7, 'ModTime': '2024-01-01T00:00:00Z', 'Hashes': {'md5': 'abc'}}
+        local_path = self._local_copy('stories/a.docx')
+        self.manifest.record('/stories/a.docx', entry, local_path)
+        self.assertTrue(self.manifest.is_current('stories/a.docx', entry))
+        # A new modtime with the same content is still current
+        self.assertTrue(self.manifest.is_current('stories/a.docx', dict(entry, ModTime='2024-02-01T00:00:00Z')))
+        self.assertFalse(self.manifest.is_current('stories/a.docx', dict(entry, Hashes={'md5': 'def'})))
+        self.assertFalse(self.manifest.is_current('stories/a.docx', dict(entry, Size=8)))
+        self.assertEqual(self.manifest.local_path('stories/a.docx'), local_path)
+
+    def test_unhashed_entry_compares_modtime(self):
+        entry = {'Size': -1, 'ModTime': '2024-01-01T00:00:00Z'}
+        local_path = self._local_copy('stories/sheet')
+        self.manifest.record('stories/sheet', entry, local_path)
+        self.assertTrue(self.manifest.is_current('stories/sheet', entry))
+        self.assertFalse(self.manifest.is_current('stories/sheet', dict(entry, ModTime='2024-02-01T00:00:00Z')))
+
+    def test_missing_local_copy_is_not_current(self):
+        entry = {'Size': 7, 'Hashes': {'md5': 'abc'}}
+        local_path = self._local_copy('stories/a.docx')
+        self.manifest.record('stories/a.docx', entry, local_path)
+        os.remove(local_path)
+        self.assertFalse(self.manifest.is_current('stories/a.docx', entry))
+
+    def test_record_replaces_earlier_version(self):
+        local_path = self._local_copy('stories/a.docx')
+        self.manifest.record('stories/a.docx', {'Size': 7, 'Hashes': {'md5': 'abc'}}, local_path)
+        self.manifest.record('stories/a.docx', {'Size': 9, 'Hashes': {'md5': 'def'}}, local_path)
+        self.assertTrue(self.manifest.is_current('stories/a.docx', {'Size': 9, 'Hashes': {'md5': 'def'}}))
+        self.assertFalse(self.manifest.is_current('stories/a.docx', {'Size': 7, 'Hashes': {'md5': 'abc'}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from system_control.drive_cache import DriveListingCache
+
+
+class TestDriveListingCache(unittest.TestCase):
+
+    def test_listing_expires_after_ttl(self):
+        cache = DriveListingCache(ttl=10)
+        with mock.patch('system_control.drive_cache.time.time', return_value=1000):
+            cache.put('/SSTmanagement/stories/', [{'Name': 'a.docx'}])
+        with mock.patch('system_control.drive_cache.time.time', return_value=1009):
+            self.assertEqual(cache.get('SSTmanagement/stories'), [{'Name': 'a.docx'}])
+        with mock.patch('system_control.drive_cache.time.time', return_value=1010):
+            self.assertIsNone(cache.get('SSTmanagement/stories'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertNotIn('SSTmanagement/stories', cache.listings)
+
+    def test_least_recently_used_listing_is_dropped(self):
+        cache = DriveListingCache(max_entries=2)
+        cache.put('a', [])
+        cache.put('b', [])
+        cache.get('a')              # b is now the least recently used
+        cache.put('c', [])
+        self.assertEqual(list(cache.listings), ['a', 'c'])
+
+    def test_invalidate_drops_folder_and_below(self):
+        cache = DriveListingCache()
+        for path in ('top', 'top/sub', 'top/sub/deeper', 'topper'):
+            cache.put(path, [])
+        cache.invalidate('/top/')
+        self.assertEqual(list(cache.listings), ['topper'])
+
+    def test_save_and_load_keep_only_unexpired_listings(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, 'listings.json')
+            cache = DriveListingCache(ttl=100, cache_file=cache_file)
+            with mock.patch('system_control.drive_cache.time.time', return_value=1000):
+                cache.put('old', [{'Name': 'x'}])
+            with mock.patch('system_control.drive_cache.time.time', return_value=1050):
+                cache.put('new', [{'Name': 'y'}])
+            cache.save()
+            reloaded = DriveListingCache(ttl=100, cache_file=cache_file)
+            with mock.patch('system_control.drive_cache.time.time', return_value=1120):
+                reloaded.load()
+                self.assertEqual(list(reloaded.listings), ['new'])
+                self.assertEqual(reloaded.get('new'), [{'Name': 'y'}])
+
+    def test_load_ignores_unreadable_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, 'listings.json')
+            with open(cache_file, 'w') as fd:
+                fd.write('not json')
+            cache = DriveListingCache(cache_file=cache_file)
+            cache.load()
+            self.assertEqual(len(cache.listings), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
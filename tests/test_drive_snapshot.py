@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import unittest
+
+from system_control.drive_snapshot import DriveSnapshot
+
+
+def entry(path, is_dir=False):
+    return {'Path': path, 'Name': path.split('/')[-1], 'Size': -1 if is_dir else 10, 'IsDir': is_dir}
+
+
+class TestDriveSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = DriveSnapshot('/SSTmanagement/', [entry('stories', True), entry('stories/one', True),
+                                                          entry('stories/one/a.docx'), entry('commands.txt'),
+                                                          entry('stories/one/ignore', True),
+                                                          entry('stories/one/ignore/b.docx')])
+
+    def test_list_entries(self):
+        self.assertEqual(sorted(x['Name'] for x in self.snapshot.list_entries('SSTmanagement')),
+                         ['commands.txt', 'stories'])
+        self.assertEqual([x['Name'] for x in self.snapshot.list_entries('/SSTmanagement/stories/one/')],
+                         ['a.docx', 'ignore'])
+        self.assertEqual(self.snapshot.get_entry('SSTmanagement/stories/one/a.docx')['Size'], 10)
+        self.assertIsNone(self.snapshot.get_entry('SSTmanagement/missing'))
+
+    def test_covers_only_directories_of_the_tree(self):
+        self.assertTrue(self.snapshot.covers('SSTmanagement/stories/one'))
+        self.assertFalse(self.snapshot.covers('SSTmanagement/stories/one/a.docx'))
+        self.assertFalse(self.snapshot.covers('Other'))
+
+    def test_invalidate_marks_folder_and_below_stale(self):
+        self.snapshot.invalidate('/SSTmanagement/stories/')
+        self.assertFalse(self.snapshot.covers('SSTmanagement/stories'))
+        self.assertFalse(self.snapshot.covers('SSTmanagement/stories/one/ignore'))
+        self.assertTrue(self.snapshot.covers('SSTmanagement'))
+
+    def test_walk(self):
+        self.assertEqual(sorted(path for path, _ in self.snapshot.walk('SSTmanagement/stories')),
+                         ['one', 'one/a.docx', 'one/ignore', 'one/ignore/b.docx'])
+        self.assertEqual(sorted(path for path, _ in self.snapshot.walk('SSTmanagement', max_depth=2)),
+                         ['commands.txt', 'stories', 'stories/one'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from system_control.fingerprint_journal import FingerprintJournal, file_fingerprint, story_fingerprint
+
+try:
+    from system_control import command_processor
+except (ImportError, SystemError):     # Needs config_private, pandas, mako, ... of a deployment
+    command_processor = None
+
+
+def drive_entries(**files):
+    """(path, lsjson entry) for each name=md5 given."""
+    return [(name.replace('__', '/'), {'Name': name, 'Size': 10, 'IsDir': False, 'Hashes': {'md5': md5}})
+            for name, md5 in files.items()]
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_story_fingerprint_follows_file_content_only(self):
+        entries = drive_entries(a_docx='1', meta_txt='2')
+        same = story_fingerprint(list(reversed(entries)) + [('gallery', {'IsDir': True, 'Size': -1})], 'code')
+        self.assertEqual(story_fingerprint(entries, 'code'), same)
+        self.assertNotEqual(story_fingerprint(entries, 'code'), story_fingerprint(drive_entries(a_docx='1',
+                                                                                                meta_txt='3'), 'code'))
+        self.assertNotEqual(story_fingerprint(entries, 'code'), story_fingerprint(entries, 'new code'))
+
+    def test_unhashed_entries_use_size_and_modtime(self):
+        sheet = [('sheet', {'Size': -1, 'ModTime': '2024-01-01T00:00:00Z', 'IsDir': False})]
+        changed = [('sheet', {'Size': -1, 'ModTime': '2024-02-01T00:00:00Z', 'IsDir': False})]
+        self.assertNotEqual(story_fingerprint(sheet), story_fingerprint(changed))
+
+    def test_file_fingerprint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            template = os.path.join(directory, 'story.mako')
+            with open(template, 'w') as fd:
+                fd.write('${title}')
+            before = file_fingerprint([template])
+            with open(template, 'w') as fd:
+                fd.write('${title}!')
+            self.assertNotEqual(before, file_fingerprint([template]))
+
+
+class TestFingerprintJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = FingerprintJournal(os.path.join(self.directory.name, 'journal.sqlite'))
+        self.output = os.path.join(self.directory.name, 'story.md')
+        with open(self.output, 'w') as fd:
+            fd.write('story')
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def test_unchanged_once_recorded(self):
+        self.assertFalse(self.journal.is_unchanged('stories/one', 'f1'))
+        self.journal.record('/stories/one/', 'f1', [self.output])
+        self.assertTrue(self.journal.is_unchanged('stories/one', 'f1'))
+        self.assertFalse(self.journal.is_unchanged('stories/one', 'f2'))
+
+    def test_changed_when_an_output_is_gone(self):
+        self.journal.record('stories/one', 'f1', [self.output])
+        os.remove(self.output)
+        self.assertFalse(self.journal.is_unchanged('stories/one', 'f1'))
+
+    def test_folder_without_outputs_is_never_unchanged(self):
+        self.journal.record('stories/one', 'f1', [])
+        self.assertFalse(self.journal.is_unchanged('stories/one', 'f1'))
+
+    def test_forget(self):
+        self.journal.record('stories/one', 'f1', [self.output])
+        self.journal.forget('stories/one')
+        self.assertFalse(self.journal.is_unchanged('stories/one', 'f1'))
+
+
+class FakeStory(object):
+    """Stands in for ProcessStoryContent - writes the story's output, or fails as told."""
+    runs = []
+    fail = None         # 'raise' or 'log'
+
+    def __init__(self, logger, folder, temp_dir, *directories):
+        self.logger = logger
+        self.folder = folder
+        self.outputs = [os.path.join(temp_dir, folder.split('/')[-1] + '.md')]
+        self.conversions = []
+
+    def process_content(self):
+        FakeStory.runs.append(self.folder)
+        if FakeStory.fail == 'raise':
+            raise OSError('pandoc failed')
+        if FakeStory.fail == 'log':
+            self.logger.make_error_entry('Missing image /images/a.jpg')
+        with open(self.outputs[0], 'w') as fd:
+            fd.write('story')
+
+
+class Conversion(object):
+    def __init__(self, failed):
+        self.failed = failed
+
+
+@unittest.skipIf(command_processor is None, "command_processor needs a deployment's config_private and packages")
+class TestStorySkipping(unittest.TestCase):
+    FOLDER = 'SSTmanagement/stories/one'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = FingerprintJournal(os.path.join(self.directory.name, 'journal.sqlite'))
+        self.entries = drive_entries(one_docx='1', meta_txt='2')
+        FakeStory.runs = []
+        FakeStory.fail = None
+        patcher = mock.patch.object(command_processor, 'PSC', FakeStory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def folders(self, force_reprocess=False):
+        """A ManageFolders with just what story processing uses."""
+        folders = command_processor.ManageFolders.__new__(command_processor.ManageFolders)
+        folders.config = mock.Mock()
+        folders.config.get_configuration_parameter.return_value = self.directory.name
+        folders.temp_dir = self.directory.name
+        folders.manage_drive = mock.Mock()
+        folders.manage_drive.tree_entries.side_effect = lambda logger, folder, max_depth: self.entries
+        folders.journal = self.journal
+        folders.force_reprocess = force_reprocess
+        folders.code_fingerprint = 'code'
+        folders.processed_stories = []
+        folders.skipped_stories = []
+        folders.completed_stories = []
+        return folders
+
+    def run_story(self, folders=None):
+        folders = folders or self.folders()
+        fctx = command_processor.FolderContext(self.FOLDER, 'SSTmanagement', mock.Mock())
+        try:
+            folders._command_process_story({'command': 'story'}, fctx)
+        finally:
+            folders._record_stories()
+        return folders
+
+    def test_unchanged_story_is_skipped(self):
+        self.run_story()
+        folders = self.run_story()
+        self.assertEqual(FakeStory.runs, [self.FOLDER])
+        self.assertEqual(folders.skipped_stories, [self.FOLDER])
+
+    def test_changed_input_is_processed(self):
+        self.run_story()
+        self.entries = drive_entries(one_docx='changed', meta_txt='2')
+        folders = self.run_story()
+        self.assertEqual(FakeStory.runs, [self.FOLDER, self.FOLDER])
+        self.assertEqual(folders.processed_stories, [self.FOLDER])
+
+    def test_force_reprocess(self):
+        self.run_story()
+        self.run_story(self.folders(force_reprocess=True))
+        self.assertEqual(len(FakeStory.runs), 2)
+
+    def test_failed_story_is_not_journaled(self):
+        self.run_story()
+        self.entries = drive_entries(one_docx='changed', meta_txt='2')
+        FakeStory.fail = 'raise'
+        with self.assertRaises(OSError):
+            self.run_story()
+        # Nor is the earlier run taken to still hold - the folder is processed whatever its inputs
+        self.entries = drive_entries(one_docx='1', meta_txt='2')
+        FakeStory.fail = None
+        self.run_story()
+        self.assertEqual(len(FakeStory.runs), 3)
+
+    def test_story_that_logged_errors_is_processed_again(self):
+        FakeStory.fail = 'log'
+        self.run_story()
+        FakeStory.fail = None
+        self.run_story()
+        self.assertEqual(len(FakeStory.runs), 2)
+
+    def test_story_is_journaled_only_once_its_documents_converted(self):
+        folders = self.folders()
+        fctx = command_processor.FolderContext(self.FOLDER, 'SSTmanagement', mock.Mock())
+        folders._command_process_story({'command': 'story'}, fctx)
+        self.assertFalse(self.journal.is_unchanged(self.FOLDER, folders.completed_stories[0][1]))
+        folders.completed_stories = [x[:3] + ([Conversion(False), Conversion(True)],)
+                                     for x in folders.completed_stories]
+        folders._record_stories()
+        self.run_story()
+        self.assertEqual(len(FakeStory.runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
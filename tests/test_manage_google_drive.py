@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+from utilities import tracing
+
+try:
+    from system_control import manage_google_drive as mgd
+except ImportError:     # pandas is not installed
+    mgd = None
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+@unittest.skipIf(mgd is None, "manage_google_drive needs pandas")
+class TestManageGoogleDrive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logger = ListLogger()
+        self.drive = mgd.ManageGoogleDrive()
+        self.drive.remote_control = None
+
+    def tearDown(self):
+        tracing._tracer = None
+        self.directory.cleanup()
+
+    def test_upload_records_one_span(self):
+        with open(os.path.join(self.directory.name, 'a.txt'), 'w') as fd:
+            fd.write('text')
+        tracer = tracing.configure_tracing()
+        with mock.patch.object(self.drive, '_perform', return_value=True) as perform:
+            self.drive.upload_file(self.logger, 'SSTmanagement/stories', 'a.txt', self.directory.name)
+        self.assertEqual(perform.call_count, 1)
+        self.assertEqual([span.name for span in tracer.spans], ['ManageGoogleDrive.upload_file'])
+
+    def test_daemon_used_when_running(self):
+        self.drive.remote_control = mock.Mock()
+        self.drive.remote_control.call.return_value = {'list': [{'Name': 'a.docx', 'IsDir': False}]}
+        with mock.patch.object(self.drive, '_run_rclone') as run_rclone:
+            entries = self.drive._perform(self.logger, self.drive._list_request('stories'), listing=True)
+        self.assertEqual(entries, [{'Name': 'a.docx', 'IsDir': False}])
+        method, params = self.drive.remote_control.call.call_args[0]
+        self.assertEqual((method, params['fs'], params['remote']), ('operations/list', 'sst_store:', 'stories'))
+        run_rclone.assert_not_called()
+
+    def test_subprocess_used_when_daemon_call_fails(self):
+        self.drive.remote_control = mock.Mock()
+        self.drive.remote_control.call.side_effect = RcEx('connection refused')
+        with mock.patch.object(self.drive, '_run_rclone', return_value=b'[{"Name": "a.docx"}]') as run_rclone:
+            entries = self.drive._perform(self.logger, self.drive._list_request('stories'), listing=True)
+        self.assertEqual(entries, [{'Name': 'a.docx'}])
+        self.assertIn('lsjson --max-depth 1', run_rclone.call_args[0][0])
+        self.assertIn('retrying with rclone subprocess', self.logger.errors[0])
+
+    def test_failed_listing_names_folder_and_command(self):
+        with mock.patch.object(self.drive, '_run_rclone', return_value=None):
+            with self.assertRaises(OSError) as raised:
+                self.drive.list_entries(self.logger, 'SSTmanagement/stories')
+        self.assertIn('SSTmanagement/stories', str(raised.exception))
+        self.assertIn("lsjson --max-depth 1 --hash 'sst_store:SSTmanagement/stories'", str(raised.exception))
+        self.assertEqual(self.logger.errors, ['Error listing files in directory: SSTmanagement/stories'])
+
+    def test_listing_output_not_json(self):
+        with mock.patch.object(self.drive, '_run_rclone', return_value=b'[{"Name": '):
+            with self.assertRaisesRegex(OSError, 'not valid lsjson output'):
+                self.drive._perform(self.logger, self.drive._list_request('stories'), listing=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
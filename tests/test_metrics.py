@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from utilities import metrics
+from utilities.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = MetricsRegistry()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def textfile(self):
+        path = self.registry.write_textfile(os.path.join(self.directory.name, 'sst.prom'))
+        self.assertEqual(os.listdir(self.directory.name), ['sst.prom'])
+        with open(path) as fd:
+            return fd.read()
+
+    def test_counter_and_gauge(self):
+        files = self.registry.counter('files_total', 'Files processed', ('kind',))
+        files.inc(kind='docx')
+        files.inc(2, kind='docx')
+        files.inc(kind='md')
+        self.registry.gauge('last_run_seconds', 'Duration of the run').set(12.5)
+        self.assertIs(self.registry.counter('files_total'), files)
+        self.assertEqual(self.textfile(),
+                         '# HELP sst_files_total Files processed\n'
+                         '# TYPE sst_files_total counter\n'
+                         'sst_files_total{kind="docx"} 3\n'
+                         'sst_files_total{kind="md"} 1\n'
+                         '# HELP sst_last_run_seconds Duration of the run\n'
+                         '# TYPE sst_last_run_seconds gauge\n'
+                         'sst_last_run_seconds 12.5\n')
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram('command_seconds', 'Command time', ('command',), buckets=(0.1, 1, 10))
+        for value in (0.05, 0.1, 0.5, 20):
+            histogram.observe(value, command='rclone')
+        self.assertEqual(self.textfile(),
+                         '# HELP sst_command_seconds Command time\n'
+                         '# TYPE sst_command_seconds histogram\n'
+                         'sst_command_seconds_bucket{command="rclone",le="0.1"} 2\n'
+                         'sst_command_seconds_bucket{command="rclone",le="1"} 3\n'
+                         'sst_command_seconds_bucket{command="rclone",le="10"} 3\n'
+                         'sst_command_seconds_bucket{command="rclone",le="+Inf"} 4\n'
+                         'sst_command_seconds_sum{command="rclone"} 20.65\n'
+                         'sst_command_seconds_count{command="rclone"} 4\n')
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter('errors_total', 'Errors', ('folder',)).inc(folder='a "quoted"\\path\nnext')
+        self.assertIn('sst_errors_total{folder="a \\"quoted\\"\\\\path\\nnext"} 1\n', self.textfile())
+
+    def test_json_has_the_same_values(self):
+        self.registry.histogram('command_seconds', 'Command time', ('command',), buckets=(1,)).observe(
+            0.5, command='pandoc')
+        path = self.registry.write_json(os.path.join(self.directory.name, 'sst.json'), run='nightly')
+        with open(path) as fd:
+            data = json.load(fd)
+        self.assertEqual(data['run'], 'nightly')
+        self.assertEqual(data['metrics']['sst_command_seconds'],
+                         [{'name': 'sst_command_seconds_bucket', 'labels': {'command': 'pandoc', 'le': '1'},
+                           'value': 1},
+                          {'name': 'sst_command_seconds_bucket', 'labels': {'command': 'pandoc', 'le': '+Inf'},
+                           'value': 1},
+                          {'name': 'sst_command_seconds_sum', 'labels': {'command': 'pandoc'}, 'value': 0.5},
+                          {'name': 'sst_command_seconds_count', 'labels': {'command': 'pandoc'}, 'value': 1}])
+
+    def test_module_helpers_use_the_run_registry(self):
+        with mock.patch.object(metrics, '_registry', self.registry):
+            metrics.count('uploads_total', folder='news', kind='docx')
+            metrics.count('uploads_total', kind='docx', folder='news')
+            metrics.set_gauge('queue_length', 3)
+            self.assertIs(metrics.get_registry(), self.registry)
+        text = self.textfile()
+        self.assertIn('sst_uploads_total{folder="news",kind="docx"} 2\n', text)
+        self.assertIn('sst_queue_length 3\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
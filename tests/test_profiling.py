@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import pstats
+import tempfile
+import unittest
+from unittest import mock
+
+from utilities import profiling
+
+
+def busy():
+    return sum(x * x for x in range(200000))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(profiling, '_settings', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def configure(self, **kwargs):
+        return profiling.configure_profiling(self.directory.name, 'run1', **kwargs)
+
+    def test_nothing_is_profiled_when_not_configured(self):
+        with mock.patch('cProfile.Profile') as profile, mock.patch.object(profiling, 'SamplingProfiler') as sampler:
+            with profiling.profile('commands'):
+                busy()
+            with profiling.profile('folder', 'SSTmanagement/stories/one'):
+                busy()
+        profile.assert_not_called()
+        sampler.assert_not_called()
+        self.assertEqual(profiling.profiled_files(), [])
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_phases_and_folders_not_selected_are_not_profiled(self):
+        self.configure(phases=['commands'], folders=['SSTmanagement/stories/*'])
+        with mock.patch('cProfile.Profile') as profile:
+            with profiling.profile('startup'):
+                busy()
+            with profiling.profile('folder', 'SSTmanagement/pages/home'):
+                busy()
+            with profiling.profile('folder'):
+                busy()
+        profile.assert_not_called()
+        self.assertEqual(profiling.profiled_files(), [])
+
+    def test_selected_phase_and_folder_are_written(self):
+        self.configure(phases=['commands'], folders=['SSTmanagement/stories/*'])
+        with profiling.profile('commands'):
+            busy()
+            with profiling.profile('folder', 'SSTmanagement/stories/one'):     # Part of the commands profile
+                busy()
+        with profiling.profile('folder', 'SSTmanagement/stories/two'):
+            busy()
+        with profiling.profile('commands'):
+            busy()
+        self.assertEqual([os.path.basename(x) for x in profiling.profiled_files()],
+                         ['run1.commands.pstats', 'run1.folder-SSTmanagement_stories_two.pstats',
+                          'run1.commands.2.pstats'])
+        stats = pstats.Stats(profiling.profiled_files()[0])
+        self.assertIn('busy', [name for filename, line, name in stats.stats])
+
+    def test_sampling_profile_is_read_by_pstats(self):
+        self.configure(phases=['commands'], sampling=True, interval=0.001)
+        with profiling.profile('commands'):
+            for _ in range(20):
+                busy()
+        stats = pstats.Stats(*profiling.profiled_files())
+        self.assertIn('busy', [name for filename, line, name in stats.stats])
+        self.assertGreater(stats.total_tt, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from system_control import rclone_rc
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+def free_address():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+
+@unittest.skipUnless(shutil.which('rclone'), "rclone is not installed")
+class TestRemoteControl(unittest.TestCase):
+    """Calls on an rclone rcd - local directories serve as the remotes."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.remote_control = rclone_rc.RcloneRemoteControl(ListLogger(), rc_address=free_address())
+        if not cls.remote_control.start():
+            raise unittest.SkipTest("rclone rcd could not be started")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.remote_control.stop()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source')
+        self.target = os.path.join(self.directory.name, 'target')
+        os.makedirs(os.path.join(self.source, 'story'))
+        os.makedirs(self.target)
+        for name in ('commands.txt', 'story/a b.docx'):
+            with open(os.path.join(self.source, name), 'w') as fd:
+                fd.write(name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_list(self):
+        reply = self.remote_control.call('operations/list', {'fs': self.source, 'remote': ''})
+        self.assertEqual(sorted((x['Name'], x['IsDir']) for x in reply['list']),
+                         [('commands.txt', False), ('story', True)])
+        reply = self.remote_control.call('operations/list', {'fs': self.source, 'remote': '',
+                                                             'opt': {'recurse': True}})
+        self.assertEqual(sorted(x['Path'] for x in reply['list']), ['commands.txt', 'story', 'story/a b.docx'])
+
+    def test_copyfile(self):
+        self.remote_control.call('operations/copyfile', {'srcFs': self.source, 'srcRemote': 'story/a b.docx',
+                                                         'dstFs': self.target, 'dstRemote': 'a b.docx'})
+        with open(os.path.join(self.target, 'a b.docx')) as fd:
+            self.assertEqual(fd.read(), 'story/a b.docx')
+
+    def test_failed_call_raises(self):
+        with self.assertRaises(RcEx):
+            self.remote_control.call('operations/copyfile', {'srcFs': self.source, 'srcRemote': 'missing.txt',
+                                                             'dstFs': self.target, 'dstRemote': 'missing.txt'})
+
+    def test_connection_is_reopened(self):
+        self.remote_control.call('rc/noop')
+        self.remote_control.local.connection.close()
+        self.assertEqual(self.remote_control.call('rc/noop', {'x': 1}), {'x': 1})
+
+
+class TestFallback(unittest.TestCase):
+    """Without a daemon the drive calls go to an rclone subprocess each."""
+
+    def tearDown(self):
+        rclone_rc.stop_remote_control()
+
+    def test_missing_rclone(self):
+        logger = ListLogger()
+        remote_control = rclone_rc.start_remote_control(logger, rc_address=free_address(),
+                                                        rclone_command='/nonexistent/rclone')
+        self.assertIsNone(remote_control)
+        self.assertIsNone(rclone_rc.get_remote_control())
+        self.assertTrue(logger.errors[0].startswith('Unable to start rclone rcd'))
+        self.assertIn('using one rclone process per drive call', logger.errors[-1])
+
+    def test_daemon_exits_at_startup(self):
+        logger = ListLogger()
+        remote_control = rclone_rc.RcloneRemoteControl(logger, rc_address=free_address(), rclone_command='false')
+        self.assertFalse(remote_control.start(timeout=5))
+        self.assertIsNone(remote_control.process)
+        self.assertEqual(logger.errors, ['rclone rcd exited at startup with code 1'])
+
+    def test_nothing_listening(self):
+        remote_control = rclone_rc.RcloneRemoteControl(ListLogger(), rc_address=free_address())
+        with self.assertRaises(OSError):
+            remote_control.call('rc/noop')
+
+
+if __name__ == '__main__':
+    unittest.main()
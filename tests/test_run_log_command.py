@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from utilities.run_log_command import BufferedLogger, _wait_process, log_context, run_command
+
+
+def process_running(pid):
+    """True if pid is a process that has not exited (a zombie waiting for its parent counts as exited)."""
+    try:
+        with open(f'/proc/{pid}/stat') as fd:
+            return fd.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+class TestRunCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = BufferedLogger()
+
+    def messages(self, level=None):
+        return [entry for entry_level, entry, fields in self.logger.entries if level is None or entry_level == level]
+
+    def test_output_is_logged_with_the_callers_fields(self):
+        with log_context(folder='SSTmanagement/stories/one', command='story'):
+            result = run_command(['sh', '-c', 'echo out; echo err >&2'], self.logger)
+        self.assertTrue(result.ok)
+        output = {entry: fields for level, entry, fields in self.logger.entries if entry.startswith('    ')}
+        self.assertEqual(set(output), {'    out', '    err'})
+        for fields in output.values():
+            self.assertEqual((fields.get('folder'), fields.get('command')), ('SSTmanagement/stories/one', 'story'))
+
+    def test_captured_stdout_is_not_logged(self):
+        result = run_command(['sh', '-c', 'echo data; echo progress >&2'], self.logger, capture_stdout=True)
+        self.assertEqual(result.stdout, b'data\n')
+        self.assertEqual(result.tail, ['progress'])
+        self.assertNotIn('    data', self.messages())
+
+    def test_return_code(self):
+        result = run_command(['sh', '-c', 'echo failing >&2; exit 3'], self.logger)
+        self.assertEqual((result.returncode, result.ok, result.timed_out), (3, False, None))
+        errors = self.messages(level=40)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('Subprocess exited with code 3'))
+        self.assertIn('failing', errors[0])
+
+    def test_wall_timeout(self):
+        start = time.monotonic()
+        result = run_command(['sleep', '30'], self.logger, timeout=1)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(result.timed_out, 'wall')
+        self.assertFalse(result.ok)
+        self.assertIn('Subprocess killed after running for more than 1 seconds', self.messages(level=40)[0])
+
+    def test_idle_timeout(self):
+        result = run_command(['sh', '-c', 'echo started; sleep 30'], self.logger, idle_timeout=1)
+        self.assertEqual(result.timed_out, 'idle')
+        self.assertEqual(result.tail, ['started'])
+
+    def test_processes_started_by_the_command_are_killed(self):
+        # The shell starts sleep in the background and writes its pid - both go when the command is killed
+        with tempfile.TemporaryDirectory() as directory:
+            pid_file = os.path.join(directory, 'pid')
+            result = run_command(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], self.logger, timeout=1)
+            with open(pid_file) as fd:
+                child = int(fd.read())
+        self.assertEqual(result.timed_out, 'wall')
+        self.assertFalse(process_running(child))
+
+    def test_missing_command(self):
+        with self.assertRaises(OSError):
+            run_command(['/nonexistent/command'], self.logger)
+
+
+class TestWaitProcess(unittest.TestCase):
+
+    def test_resource_usage_of_the_command(self):
+        process = subprocess.Popen([sys.executable, '-c', 'sum(range(5 * 10 ** 6))'])
+        rusage = _wait_process(process, 60)
+        self.assertEqual(process.returncode, 0)
+        self.assertGreater(rusage.ru_utime + rusage.ru_stime, 0)
+
+    def test_timeout(self):
+        process = subprocess.Popen(['sleep', '30'])
+        try:
+            with self.assertRaises(subprocess.TimeoutExpired):
+                _wait_process(process, 0.2)
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_signal_gives_negative_return_code(self):
+        process = subprocess.Popen(['sleep', '30'])
+        process.terminate()
+        _wait_process(process, 10)
+        self.assertEqual(process.returncode, -15)
+
+
+if __name__ == '__main__':
+    unittest.main()
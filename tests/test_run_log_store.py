@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from utilities.run_log_command import JsonLinesHandler, _LogFieldsFilter, log_context
+from utilities.run_log_store import RunLogStore
+
+try:
+    from system_control.system_manager import SystemManager
+except (ImportError, SystemError):     # Needs config_private and the USER the config file is set up for
+    SystemManager = None
+
+
+def record(ts, message, level='INFO', folder=None, command=None, phase=None, duration=None):
+    return {'ts': ts, 'level': level, 'logger': 'SSTcontent', 'message': message, 'run_id': None,
+            'folder': folder, 'command': command, 'phase': phase, 'duration': duration}
+
+
+STORIES = 'SSTmanagement/stories'
+RUN = [record(100, 'Begin command processing'),
+       record(101, 'Shortcode box has not been terminated', 'ERROR', STORIES + '/one', 'story'),
+       record(102, 'command story finished in 4.00s', folder=STORIES + '/one', command='story', phase='command',
+              duration=4.0),
+       record(103, 'command story finished in 9.00s', folder=STORIES + '/two', command='story', phase='command',
+              duration=9.0),
+       record(104, 'command all finished in 13.00s', folder=STORIES, command='all', phase='command', duration=13.0),
+       record(105, 'Missing image', 'ERROR', 'SSTmanagement/stories-old', 'story'),
+       record(106, 'Error in other folder', 'ERROR', 'SSTmanagement/pages', 'process_pages')]
+
+
+class TestRunLogStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = RunLogStore(os.path.join(self.directory.name, 'run_logs.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def write_run(self, run_id, records, cut_short=False):
+        path = os.path.join(self.directory.name, run_id + '.jsonl')
+        with open(path, 'w', encoding='utf-8') as fd:
+            for entry in records:
+                fd.write(json.dumps(entry) + '\n')
+            if cut_short:
+                fd.write('{"ts": 200, "level": "IN')
+        return path
+
+    def test_ingest_counts_records_and_errors(self):
+        self.assertEqual(self.store.ingest('run1', self.write_run('run1', RUN, cut_short=True)), len(RUN))
+        self.assertEqual(self.store.runs(), [('run1', 100, 106, len(RUN), 3)])
+
+    def test_ingest_again_replaces_the_run(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        self.store.ingest('run1', self.write_run('run1', RUN[:2]))
+        self.assertEqual(len(self.store.run_records('run1')), 2)
+
+    def test_entries_written_by_the_run_log_handler(self):
+        path = os.path.join(self.directory.name, 'run2.jsonl')
+        handler = JsonLinesHandler(path)
+        handler.addFilter(_LogFieldsFilter())
+        logger = logging.getLogger('test_run_log_store')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            with log_context(folder=STORIES + '/one', command='story'):
+                logger.error('Document one.docx has 2 errors')
+            logger.warning('Outside any folder')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        self.store.ingest('run2', path)
+        self.assertEqual([row[1:] for row in self.store.run_records('run2')],
+                         [('ERROR', STORIES + '/one', 'story', 'Document one.docx has 2 errors'),
+                          ('WARNING', None, None, 'Outside any folder')])
+
+    def test_run_records_by_level(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        self.assertEqual([row[4] for row in self.store.run_records('run1', level='ERROR')],
+                         ['Shortcode box has not been terminated', 'Missing image', 'Error in other folder'])
+
+    def test_folder_records_include_subfolders_only(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        rows = self.store.run_folder_records('run1', STORIES + '/', level='ERROR')
+        # stories-old is not below stories
+        self.assertEqual([(row[2], row[4]) for row in rows],
+                         [(STORIES + '/one', 'Shortcode box has not been terminated')])
+        self.assertEqual(len(self.store.run_folder_records('run1', STORIES)), 4)
+
+    def test_folder_timings_leave_out_container_commands(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        self.assertEqual(self.store.run_folder_timings('run1', STORIES),
+                         [(STORIES + '/two', 'story', 9.0), (STORIES + '/one', 'story', 4.0)])
+
+    def test_errors_for_folder_over_the_newest_runs(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        later = [dict(entry, ts=entry['ts'] + 1000) for entry in RUN[:2]]
+        self.store.ingest('run2', self.write_run('run2', later))
+        self.assertEqual([row[0] for row in self.store.errors_for_folder(STORIES)], ['run1', 'run2'])
+        self.assertEqual([row[0] for row in self.store.errors_for_folder(STORIES, last_runs=1)], ['run2'])
+
+    def test_retention_drops_and_compresses_old_runs(self):
+        for number in range(4):
+            self.store.ingest(f'run{number}', self.write_run(f'run{number}', [record(number * 1000, 'entry')]))
+        with open(os.path.join(self.directory.name, 'run0.trace.json'), 'w') as fd:
+            fd.write('{}')
+        self.store.apply_retention(keep_runs=3, compress_after=1)
+        self.assertEqual([row[0] for row in self.store.runs()], ['run3', 'run2', 'run1'])
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['run1.jsonl.gz', 'run2.jsonl.gz', 'run3.jsonl', 'run_logs.sqlite'])
+        with gzip.open(os.path.join(self.directory.name, 'run1.jsonl.gz'), 'rt') as fd:
+            self.assertEqual(json.loads(fd.readline())['ts'], 1000)
+        # Compressed run logs can be loaded again
+        self.assertEqual(self.store.ingest('run1', os.path.join(self.directory.name, 'run1.jsonl.gz')), 1)
+
+    @unittest.skipIf(SystemManager is None, "system_manager needs a deployment's config_private and USER")
+    def test_digest_of_a_users_folders(self):
+        self.store.ingest('run1', self.write_run('run1', RUN))
+        subject, body = SystemManager._log_digest(self.store, 'run1', [STORIES, 'SSTmanagement/pages'])
+        self.assertEqual(subject, 'sst_utils run run1: 2 errors in your folders')
+        lines = body.splitlines()
+        self.assertEqual(lines[0], f'{STORIES}: 1 errors, 2 commands taking 13.0s')
+        self.assertIn(f'    {STORIES}/one story: Shortcode box has not been terminated', lines)
+        self.assertIn(f'         9.0s  story  {STORIES}/two', lines)
+        self.assertIn('SSTmanagement/pages: 1 errors, 0 commands taking 0.0s', lines)
+        self.assertNotIn('Missing image', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
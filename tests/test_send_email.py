@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utilities.send_email import MailWorker
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """Local SMTP server that keeps what it is sent.
+
+    close_after - drop the session after that many messages; drop_on_mail - drop it as a message is started;
+    refuse - a recipient that is refused."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, close_after=None, drop_on_mail=False, refuse=None):
+        super().__init__(('127.0.0.1', 0), SmtpSession)
+        self.close_after = close_after
+        self.drop_on_mail = drop_on_mail
+        self.refuse = refuse
+        self.sessions = 0
+        self.messages = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SmtpSession(socketserver.StreamRequestHandler):
+
+    def reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        sink.sessions += 1
+        sent = 0
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode('ascii').strip().split(' ')[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif verb == 'MAIL':
+                if sink.drop_on_mail:
+                    return
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                if sink.refuse and sink.refuse in line.decode('ascii'):
+                    self.reply('550 no such user')
+                else:
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line)
+                sink.messages.append(b''.join(data).decode('utf-8'))
+                self.reply('250 queued')
+                sent += 1
+                if sink.close_after and sent >= sink.close_after:
+                    return
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class TestMailWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = ListLogger()
+        self.sinks = []
+
+    def tearDown(self):
+        for sink in self.sinks:
+            sink.stop()
+
+    def worker(self, **kwargs):
+        sink = SmtpSink(**kwargs)
+        self.sinks.append(sink)
+        return sink, MailWorker('sst@example.org', None, '127.0.0.1', sink.port, self.logger, starttls=False)
+
+    def mail(self, worker, recipient, subject='Log result of sst_utils run'):
+        mail = worker.new_email()
+        mail.add_recipient(recipient)
+        mail.set_subject(subject)
+        mail.set_body('2 errors in your folders')
+        return mail
+
+    def test_one_session_for_several_messages(self):
+        sink, worker = self.worker()
+        for user in ('ann', 'bob', 'cy'):
+            worker.submit(self.mail(worker, f'{user}@example.org', subject=f'Digest for {user}'))
+        self.assertTrue(worker.close(timeout=30))
+        self.assertEqual(sink.sessions, 1)
+        self.assertEqual([('To: ann@example.org' in x, 'Subject: Digest for cy' in x) for x in sink.messages],
+                         [(True, False), (False, False), (False, True)])
+        self.assertEqual((worker.sent, worker.failed), (3, 0))
+        self.assertEqual(self.logger.info, ['Email: 3 sent, 0 failed'])
+
+    def test_reconnects_once_when_the_server_drops_the_session(self):
+        sink, worker = self.worker(close_after=1)
+        worker.submit(self.mail(worker, 'ann@example.org'))
+        worker.submit(self.mail(worker, 'bob@example.org'))
+        self.assertTrue(worker.close(timeout=30))
+        self.assertEqual((sink.sessions, len(sink.messages)), (2, 2))
+        self.assertEqual((worker.sent, worker.failed), (2, 0))
+
+    def test_gives_up_after_one_reconnection(self):
+        sink, worker = self.worker(drop_on_mail=True)
+        worker.submit(self.mail(worker, 'ann@example.org'))
+        self.assertTrue(worker.close(timeout=30))
+        self.assertEqual(sink.sessions, 2)
+        self.assertEqual((worker.sent, worker.failed), (0, 1))
+        self.assertTrue(self.logger.errors[0].startswith('Unable to send email to ann@example.org'))
+
+    def test_send_failures_are_counted(self):
+        sink, worker = self.worker(refuse='bob@')
+        worker.submit(self.mail(worker, 'bob@example.org'))
+        worker.submit(self.mail(worker, 'ann@example.org'))
+        self.assertTrue(worker.close(timeout=30))
+        self.assertEqual((worker.sent, worker.failed, len(sink.messages)), (1, 1, 1))
+        self.assertEqual(len(self.logger.errors), 1)
+
+    def test_build_failures_are_counted(self):
+        sink, worker = self.worker()
+        no_recipient = worker.new_email()
+        no_recipient.set_subject('Digest')
+        no_recipient.set_body('body')
+        worker.submit(no_recipient)
+        missing_attachment = self.mail(worker, 'ann@example.org')
+        missing_attachment.add_attachment(os.path.join(tempfile.gettempdir(), 'no_such_dir', 'SSTcontent.log'))
+        worker.submit(missing_attachment)
+        self.assertTrue(worker.close(timeout=30))
+        self.assertEqual((worker.sent, worker.failed, sink.sessions), (0, 2, 0))
+        self.assertEqual(len(self.logger.errors), 2)
+
+    def test_attachment_is_compressed(self):
+        sink, worker = self.worker()
+        with tempfile.TemporaryDirectory() as directory:
+            log_file = os.path.join(directory, 'SSTcontent.log')
+            with open(log_file, 'w') as fd:
+                fd.write('log\n')
+            mail = self.mail(worker, 'ann@example.org')
+            mail.add_attachment(log_file, compress=True)
+            worker.submit(mail)
+        self.assertTrue(worker.close(timeout=30))
+        self.assertIn('filename="SSTcontent.log.gz"', sink.messages[0])
+
+    def test_messages_not_sent_by_the_timeout_are_logged(self):
+        sink, worker = self.worker()
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send(message):
+            sending.set()
+            release.wait(30)
+        with mock.patch.object(worker, '_send', side_effect=send):
+            for user in ('ann', 'bob', 'cy'):
+                worker.submit(self.mail(worker, f'{user}@example.org', subject=f'Digest for {user}'))
+            sending.wait(30)
+            self.assertFalse(worker.close(timeout=0.2))
+            release.set()
+            worker.thread.join(30)
+        self.assertFalse(worker.thread.is_alive())
+        self.assertEqual(self.logger.errors,
+                         ['Email still being sent after 0.2s - abandoned, 2 queued messages not sent',
+                          'Email to bob@example.org not sent: Digest for bob',
+                          'Email to cy@example.org not sent: Digest for cy'])
+        self.assertEqual(worker.sent, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
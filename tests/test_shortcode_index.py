@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+import zipfile
+
+from new_content.shortcode_index import ShortcodeIndex, scan_text, update_index
+
+DOCUMENT = ('<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            '<w:p><w:r><w:t>Story</w:t></w:r></w:p>'
+            '<w:p><w:r><w:t>{{% singlepic image="/images/</w:t></w:r><w:r><w:t>2023/story.jpg" %}}</w:t></w:r></w:p>'
+            '</w:body></w:document>')
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+class TestScanText(unittest.TestCase):
+
+    def test_shortcodes_and_references(self):
+        text = ('Intro ![pic](/images/a.jpg?w=2)\n'
+                '{{% Gallery picnic %}}\n'
+                '{{% singlepic image="/images/b.jpg" caption="Home" %}} [link](/pages/other)\n')
+        shortcodes, references = scan_text(text)
+        self.assertEqual(shortcodes, [(2, 'gallery', '{}'),
+                                      (3, 'singlepic', '{"caption": "Home", "image": "/images/b.jpg"}')])
+        self.assertEqual(references, [(1, 'image', '/images/a.jpg'), (2, 'gallery', '/galleries/picnic'),
+                                      (3, 'image', '/images/b.jpg')])
+
+
+class TestShortcodeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sst = os.path.join(self.directory.name, 'sst')
+        self.docx = os.path.join(self.directory.name, 'docx')
+        self.images = os.path.join(self.sst, 'images')
+        self.galleries = os.path.join(self.sst, 'galleries')
+        for directory in (os.path.join(self.sst, 'pages', 'news'), self.docx, os.path.join(self.images, '2023'),
+                          os.path.join(self.galleries, 'picnic')):
+            os.makedirs(directory)
+        for name in ('2023/story.jpg', '2023/unused.jpg', 'logo.png'):
+            open(os.path.join(self.images, name), 'wb').close()
+        self.write('sst/pages/home.md', '![logo](/images/logo.png)\n{{% gallery picnic %}}\n')
+        self.write('sst/pages/news/today.md', 'News\n\n{{% singlepic image="/images/2023/missing.jpg" %}}\n')
+        self.write('docx/notes.md', 'No shortcodes\n')
+        with zipfile.ZipFile(os.path.join(self.docx, 'story.docx'), 'w') as docx:
+            docx.writestr('word/document.xml', DOCUMENT)
+        self.db_file = os.path.join(self.directory.name, 'index.db')
+        self.index = ShortcodeIndex(self.db_file)
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as fd:
+            fd.write(text)
+        return path
+
+    def update(self, max_workers=2):
+        return self.index.update(self.sst, self.docx, self.images, self.galleries, max_workers=max_workers)
+
+    def test_build_then_update_incrementally(self):
+        self.assertEqual(self.update(), (4, 0, 0, []))
+        today = os.path.join(self.sst, 'pages', 'news', 'today.md')
+        story = os.path.join(self.docx, 'story.docx')
+        self.assertEqual(self.index.broken_references(), [(today, 3, 'image', '/images/2023/missing.jpg')])
+        self.assertEqual(self.index.unused_assets(), ['/images/2023/unused.jpg'])
+        self.assertEqual(self.index.asset_uses('/images/2023/story.jpg'), [(story, 2, '/images/2023/story.jpg')])
+        self.assertEqual(self.update(), (0, 0, 4, []))
+
+        # One page fixed, one added and a document removed - only the first two are scanned
+        self.write('sst/pages/news/today.md', 'News\n\n{{% singlepic image="/images/2023/unused.jpg" %}}\n')
+        added = self.write('sst/pages/news/new.md', '[story](/images/2023/story.jpg)\n')
+        os.remove(story)
+        self.assertEqual(self.update(), (2, 1, 2, []))
+        self.assertEqual(self.index.broken_references(), [])
+        self.assertEqual(self.index.unused_assets(), [])
+        self.assertEqual(self.index.asset_uses('/images/2023/story.jpg'), [(added, 1, '/images/2023/story.jpg')])
+        self.assertEqual(self.index.shortcode_uses('SinglePic'), [(today, 3, {'image': '/images/2023/unused.jpg'})])
+        self.assertEqual(self.index.unused_assets('gallery'), [])
+
+    def test_index_persists(self):
+        self.update(max_workers=1)
+        self.index.close()
+        self.index = ShortcodeIndex(self.db_file)
+        self.assertEqual(self.update(max_workers=1), (0, 0, 4, []))
+
+    def test_unreadable_document_is_reported(self):
+        self.write('docx/broken.docx', 'Not a word document')
+        logger = ListLogger()
+        update_index(logger, self.db_file, self.sst, self.docx, self.images, self.galleries, max_workers=2)
+        self.assertEqual(logger.errors[0],
+                         f"Unable to index {os.path.join(self.docx, 'broken.docx')}: File is not a zip file")
+        self.assertEqual(logger.errors[1], f"Missing image /images/2023/missing.jpg used in "
+                                           f"{os.path.join(self.sst, 'pages', 'news', 'today.md')} (line 3)")
+        self.assertTrue(logger.info[0].endswith('5 files scanned, 0 removed, 0 unchanged - 1 broken references'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from utilities.run_log_command import BufferedLogger, log_context, run_command
+from utilities.subprocess_accounting import SubprocessAccounting, command_kind, command_template
+
+# Half a second of CPU time in the child, then one line of output
+BUSY = 'import time\nend = time.process_time() + 0.5\nwhile time.process_time() < end: pass\nprint("done")'
+
+
+class TestCommandNames(unittest.TestCase):
+
+    def test_template_hides_files_and_remotes(self):
+        self.assertEqual(command_template(['/usr/bin/rclone', 'copy', 'gdrive:stories/one', '/tmp/x',
+                                           '--drive-export-formats=docx']),
+                         'rclone copy <remote> <path> --drive-export-formats=docx')
+        self.assertEqual(command_template(['pandoc', 'a.docx', '-o', 'out', '-t', 'markdown']),
+                         'pandoc <path> -o <path> -t markdown')
+
+    def test_kind_is_program_and_rclone_subcommand(self):
+        self.assertEqual(command_kind(['/usr/bin/rclone', '--config', 'x.conf', 'lsjson', 'gdrive:']), 'rclone lsjson')
+        self.assertEqual(command_kind(['pandoc', 'a.docx']), 'pandoc')
+
+
+class TestAccounting(unittest.TestCase):
+
+    def setUp(self):
+        self.accounting = SubprocessAccounting()
+        patcher = mock.patch('utilities.run_log_command.get_accounting', return_value=self.accounting)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = BufferedLogger()
+
+    def test_cpu_time_of_the_command_is_recorded(self):
+        with log_context(folder='SSTmanagement/stories/one'):
+            run_command([sys.executable, '-c', BUSY], self.logger)
+            run_command(['sh', '-c', 'exit 2'], self.logger)
+        busy, failed = self.accounting.records
+        self.assertGreaterEqual(busy['cpu'], 0.4)
+        self.assertEqual((busy['returncode'], busy['output_bytes'], busy['folder']),
+                         (0, len('done\n'), 'SSTmanagement/stories/one'))
+        self.assertEqual((failed['kind'], failed['returncode']), ('sh', 2))
+        self.assertIsNotNone(failed['cpu'])
+
+        # The totals include the CPU time from wait4
+        (folder, count, wall, cpu, failures, output_bytes), = self.accounting.aggregate('folder')
+        self.assertEqual((folder, count, failures, output_bytes), ('SSTmanagement/stories/one', 2, 1, 5))
+        self.assertAlmostEqual(cpu, busy['cpu'] + failed['cpu'])
+        self.assertAlmostEqual(wall, busy['wall'] + failed['wall'])
+
+    def test_killed_command_is_recorded(self):
+        run_command(['sleep', '30'], self.logger, timeout=1)
+        record, = self.accounting.records
+        self.assertLess(record['returncode'], 0)
+        self.assertIsNotNone(record['cpu'])
+        self.assertEqual(self.accounting.aggregate('kind')[0][4], 1)
+
+    def test_unknown_cpu_counts_as_none_spent(self):
+        self.accounting.record(['rclone', 'copy', 'a', 'b'], 2.0, None, 0, 10)
+        self.accounting.record(['rclone', 'copy', 'c', 'd'], 1.0, 0.25, 0, 20)
+        self.accounting.record(['pandoc', 'x.docx'], 5.0, 4.0, 1, 0)
+        self.assertEqual(self.accounting.aggregate('kind'),
+                         [('pandoc', 1, 5.0, 4.0, 1, 0), ('rclone copy', 2, 3.0, 0.25, 0, 30)])
+
+    def test_report_and_json(self):
+        run_command([sys.executable, '-c', BUSY], self.logger)
+        report = BufferedLogger()
+        self.accounting.report(report)
+        lines = [entry for level, entry, fields in report.entries]
+        self.assertIn('External commands by command (1):', lines)
+        self.assertTrue(any(line.endswith(os.path.basename(sys.executable)) for line in lines))
+        with tempfile.TemporaryDirectory() as directory:
+            with open(self.accounting.write_json(os.path.join(directory, 'accounting.json'))) as fd:
+                data = json.load(fd)
+        self.assertEqual(data['by_kind'][0][:2], [os.path.basename(sys.executable), 1])
+        self.assertGreaterEqual(data['by_kind'][0][3], 0.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import asyncio
+import unittest
+from unittest import mock
+
+from system_control.exceptions import RcloneRemoteControlException as RcEx
+from system_control.transfer_scheduler import TransferScheduler
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+class TestTransferScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TransferScheduler(max_concurrency=8, min_concurrency=1, rate=1000, burst=1000,
+                                           max_retries=3, base_delay=0.01, max_delay=0.01)
+        self.logger = ListLogger()
+
+    def test_classify(self):
+        self.assertEqual(TransferScheduler.classify('ERROR : googleapi: Error 403: userRateLimitExceeded'),
+                         'throttled')
+        self.assertEqual(TransferScheduler.classify(b'Failed to copy: googleapi: Error 503: backendError'),
+                         'transient')
+        self.assertIsNone(TransferScheduler.classify('ERROR : file not found'))
+        # Only error lines count - a file name in a listing is not a rate limit
+        self.assertIsNone(TransferScheduler.classify('{"Path": "rateLimitExceeded.docx", "Size": 429}'))
+        self.assertIsNone(TransferScheduler.classify(''))
+
+    def test_rate_limit_halves_concurrency_once_per_interval(self):
+        self.scheduler._acquire()
+        self.scheduler._acquire()
+        self.scheduler._release('throttled', 0)
+        self.scheduler._release('throttled', 0)     # Same interval - no second decrease
+        self.assertEqual(self.scheduler.limit, 4)
+        self.assertEqual(self.scheduler.throttle_events, 2)
+
+    def test_concurrency_never_below_minimum(self):
+        for _ in range(6):
+            self.scheduler.last_decrease = 0
+            self.scheduler._acquire()
+            self.scheduler._release('throttled', 0)
+        self.assertEqual(self.scheduler.limit, 1)
+        self.assertEqual(self.scheduler.lowest_limit, 1)
+
+    def test_success_raises_concurrency_additively(self):
+        self.scheduler.limit = 2.0
+        for _ in range(2):
+            self.scheduler._acquire()
+            self.scheduler._release(None, 0)
+        # About one more per window of calls at the current limit
+        self.assertAlmostEqual(self.scheduler.limit, 2.0 + 1 / 2.0 + 1 / 2.5)
+        for _ in range(100):
+            self.scheduler._acquire()
+            self.scheduler._release(None, 0)
+        self.assertEqual(self.scheduler.limit, 8)
+
+    def test_throttled_operation_is_retried(self):
+        results = iter(['ERROR : googleapi: Error 403: rateLimitExceeded', 'ERROR : Error 503: backendError', 'ok'])
+        with mock.patch('system_control.transfer_scheduler.time.sleep') as sleep:
+            self.assertEqual(self.scheduler.run(self.logger, 'lsjson', lambda: next(results)), 'ok')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual((self.scheduler.calls, self.scheduler.succeeded, self.scheduler.retries), (3, 1, 2))
+        self.assertEqual(self.scheduler.limit, 4 + 1 / 4)
+        self.assertEqual(self.logger.errors, [])
+
+    def test_gives_up_after_max_retries(self):
+        with mock.patch('system_control.transfer_scheduler.time.sleep'):
+            result = self.scheduler.run(self.logger, 'copy', lambda: 'ERROR : Error 429 Too Many Requests')
+        self.assertEqual(result, 'ERROR : Error 429 Too Many Requests')
+        self.assertEqual((self.scheduler.calls, self.scheduler.failed), (4, 1))
+        self.assertEqual(len(self.logger.errors), 1)
+
+    def test_remote_control_error_not_retried_is_raised(self):
+        def operation():
+            raise RcEx('object not found')
+        with self.assertRaises(RcEx):
+            self.scheduler.run(self.logger, 'stat', operation)
+        self.assertEqual((self.scheduler.failed, self.scheduler.active), (1, 0))
+
+    def test_other_errors_release_the_slot(self):
+        def operation():
+            raise ValueError('bad')
+        with self.assertRaises(ValueError):
+            self.scheduler.run(self.logger, 'stat', operation)
+        self.assertEqual((self.scheduler.failed, self.scheduler.active), (1, 0))
+
+    def test_backoff_is_capped(self):
+        scheduler = TransferScheduler(base_delay=1, max_delay=4)
+        for attempt in range(10):
+            self.assertTrue(0 <= scheduler.backoff(attempt) <= min(4, 2 ** attempt))
+
+
+class TestRunAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TransferScheduler(max_concurrency=1, min_concurrency=1, rate=1000, burst=1000,
+                                           max_retries=3, base_delay=0.01, max_delay=0.01)
+        self.logger = ListLogger()
+
+    @staticmethod
+    async def wait_until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+
+    def test_operation_result(self):
+        async def operation():
+            return b'listing'
+        result = asyncio.run(self.scheduler.run_async(self.logger, 'list', operation))
+        self.assertEqual((result, self.scheduler.succeeded, self.scheduler.active), (b'listing', 1, 0))
+
+    def test_cancelled_while_waiting_for_a_slot(self):
+        async def operation():
+            return 'done'
+
+        async def run():
+            self.scheduler._acquire()       # The only slot is taken by a thread
+            waiting = asyncio.ensure_future(self.scheduler.run_async(self.logger, 'list', operation))
+            await asyncio.sleep(0.1)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            # The executor thread takes the slot when the thread gives it back - then it is given back too
+            self.scheduler._release(None, 0.0)
+            await self.wait_until(lambda: self.scheduler.calls == 2)
+            await self.wait_until(lambda: self.scheduler.active == 0)
+            self.assertEqual((self.scheduler.calls, self.scheduler.active), (2, 0))
+            return await asyncio.wait_for(self.scheduler.run_async(self.logger, 'list', operation), 5)
+
+        self.assertEqual(asyncio.run(run()), 'done')
+        self.assertEqual((self.scheduler.calls, self.scheduler.succeeded, self.scheduler.failed), (3, 1, 0))
+
+    def test_cancelled_while_running(self):
+        async def operation():
+            await asyncio.sleep(30)
+
+        async def run():
+            running = asyncio.ensure_future(self.scheduler.run_async(self.logger, 'copy', operation))
+            await self.wait_until(lambda: self.scheduler.active == 1)
+            running.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await running
+
+        asyncio.run(run())
+        self.assertEqual((self.scheduler.active, self.scheduler.limit, self.scheduler.failed), (0, 1.0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+import zipfile
+
+from new_content.validate_shortcodes import ValidateShortcodes, docx_paragraphs
+
+DOCUMENT = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>{}'
+            '</w:body></w:document>')
+
+
+def paragraph(*runs):
+    return '<w:p>' + ''.join(f'<w:r><w:t xml:space="preserve">{run}</w:t></w:r>' for run in runs) + '</w:p>'
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.info = []
+        self.errors = []
+
+    def make_info_entry(self, entry, **fields):
+        self.info.append(entry)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors.append(entry)
+
+
+class TestValidateDocx(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logger = ListLogger()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def docx(self, document, name='story.docx'):
+        path = os.path.join(self.directory.name, name)
+        with zipfile.ZipFile(path, 'w') as docx:
+            docx.writestr('[Content_Types].xml', '<Types/>')
+            if document is not None:
+                docx.writestr('word/document.xml', document)
+        return path
+
+    def validate(self, path):
+        return ValidateShortcodes(path, 'docx', self.logger).validate_docx()
+
+    def test_paragraphs_join_runs(self):
+        body = (paragraph('Intro ', 'text')
+                + '<w:p><w:r><w:t>a</w:t><w:tab/><w:t>b</w:t><w:br/><w:t>c</w:t></w:r></w:p>'
+                + paragraph('{{% single', 'pic image="/images/a.jpg" %}}'))
+        self.assertEqual(list(docx_paragraphs(self.docx(DOCUMENT.format(body)))),
+                         ['Intro text', 'a\tb\nc', '{{% singlepic image="/images/a.jpg" %}}'])
+
+    def test_shortcode_split_across_runs_is_checked(self):
+        body = paragraph('First') + paragraph('{{% Sing', 'lepic image="/images/a.jpg" %}}')
+        diagnostics = self.validate(self.docx(DOCUMENT.format(body)))
+        self.assertEqual([(x.message, x.line) for x in diagnostics],
+                         [('Invalid capitalization in shortcode Singlepic', 2)])
+        self.assertEqual(len(self.logger.errors), 1)
+
+    def test_valid_document(self):
+        body = paragraph('{{% box name="b1" %}}', 'Boxed', '{{% /box %}}')
+        self.assertEqual(self.validate(self.docx(DOCUMENT.format(body))), [])
+        self.assertEqual(self.logger.errors, [])
+
+    def test_file_that_is_not_a_zip(self):
+        path = os.path.join(self.directory.name, 'story.docx')
+        with open(path, 'w') as fd:
+            fd.write('Not a word document')
+        self.assertEqual(self.validate(path), [])
+        self.assertEqual(self.logger.errors, [f'Unable to read document {path}: File is not a zip file'])
+
+    def test_zip_without_document(self):
+        path = self.docx(None)
+        self.assertEqual(self.validate(path), [])
+        self.assertEqual(len(self.logger.errors), 1)
+        self.assertTrue(self.logger.errors[0].startswith(f'Unable to read document {path}: '))
+        self.assertIn('word/document.xml', self.logger.errors[0])
+
+    def test_truncated_xml(self):
+        path = self.docx(DOCUMENT.format(paragraph('Intro'))[:-len('</w:body></w:document>')])
+        self.assertEqual(self.validate(path), [])
+        self.assertEqual(len(self.logger.errors), 1)
+        self.assertTrue(self.logger.errors[0].startswith(f'Unable to read document {path}: no element found'))
+
+    def test_malformed_xml(self):
+        path = self.docx(DOCUMENT.format('<w:p><w:r><w:t>{{% box</w:r></w:p>'))
+        self.assertEqual(self.validate(path), [])
+        self.assertEqual(len(self.logger.errors), 1)
+        self.assertTrue(self.logger.errors[0].startswith(f'Unable to read document {path}: mismatched tag'))
+
+    def test_missing_file(self):
+        path = os.path.join(self.directory.name, 'missing.docx')
+        self.validate(path)
+        self.assertEqual(len(self.logger.errors), 1)
+        self.assertTrue(self.logger.errors[0].startswith(f'Unable to read document {path}: '))
+
+    def test_wrong_file_type(self):
+        ValidateShortcodes('story.md', 'md', self.logger).validate_docx()
+        self.assertEqual(self.logger.errors, ['File story.md is not of type docx'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import unittest
+
+from new_content.validate_shortcodes import ValidateShortcodes
+
+
+class TestCheckText(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = ValidateShortcodes('page.md', 'md', None)
+
+    def check(self, text):
+        return [(x.message, x.line, x.column, x.shortcode, x.attribute) for x in self.validator.check_text(text)]
+
+    def test_valid_shortcodes(self):
+        text = ('Intro\n{{% singlepic image="/images/a.jpg" alignment="left" %}}\n'
+                '{{% box name="b1" direction="left" %}}text{{% /box %}}\n')
+        self.assertEqual(self.check(text), [])
+
+    def test_unknown_shortcode_and_capitalization(self):
+        text = 'Line one\n  {{% nosuch x="1" %}}\n{{% Box name="b" %}}\n'
+        self.assertEqual(self.check(text),
+                         [('Shortcode nosuch is not a recognized shortcode.', 2, 3, 'nosuch', None),
+                          ('Invalid capitalization in shortcode Box', 3, 1, 'Box', None)])
+
+    def test_singlepic_attributes(self):
+        text = '{{% singlepic imag="/images/a.jpg" alignment="middle" %}}'
+        self.assertEqual(self.check(text),
+                         [('Unrecognized attribute imag in singlepic.', 1, 1, 'singlepic', 'imag'),
+                          ('Required attribute image not found in shortcode singlepic', 1, 1, 'singlepic', 'image'),
+                          ('Invalid alignment value middle in singlepic.', 1, 1, 'singlepic', 'alignment'),
+                          ('Missing required attribute image in singlepic.', 1, 1, 'singlepic', 'image')])
+
+    def test_unterminated_shortcode(self):
+        diagnostics = self.validator.check_text('ok\n\n{{% box name="b"\nmore')
+        self.assertEqual(len(diagnostics), 1)
+        self.assertEqual(str(diagnostics[0]), 'Shortcode box has not been terminated (no "%}}") (line 3, column 1)')
+
+    def test_shortcodes_within_a_shortcode_are_not_checked(self):
+        self.assertEqual(self.check('{{% box name="x" {{% nosuch %}} %}}'), [])
+
+    def test_each_check_starts_afresh(self):
+        self.check('{{% nosuch %}}')
+        self.assertEqual(self.check('plain text'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import bisect
+import json
+import os
+import threading
+import time
+
+# Seconds - from quick drive calls to long pandoc conversions and whole folders
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(x, '') for x in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(labels.get(x, '') for x in self.label_names)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(object):
+    """Counts of observations per bucket (cumulative on output), their sum and count."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = dict()    # labels -> [count per bucket (+Inf last), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(x, '') for x in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def samples(self):
+        res = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    res.append((self.name + '_bucket', key + (('le', str(bound)),), cumulative))
+                res.append((self.name + '_sum', key, total))
+                res.append((self.name + '_count', key, cumulative))
+        return res
+
+
+class MetricsRegistry(object):
+    """Metrics of one run, written at the end of the run for node_exporter's textfile collector.
+
+    Updating a metric is a dictionary update under a lock so it can be done from the folder workers
+    and in loops over files."""
+
+    def __init__(self, prefix='sst_'):
+        self.prefix = prefix
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help_text, label_names, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(self.prefix + name, help_text, label_names, **kwargs)
+            return metric
+
+    def counter(self, name, help_text='', label_names=()):
+        return self._get(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text='', label_names=()):
+        return self._get(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text='', label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, label_names, buckets=buckets)
+
+    @staticmethod
+    def _labels(label_names, key):
+        pairs = list(zip(label_names, key[:len(label_names)])) + list(key[len(label_names):])
+        if not pairs:
+            return ''
+        escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for name, value in pairs]
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def write_textfile(self, path):
+        """Write the metrics in the Prometheus text format - renamed into place so a scrape never sees half a file."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in sorted(metrics, key=lambda x: x.name):
+            kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{self._labels(metric.label_names, key)} {value}")
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+        return path
+
+    def write_json(self, path, **extra):
+        """Same values as write_textfile as a JSON document."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        data = dict(extra, written=time.time(), metrics=dict())
+        for metric in metrics:
+            data['metrics'][metric.name] = [
+                {'name': name, 'labels': dict(list(zip(metric.label_names, key[:len(metric.label_names)])) +
+                                              list(key[len(metric.label_names):])), 'value': value}
+                for name, key, value in metric.samples()]
+        with open(path, 'w') as fd:
+            json.dump(data, fd, indent=1)
+        return path
+
+
+# Metrics of the run - collected whether or not they are written out at the end (driver, [metrics])
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def count(name, amount=1, help_text='', **labels):
+    """Add amount to a counter, creating it on first use."""
+    _registry.counter(name, help_text, tuple(sorted(labels))).inc(amount, **labels)
+
+
+def observe(name, value, help_text='', **labels):
+    """Add an observation to a histogram of seconds, creating it on first use."""
+    _registry.histogram(name, help_text, tuple(sorted(labels))).observe(value, **labels)
+
+
+def set_gauge(name, value, help_text='', **labels):
+    _registry.gauge(name, help_text, tuple(sorted(labels))).set(value, **labels)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import cProfile
+import contextlib
+import contextvars
+import fnmatch
+import glob
+import marshal
+import os
+import pstats
+import re
+import sys
+import threading
+
+
+class SamplingProfiler(object):
+    """Low overhead profiler - samples the stack of one thread every interval seconds.
+
+    Results are written in the same (pstats) format as cProfile so the same tools read both: call
+    counts are sample counts and times are samples multiplied by the interval."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = dict()    # function -> [samples at top of stack, samples on stack, {caller: samples}]
+        self.thread_id = None
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    @staticmethod
+    def _function(code):
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def _sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            seen = set()
+            top = True
+            while frame is not None:
+                function = self._function(frame.f_code)
+                counts = self.samples.setdefault(function, [0, 0, dict()])
+                if top:
+                    counts[0] += 1
+                    top = False
+                if function not in seen:
+                    counts[1] += 1
+                    seen.add(function)
+                if frame.f_back is not None:
+                    caller = self._function(frame.f_back.f_code)
+                    counts[2][caller] = counts[2].get(caller, 0) + 1
+                frame = frame.f_back
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+        self.sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def disable(self):
+        self.stop_event.set()
+        self.sampler.join()
+
+    def dump_stats(self, path):
+        stats = dict()
+        for function, (own, total, callers) in self.samples.items():
+            stats[function] = (total, total, own * self.interval, total * self.interval,
+                               {caller: (count, count, 0.0, count * self.interval) for caller, count in callers.items()})
+        with open(path, 'wb') as fd:
+            marshal.dump(stats, fd)
+
+
+class ProfileSettings(object):
+    """Which parts of the run are profiled and where the profiles are written."""
+
+    def __init__(self, directory, run_id, phases=(), folders=(), sampling=False, interval=0.005):
+        self.directory = directory
+        self.run_id = run_id
+        self.phases = set(phases)
+        self.folders = list(folders)
+        self.sampling = sampling
+        self.interval = interval
+        self.written = []
+        self.lock = threading.Lock()
+
+    def wanted(self, phase, folder):
+        if phase in self.phases:
+            return True
+        return phase == 'folder' and folder and any(fnmatch.fnmatch(folder, x) for x in self.folders)
+
+    def profile_path(self, phase, folder):
+        name = phase if not folder else phase + '-' + re.sub(r'[^\w.-]+', '_', folder.strip('/'))
+        path = os.path.join(self.directory, f"{self.run_id}.{name}.pstats")
+        with self.lock:
+            count = 1
+            while path in self.written:     # The same phase run more than once
+                count += 1
+                path = os.path.join(self.directory, f"{self.run_id}.{name}.{count}.pstats")
+            self.written.append(path)
+        return path
+
+
+# Nothing is profiled unless configure_profiling has been called (driver, [profiling])
+_settings = None
+_profiling = contextvars.ContextVar('profiling', default=False)
+
+
+def configure_profiling(directory, run_id, phases=(), folders=(), sampling=False, interval=0.005):
+    global _settings
+    _settings = ProfileSettings(directory, run_id, phases=phases, folders=folders, sampling=sampling,
+                                interval=interval)
+    return _settings
+
+
+def profiled_files():
+    return list(_settings.written) if _settings else []
+
+
+@contextlib.contextmanager
+def profile(phase, folder=None):
+    """Profile the block if phase (or folder, for phase 'folder') is selected, writing <run id>.<phase>.pstats.
+
+    A block within one already being profiled on the same thread is part of that profile."""
+    if not _settings or _profiling.get() or not _settings.wanted(phase, folder):
+        yield
+        return
+    profiler = SamplingProfiler(_settings.interval) if _settings.sampling else cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # From Python 3.12 only one cProfile can run at a time - another folder is being profiled
+        yield
+        return
+    token = _profiling.set(True)
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling.reset(token)
+        profiler.dump_stats(_settings.profile_path(phase, folder))
+
+
+def _load(patterns):
+    files = sorted(set(path for pattern in patterns for path in (glob.glob(pattern) or [pattern])))
+    return pstats.Stats(*files), files
+
+
+def _function_name(function):
+    filename, line, name = function
+    return f"{os.path.basename(filename)}:{line}({name})" if line else name
+
+
+def diff_stats(old, new, sort='cumulative'):
+    """[(function, old seconds, new seconds)] of the functions in two sets of stats, largest change first."""
+    index = 3 if sort == 'cumulative' else 2
+    functions = set(old.stats) | set(new.stats)
+    rows = [(function, old.stats[function][index] if function in old.stats else 0.0,
+             new.stats[function][index] if function in new.stats else 0.0) for function in functions]
+    return sorted(rows, key=lambda x: abs(x[2] - x[1]), reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge, show and compare sst_utils profiles (.pstats)")
+    commands = parser.add_subparsers(dest='action', required=True)
+    show = commands.add_parser('show', help="functions taking the most time in one or more profiles")
+    show.add_argument('profiles', nargs='+', help="pstats files or glob patterns")
+    show.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'calls'])
+    show.add_argument('--top', type=int, default=30)
+    merge = commands.add_parser('merge', help="combine profiles (e.g. every folder of a run) into one")
+    merge.add_argument('output')
+    merge.add_argument('profiles', nargs='+', help="pstats files or glob patterns")
+    diff = commands.add_parser('diff', help="compare two runs - each a profile, glob or run id in --directory")
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--directory', default='.', help="where profiles named <run id>.*.pstats are")
+    diff.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime'])
+    diff.add_argument('--top', type=int, default=30)
+    args = parser.parse_args()
+
+    if args.action == 'show':
+        stats, files = _load(args.profiles)
+        stats.sort_stats(args.sort).print_stats(args.top)
+    elif args.action == 'merge':
+        stats, files = _load(args.profiles)
+        stats.dump_stats(args.output)
+        print(f"Merged {len(files)} profiles into {args.output}")
+    else:
+        runs = []
+        for run in (args.old, args.new):
+            if not run.endswith('.pstats') and not glob.has_magic(run):
+                run = os.path.join(args.directory, run + '.*.pstats')
+            runs.append(_load([run]))
+        (old, old_files), (new, new_files) = runs
+        print(f"{'old s':>10} {'new s':>10} {'change':>10} {'%':>7}  function "
+              f"({args.sort}, {len(old_files)} old and {len(new_files)} new profiles)")
+        for function, old_time, new_time in diff_stats(old, new, args.sort)[:args.top]:
+            percent = f"{(new_time - old_time) / old_time * 100:7.1f}" if old_time else '    new'
+            print(f"{old_time:10.3f} {new_time:10.3f} {new_time - old_time:+10.3f} {percent}  {_function_name(function)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,573 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import resource
 import shlex
+import signal
 import logging
+import logging.handlers
 import subprocess
+import threading
+import time
+
+from utilities import metrics, profiling, tracing
+from utilities.subprocess_accounting import get_accounting
+
+
+# One queue and writer thread (QueueListener) per log name - shared by every OvernightLogger of that name
+_listeners = dict()
+_listeners_lock = threading.Lock()
+
+# Structured copy of every entry of the run (configure_run_log) with what the run was doing at the time
+LOG_FIELDS = ('run_id', 'folder', 'command', 'phase', 'duration')
+_run_id = None
+_json_handler = None
+_log_fields = contextvars.ContextVar('log_fields', default={})
+
+
+class JsonLinesHandler(logging.Handler):
+    """Write each entry as a JSON object on its own line."""
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.stream = open(filename, 'a', encoding='utf-8')
+
+    def emit(self, record):
+        try:
+            data = {'ts': record.created, 'level': record.levelname, 'logger': record.name,
+                    'message': record.getMessage()}
+            for field in LOG_FIELDS:
+                data[field] = getattr(record, field, None)
+            self.stream.write(json.dumps(data) + '\n')
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+class _LogFieldsFilter(logging.Filter):
+    """Add the run id and the current log_context fields to entries that do not carry their own."""
+    def filter(self, record):
+        if not getattr(record, 'run_id', None):
+            record.run_id = _run_id
+        for field, value in _log_fields.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        return True
+
+
+def configure_run_log(directory, run_id):
+    """Also write every entry of every log, with its fields, to directory/run_id.jsonl."""
+    global _run_id, _json_handler
+    os.makedirs(directory, exist_ok=True)
+    _run_id = run_id
+    _json_handler = JsonLinesHandler(os.path.join(directory, run_id + '.jsonl'))
+    with _listeners_lock:
+        for log_queue, listener in _listeners.values():
+            listener.handlers = listener.handlers + (_json_handler,)
+    return _json_handler.filename
+
+
+def current_run_id():
+    return _run_id
+
+
+def current_run_log():
+    return _json_handler.filename if _json_handler else None
+
+
+def current_log_fields():
+    return dict(_log_fields.get())
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Entries logged within the block (on this thread) carry fields (folder, command, phase)."""
+    token = _log_fields.set(dict(_log_fields.get(), **fields))
+    try:
+        yield
+    finally:
+        _log_fields.reset(token)
+
+
+@contextlib.contextmanager
+def log_phase(logger, phase, **fields):
+    """Run the block in log_context(phase=phase, ...) and a trace span, and log how long it took.
+
+    The block is profiled if the phase is selected for profiling (see utilities/profiling.py)."""
+    start = time.monotonic()
+    with log_context(phase=phase, **fields), \
+            tracing.span(fields.get('command') or phase, category=phase, **fields), \
+            profiling.profile(phase, folder=_log_fields.get().get('folder')):
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            logger.make_info_entry(f"{phase} {fields.get('command') or ''} finished in {duration:.2f}s".replace('  ', ' '),
+                                   duration=round(duration, 3))
+
+
+def flush_logs():
+    """Wait until everything logged so far, in every log, has been written."""
+    with _listeners_lock:
+        for log_queue, listener in _listeners.values():
+            listener.stop()
+            listener.start()
+
+
+def _start_listener(log_name, log_directory):
+    """Create the handlers of a log once and a listener thread to write to them."""
+    # create file handler which logs even debug messages
+    fh = logging.FileHandler(log_directory + log_name + '.log', mode='w')
+    fh.setLevel(logging.INFO)
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.ERROR)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
+    log_queue = queue.Queue(-1)
+    handlers = (fh, ch, _json_handler) if _json_handler else (fh, ch)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    if not _listeners:
+        atexit.register(shutdown_logging)
+    _listeners[log_name] = (log_queue, listener)
+
+
+def shutdown_logging():
+    """Write out everything queued and close the log files."""
+    with _listeners_lock:
+        for log_queue, listener in _listeners.values():
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        _listeners.clear()
+
+
+def _queue_handler(log_queue):
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(_LogFieldsFilter())
+    return handler
 
 
 class OvernightLogger(object):
+    """Log to log_directory/log_name.log (and errors to the console).
+
+    Entries are put on a queue and written by a listener thread so logging never waits on file
+    I/O.  Loggers with the same name share the handlers, which are only created once."""
     def __init__(self, log_name, log_directory):
+        self.log_name = log_name
         self.logger = logging.getLogger(log_name)
         self.logger.setLevel(logging.INFO)
-        # create file handler which logs even debug messages
-        fh = logging.FileHandler(log_directory + log_name + '.log', mode='w')
-        fh.setLevel(logging.INFO)
-        # create console handler with a higher log level
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.ERROR)
-        # create formatter and add it to the handlers
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-        # add the handlers to the logger
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
-
-    def make_info_entry(self, entry):
-        self.logger.info(entry)
-
-    def make_error_entry(self, entry):
-        self.logger.error(entry)
+        with _listeners_lock:
+            if log_name not in _listeners:
+                _start_listener(log_name, log_directory)
+                self.logger.handlers = [_queue_handler(_listeners[log_name][0])]
+                self.logger.propagate = False
+
+    def make_info_entry(self, entry, **fields):
+        self.logger.info(entry, extra=fields)
+
+    def make_error_entry(self, entry, **fields):
+        self.logger.error(entry, extra=fields)
+
+    def flush(self):
+        """Wait until everything logged so far has been written."""
+        with _listeners_lock:
+            if self.log_name in _listeners:
+                listener = _listeners[self.log_name][1]
+                listener.stop()     # Stop writes out all queued entries before it returns
+                listener.start()
 
     def close_logger(self):
+        self.flush()
         self.logger = None
 
 
-def run_shell_command(command_line, logger, outfile=False, result_as_string=False, ignore=None):
+class BufferedLogger(object):
+    """Hold the log entries of one piece of work running in parallel with others.
+
+    Entries are written to the real logger in one block (flush_to) so the log of each folder
+    stays together and in a predictable order however the work was scheduled.  The log_context
+    fields in effect when an entry is made are kept with it.
+
+    Every error is kept but only the last max_info_entries info entries (e.g. subprocess output
+    streamed by run_command) - the older ones are dropped, and counted in a note when flushed."""
+    def __init__(self, max_info_entries=2000):
+        self.entries = []
+        self.max_info_entries = max_info_entries
+        self.info_entries = 0
+        self.omitted = 0
+
+    def make_info_entry(self, entry, **fields):
+        self.entries.append((logging.INFO, entry, dict(current_log_fields(), **fields)))
+        self.info_entries += 1
+        # Trim in batches so each entry is only copied a bounded number of times
+        if self.max_info_entries and self.info_entries > 2 * self.max_info_entries:
+            self._drop_oldest_info(self.info_entries - self.max_info_entries)
+
+    def make_error_entry(self, entry, **fields):
+        self.entries.append((logging.ERROR, entry, dict(current_log_fields(), **fields)))
+
+    def _drop_oldest_info(self, count):
+        kept = []
+        for item in self.entries:
+            if count and item[0] != logging.ERROR:
+                count -= 1
+                self.info_entries -= 1
+                self.omitted += 1
+            else:
+                kept.append(item)
+        self.entries = kept
+
+    def flush_to(self, logger):
+        if self.max_info_entries and self.info_entries > self.max_info_entries:
+            self._drop_oldest_info(self.info_entries - self.max_info_entries)
+        if self.omitted:
+            logger.make_info_entry(f"{self.omitted} earlier info entries omitted - only the last "
+                                   f"{self.max_info_entries} are kept", **self.entries[0][2])
+        for level, entry, fields in self.entries:
+            if level == logging.ERROR:
+                logger.make_error_entry(entry, **fields)
+            else:
+                logger.make_info_entry(entry, **fields)
+        self.entries = []
+        self.info_entries = 0
+        self.omitted = 0
+
+
+class ErrorCountingLogger(object):
+    """Pass entries on to logger, counting the errors - to tell whether a piece of work logged any."""
+    def __init__(self, logger):
+        self.logger = logger
+        self.errors = 0
+
+    def make_info_entry(self, entry, **fields):
+        self.logger.make_info_entry(entry, **fields)
+
+    def make_error_entry(self, entry, **fields):
+        self.errors += 1
+        self.logger.make_error_entry(entry, **fields)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+class CommandResult(object):
+    """Outcome of run_command.
+
+    stdout holds the standard output if it was captured, tail the last lines of everything else
+    the command wrote (standard error and uncaptured standard output)."""
+    def __init__(self, command_line, returncode, stdout, tail, timed_out=None):
+        self.command_line = command_line
+        self.returncode = returncode
+        self.stdout = stdout
+        self.tail = tail
+        self.timed_out = timed_out  # None, 'wall' or 'idle'
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def output_text(self):
+        return '\n'.join(self.tail)
+
+
+# Limits applied to every command unless the caller gives its own (None = no limit)
+_command_timeout = None
+_command_idle_timeout = None
+
+
+def configure_command_timeouts(timeout=None, idle_timeout=None):
+    """Set the default wall clock limit and the longest a command may go without writing any output."""
+    global _command_timeout, _command_idle_timeout
+    _command_timeout = timeout
+    _command_idle_timeout = idle_timeout
+
+
+def _wait_process(process, timeout):
+    """Wait up to timeout seconds for a command to end and return its resource usage (None if not known).
+
+    Same as process.wait but reaps the process with os.wait4, which also gives the CPU time it used.
+    Raises subprocess.TimeoutExpired."""
+    if not hasattr(os, 'wait4') or process.returncode is not None:
+        process.wait(timeout=timeout)
+        return None
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            process.wait(timeout=timeout)
+            return None
+        if pid:
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            return rusage
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def _kill_process_group(process):
+    """Stop a command and anything it started - it runs in its own session (start_new_session).
+
+    Returns the resource usage of the command."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return _wait_process(process, 5)
+        try:
+            return _wait_process(process, 5)
+        except subprocess.TimeoutExpired:
+            continue
+    return None
+
+
+def run_command(command, logger, capture_stdout=False, timeout=None, idle_timeout=None, tail_lines=200,
+                log_output=True):
+    """Run a command (string or argument list), streaming its output line by line to the logger.
+
+    Only the last tail_lines lines are kept in memory, plus the standard output if capture_stdout is
+    set (command output that is data - e.g. a listing).  The command is killed, with any process
+    it started, when it runs longer than timeout or writes nothing for idle_timeout seconds.
+    Raises OSError if the command cannot be started."""
+    args, command_line, timeout, idle_timeout = _command_args(command, timeout, idle_timeout)
+    logger.make_info_entry('Subprocess: {}'.format(command_line))
+
+    with tracing.span('subprocess ' + os.path.basename(args[0]), category='subprocess', command=command_line[:200]):
+        tracing.add_to_span(subprocesses=1)
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        _command_started()
+        tail = collections.deque(maxlen=tail_lines)
+        stdout = []
+        last_output = [time.monotonic()]
+        output_bytes = [0, 0]
+
+        def pump(stream, capture):
+            for line in iter(stream.readline, b''):
+                last_output[0] = time.monotonic()
+                output_bytes[capture] += len(line)
+                if capture:
+                    stdout.append(line)
+                    continue
+                text = line.decode('utf-8', errors='replace').rstrip()
+                tail.append(text)
+                if log_output and text:
+                    logger.make_info_entry('    ' + text)
+            stream.close()
+
+        # Output lines are logged with the folder, command and phase of the caller (log_context)
+        readers = [threading.Thread(target=contextvars.copy_context().run, args=(pump, process.stdout, capture_stdout),
+                                    daemon=True),
+                   threading.Thread(target=contextvars.copy_context().run, args=(pump, process.stderr, False),
+                                    daemon=True)]
+        for reader in readers:
+            reader.start()
+        started = time.monotonic()
+        timed_out = None
+        while True:
+            try:
+                rusage = _wait_process(process, 0.5)
+                break
+            except subprocess.TimeoutExpired:
+                now = time.monotonic()
+                if timeout and now - started > timeout:
+                    timed_out = 'wall'
+                elif idle_timeout and now - last_output[0] > idle_timeout:
+                    timed_out = 'idle'
+                if timed_out:
+                    rusage = _kill_process_group(process)
+                    break
+        for reader in readers:
+            reader.join(timeout=5)
+
+        result = CommandResult(command_line, process.returncode, b''.join(stdout) if capture_stdout else None,
+                               list(tail), timed_out)
+        _report_result(result, logger, timeout, idle_timeout)
+        cpu = rusage.ru_utime + rusage.ru_stime if rusage else None
+        _account_command(args, time.monotonic() - started, cpu, process.returncode, sum(output_bytes))
+        return result
+
+
+def _account_command(args, elapsed, cpu, returncode, output_bytes):
+    command = os.path.basename(args[0])
+    metrics.count('subprocess_spawns_total', help_text="External commands run", command=command)
+    metrics.observe('subprocess_duration_seconds', elapsed, help_text="Run time of external commands", command=command)
+    get_accounting().record(args, elapsed, cpu, returncode, output_bytes, folder=_log_fields.get().get('folder'))
+    with _commands_lock:
+        _commands['finished'] += 1
+
+
+# Commands started and finished so far - the children's CPU time is a command's own if no other ran alongside it
+_commands = {'started': 0, 'finished': 0}
+_commands_lock = threading.Lock()
+
+
+def _command_started():
+    """Count a command as started and return (commands started, whether others are running)."""
+    with _commands_lock:
+        _commands['started'] += 1
+        return _commands['started'], _commands['started'] - _commands['finished'] > 1
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _command_args(command, timeout, idle_timeout):
+    args = shlex.split(command) if isinstance(command, str) else [str(x) for x in command]
+    command_line = command if isinstance(command, str) else ' '.join(args)
+    timeout = timeout if timeout is not None else _command_timeout
+    idle_timeout = idle_timeout if idle_timeout is not None else _command_idle_timeout
+    return args, command_line, timeout, idle_timeout
+
+
+def _report_result(result, logger, timeout, idle_timeout):
+    if result.timed_out == 'wall':
+        logger.make_error_entry(f"Subprocess killed after running for more than {timeout} seconds: "
+                                f"{result.command_line}")
+    elif result.timed_out == 'idle':
+        logger.make_error_entry(f"Subprocess killed after {idle_timeout} seconds without output: {result.command_line}")
+    elif result.returncode != 0:
+        last_lines = '\n\t\t'.join(result.tail[-20:])
+        logger.make_error_entry(f"Subprocess exited with code {result.returncode}: {result.command_line}" +
+                                (f"\n\t\t{last_lines}" if last_lines else ''))
+
+
+async def _kill_process_group_async(process):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def run_command_async(command, logger, capture_stdout=False, timeout=None, idle_timeout=None, tail_lines=200,
+                            log_output=True):
+    """Coroutine version of run_command, for use within an asyncio event loop."""
+    args, command_line, timeout, idle_timeout = _command_args(command, timeout, idle_timeout)
+    logger.make_info_entry('Subprocess: {}'.format(command_line))
+
+    with tracing.span('subprocess ' + os.path.basename(args[0]), category='subprocess', command=command_line[:200]):
+        tracing.add_to_span(subprocesses=1)
+        cpu_before = _children_cpu()
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE, start_new_session=True,
+                                                       limit=1024 * 1024)
+        started_count, shared = _command_started()
+        tail = collections.deque(maxlen=tail_lines)
+        stdout = []
+        last_output = [time.monotonic()]
+        output_bytes = [0, 0]
+
+        async def pump(stream, capture):
+            while True:
+                # Captured output (a listing) is data - read in blocks as it need not have line breaks
+                line = await (stream.read(65536) if capture else stream.readline())
+                if not line:
+                    break
+                last_output[0] = time.monotonic()
+                output_bytes[capture] += len(line)
+                if capture:
+                    stdout.append(line)
+                    continue
+                text = line.decode('utf-8', errors='replace').rstrip()
+                tail.append(text)
+                if log_output and text:
+                    logger.make_info_entry('    ' + text)
+
+        readers = [asyncio.ensure_future(pump(process.stdout, capture_stdout)),
+                   asyncio.ensure_future(pump(process.stderr, False))]
+        started = time.monotonic()
+        timed_out = None
+        while True:
+            try:
+                await asyncio.wait_for(process.wait(), 0.5)
+                break
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                if timeout and now - started > timeout:
+                    timed_out = 'wall'
+                elif idle_timeout and now - last_output[0] > idle_timeout:
+                    timed_out = 'idle'
+                if timed_out:
+                    await _kill_process_group_async(process)
+                    break
+        done, pending = await asyncio.wait(readers, timeout=5)
+        for reader in pending:
+            reader.cancel()
+
+        result = CommandResult(command_line, process.returncode, b''.join(stdout) if capture_stdout else None,
+                               list(tail), timed_out)
+        _report_result(result, logger, timeout, idle_timeout)
+        # The event loop's child watcher reaps the process - only the total of all children is available
+        cpu = _children_cpu() - cpu_before if not shared and started_count == _commands['started'] else None
+        _account_command(args, time.monotonic() - started, cpu, process.returncode, sum(output_bytes))
+        return result
+
+
+def run_shell_command(command_line, logger, outfile=False, result_as_string=False, ignore=None,
+                      timeout=None, idle_timeout=None):
     command_line_plus = command_line
     if ignore:
         command_line_plus += " --exclude=" + ignore
-    command_line_args = shlex.split(command_line_plus)
-    cmd = command_line_args[0]
-
-    logger.make_info_entry('Subprocess: {}'.format(command_line_plus))
+    cmd = shlex.split(command_line_plus)[0]
 
     try:
-        command_line_process = subprocess.Popen(
-            command_line_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-
-        process_output, process_error = command_line_process.communicate()
-        if process_error:
-            logger.make_error_entry(f"Error returned from subprocess with command line:\n\t\t{command_line_plus}" +
-                                    f"\n\nError:\n\t\t{process_error}")
-        logger.make_info_entry(f"Command output (first 1000 chars):\n\n{process_output[:1000]}")
+        result = run_command(command_line_plus, logger, capture_stdout=bool(outfile or result_as_string),
+                             timeout=timeout, idle_timeout=idle_timeout)
         if outfile:
             with open(outfile, 'wb') as fl:
-                fl.write(process_output)
-
-        # logger.make_info_entry(process_output)
-        # logger.make_info_entry(process_error)
-    except (OSError, subprocess.CalledProcessError) as exception:
+                fl.write(result.stdout)
+    except OSError as exception:
         logger.make_error_entry('Exception occurred in {}: {}'.format(cmd, exception))
         logger.make_error_entry('Subprocess {} failed'.format(cmd))
         return False
-    else:
-        # no exception was raised
-        # logger.make_info_entry('Subprocess {} completed'.format(cmd))
-        if result_as_string:
-            return process_output
-    return True
+    if result_as_string:
+        return result.stdout
+    return result.ok
+
 
+async def run_shell_command_async(command_line, logger, outfile=False, result_as_string=False, ignore=None,
+                                  timeout=None, idle_timeout=None):
+    """Coroutine version of run_shell_command."""
+    command_line_plus = command_line
+    if ignore:
+        command_line_plus += " --exclude=" + ignore
+    cmd = shlex.split(command_line_plus)[0]
 
+    try:
+        result = await run_command_async(command_line_plus, logger, capture_stdout=bool(outfile or result_as_string),
+                                         timeout=timeout, idle_timeout=idle_timeout)
+        if outfile:
+            with open(outfile, 'wb') as fl:
+                fl.write(result.stdout)
+    except OSError as exception:
+        logger.make_error_entry('Exception occurred in {}: {}'.format(cmd, exception))
+        logger.make_error_entry('Subprocess {} failed'.format(cmd))
+        return False
+    if result_as_string:
+        return result.stdout
+    return result.ok
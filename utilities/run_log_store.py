@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Run logs and their index live in this subdirectory of the logs directory
+RUN_LOG_DIRECTORY = 'runs'
+# Entries of these phases enclose other commands - leave them out of per command timings
+CONTAINER_COMMANDS = ('all', 'process_single_folder')
+
+
+class RunLogStore(object):
+    """Index of the structured (JSON lines) logs of past runs.
+
+    Each run writes logs_directory/runs/<run_id>.jsonl (see configure_run_log in run_log_command).
+    After the run it is loaded here so errors and timings can be looked up by run, folder and command
+    without reading the text logs.  Only the newest runs are kept; older run files are compressed."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started REAL, "
+                                "finished REAL, records INTEGER, errors INTEGER, log_file TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (run_id TEXT, ts REAL, level TEXT, "
+                                "logger TEXT, folder TEXT, command TEXT, phase TEXT, duration REAL, message TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_run ON records (run_id, level)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_folder ON records (folder, level)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_duration ON records (ts, duration)")
+        self.connection.commit()
+
+    def ingest(self, run_id, log_file):
+        """Load the JSON lines log of a run, replacing anything loaded for it before.  Returns records loaded."""
+        rows = []
+        opener = gzip.open if log_file.endswith('.gz') else open
+        with opener(log_file, 'rt', encoding='utf-8') as stream:
+            for line in stream:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue    # A line cut short by a crash
+                rows.append((run_id, data.get('ts'), data.get('level'), data.get('logger'), data.get('folder'),
+                             data.get('command'), data.get('phase'), data.get('duration'), data.get('message')))
+        errors = sum(1 for row in rows if row[2] == 'ERROR')
+        times = [row[1] for row in rows if row[1]]
+        with self.lock:
+            self.connection.execute("DELETE FROM records WHERE run_id = ?", (run_id,))
+            self.connection.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                                    (run_id, min(times) if times else None, max(times) if times else None,
+                                     len(rows), errors, log_file))
+            self.connection.commit()
+        return len(rows)
+
+    def apply_retention(self, keep_runs=60, compress_after=5):
+        """Drop runs beyond the newest keep_runs and gzip the log files of all but the newest compress_after."""
+        with self.lock:
+            runs = self.connection.execute("SELECT run_id, log_file FROM runs ORDER BY started DESC").fetchall()
+            for run_id, log_file in runs[keep_runs:]:
+                self.connection.execute("DELETE FROM records WHERE run_id = ?", (run_id,))
+                self.connection.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+                # The run log and anything else written for the run (trace, ...) is named <run_id>.*
+                if log_file and os.path.isdir(os.path.dirname(log_file)):
+                    for name in os.listdir(os.path.dirname(log_file)):
+                        if name.startswith(run_id + '.'):
+                            os.remove(os.path.join(os.path.dirname(log_file), name))
+            for run_id, log_file in runs[compress_after:keep_runs]:
+                if log_file and not log_file.endswith('.gz') and os.path.exists(log_file):
+                    with open(log_file, 'rb') as source, gzip.open(log_file + '.gz', 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                    os.remove(log_file)
+                    self.connection.execute("UPDATE runs SET log_file = ? WHERE run_id = ?", (log_file + '.gz', run_id))
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+
+    def runs(self, limit=10):
+        """(run_id, started, finished, records, errors) of the newest runs."""
+        with self.lock:
+            return self.connection.execute("SELECT run_id, started, finished, records, errors FROM runs "
+                                           "ORDER BY started DESC LIMIT ?", (limit,)).fetchall()
+
+    def run_records(self, run_id, level=None):
+        """(ts, level, folder, command, message) of a run, errors only if level is 'ERROR'."""
+        query = "SELECT ts, level, folder, command, message FROM records WHERE run_id = ?"
+        params = [run_id]
+        if level:
+            query += " AND level = ?"
+            params.append(level)
+        with self.lock:
+            return self.connection.execute(query + " ORDER BY ts", params).fetchall()
+
+    def run_folder_records(self, run_id, folder, level=None):
+        """(ts, level, folder, command, message) of a run logged for folder or its subfolders."""
+        query = ("SELECT ts, level, folder, command, message FROM records "
+                 "WHERE run_id = ? AND (folder = ? OR folder LIKE ?)")
+        params = [run_id, folder, folder.rstrip('/') + '/%']
+        if level:
+            query += " AND level = ?"
+            params.append(level)
+        with self.lock:
+            return self.connection.execute(query + " ORDER BY ts", params).fetchall()
+
+    def run_folder_timings(self, run_id, folder):
+        """(folder, command, seconds) of the commands run in folder or its subfolders, slowest first."""
+        placeholders = ', '.join('?' for _ in CONTAINER_COMMANDS)
+        with self.lock:
+            return self.connection.execute(
+                f"SELECT folder, command, duration FROM records WHERE run_id = ? AND (folder = ? OR folder LIKE ?) "
+                f"AND phase = 'command' AND duration IS NOT NULL AND command NOT IN ({placeholders}) "
+                f"ORDER BY duration DESC", (run_id, folder, folder.rstrip('/') + '/%', *CONTAINER_COMMANDS)).fetchall()
+
+    def errors_for_folder(self, folder, last_runs=5):
+        """(run_id, ts, command, message) of errors logged for folder (or its subfolders) in the newest runs."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT run_id, ts, command, message FROM records WHERE level = 'ERROR' "
+                "AND (folder = ? OR folder LIKE ?) AND run_id IN "
+                "(SELECT run_id FROM runs ORDER BY started DESC LIMIT ?) ORDER BY ts",
+                (folder, folder.rstrip('/') + '/%', last_runs)).fetchall()
+
+    def slowest_folders(self, days=7, limit=10):
+        """(folder, total seconds, commands timed, slowest command seconds) over the last days."""
+        since = time.time() - days * 86400
+        placeholders = ', '.join('?' for _ in CONTAINER_COMMANDS)
+        with self.lock:
+            return self.connection.execute(
+                f"SELECT folder, SUM(duration), COUNT(*), MAX(duration) FROM records WHERE ts >= ? "
+                f"AND duration IS NOT NULL AND folder IS NOT NULL AND phase = 'command' "
+                f"AND command NOT IN ({placeholders}) GROUP BY folder ORDER BY SUM(duration) DESC LIMIT ?",
+                (since, *CONTAINER_COMMANDS, limit)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def run_log_directory(logs_directory):
+    return os.path.join(logs_directory, RUN_LOG_DIRECTORY)
+
+
+def run_log_db(logs_directory):
+    return os.path.join(logs_directory, RUN_LOG_DIRECTORY, 'run_logs.sqlite')
+
+
+def _format_time(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)) if ts else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the index of sst_utils run logs")
+    parser.add_argument('db_file', help="run log index (logs_directory/runs/run_logs.sqlite)")
+    commands = parser.add_subparsers(dest='query', required=True)
+    commands.add_parser('runs', help="newest runs").add_argument('--limit', type=int, default=10)
+    errors = commands.add_parser('errors', help="errors of a run (default the newest)")
+    errors.add_argument('run_id', nargs='?')
+    folder = commands.add_parser('folder', help="errors for a folder over the last runs")
+    folder.add_argument('folder')
+    folder.add_argument('--runs', type=int, default=5)
+    slowest = commands.add_parser('slowest', help="folders taking the most command time")
+    slowest.add_argument('--days', type=int, default=7)
+    slowest.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    store = RunLogStore(args.db_file)
+    if args.query == 'runs':
+        for run_id, started, finished, records, errors in store.runs(args.limit):
+            print(f"{run_id}  {_format_time(started)}  {(finished or 0) - (started or 0):8.1f}s  "
+                  f"{records:6d} records  {errors:4d} errors")
+    elif args.query == 'errors':
+        run_id = args.run_id or (store.runs(1) or [[None]])[0][0]
+        for ts, level, folder, command, message in store.run_records(run_id, level='ERROR'):
+            print(f"{_format_time(ts)}  {folder or '-'}  {command or '-'}  {message}")
+    elif args.query == 'folder':
+        for run_id, ts, command, message in store.errors_for_folder(args.folder, args.runs):
+            print(f"{run_id}  {_format_time(ts)}  {command or '-'}  {message}")
+    else:
+        for folder, total, count, slowest_command in store.slowest_folders(args.days, args.limit):
+            print(f"{total:9.1f}s  {count:5d} commands  slowest {slowest_command:8.1f}s  {folder}")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
+import gzip
+import queue
 import smtplib
 import ssl
+import threading
 from email.message import EmailMessage
 
 
 class ManageEmail(object):
-    def __init__(self, sender, password, smtp_server, smtp_port):
+    def __init__(self, sender, password, smtp_server, smtp_port, starttls=True):
         self.smtp_server = smtp_server
         self.port = smtp_port
         self.sender_email = sender
         self.password = password
+        self.starttls = starttls
         self.recipients = []
         self.subject = None
         self.attachments = []
@@ -21,13 +25,14 @@ class ManageEmail(object):
     def set_subject(self, subject):
         self.subject = subject
 
-    def add_attachment(self, attachment_path):
-        self.attachments.append(attachment_path)
+    def add_attachment(self, attachment_path, compress=False):
+        """Attach a text file, gzipped if compress is set."""
+        self.attachments.append((attachment_path, compress))
 
     def set_body(self, body):
         self.body = body
 
-    def send_email(self):
+    def build_message(self):
         if not self.recipients:
             raise ValueError("Attempt to send email with no recipients.")
         if not self.subject:
@@ -38,32 +43,150 @@ class ManageEmail(object):
         message = EmailMessage()
         message['Subject'] = self.subject
         message['From'] = self.sender_email
-        receiver_email = self.recipients[0]
-        if len(self.recipients) > 1:
-            for receiver in self.recipients[1:]:
-                receiver_email += ', ' + receiver
-        message['To'] = receiver_email
+        message['To'] = ', '.join(self.recipients)
         message.preamble = 'Message received by non-MIME-aware mail reader.\n'
         message.set_content(self.body)
 
-        for path in self.attachments:
+        for path, compress in self.attachments:
             filename = path.split('/')[-1]
             with open(path, 'rb') as fp:
-                message.add_attachment(fp.read(), maintype='text', subtype='plain',
-                                       filename=filename)
+                data = fp.read()
+            if compress:
+                message.add_attachment(gzip.compress(data), maintype='application', subtype='gzip',
+                                       filename=filename + '.gz')
+            else:
+                message.add_attachment(data, maintype='text', subtype='plain', filename=filename)
+        return message
 
-        # Create a secure SSL context
-        context = ssl.create_default_context()
+    def connect(self):
+        """Open and log in to an SMTP session."""
+        server = smtplib.SMTP(self.smtp_server, self.port)
+        try:
+            server.ehlo()
+            if self.starttls:
+                # Create a secure SSL context
+                server.starttls(context=ssl.create_default_context())  # Secure the connection
+                server.ehlo()
+            if self.password:
+                server.login(self.sender_email, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
 
-        # Try to log in to server and send email
+    def send_email(self):
+        message = self.build_message()
+        server = self.connect()
         try:
-            server = smtplib.SMTP(self.smtp_server, self.port)
-            server.ehlo()  # Can be omitted
-            server.starttls(context=context)  # Secure the connection
-            server.ehlo()  # Can be omitted
-            server.login(self.sender_email, self.password)
             server.send_message(message)
-        except Exception as e:
-            raise e
         finally:
             server.quit()
+
+
+class MailWorker(object):
+    """Send messages from a background thread over one SMTP session.
+
+    The session is opened for the first message and reused for the rest; it is reopened once if
+    the server has dropped it.  Messages are built when queued so their attachments are read then."""
+
+    def __init__(self, sender, password, smtp_server, smtp_port, logger, starttls=True):
+        self.account = ManageEmail(sender, password, smtp_server, smtp_port, starttls=starttls)
+        self.logger = logger
+        self.queue = queue.Queue()
+        self.server = None
+        self.sent = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name='mail', daemon=True)
+        self.thread.start()
+
+    def new_email(self):
+        """A ManageEmail using this worker's account - fill it in and pass it to submit."""
+        account = self.account
+        return ManageEmail(account.sender_email, account.password, account.smtp_server, account.port,
+                           starttls=account.starttls)
+
+    def submit(self, mail):
+        try:
+            self.queue.put(mail.build_message())
+        except (OSError, ValueError) as e:
+            self.failed += 1
+            self.logger.make_error_entry(f"Unable to build email to {', '.join(mail.recipients)}: {e}")
+
+    def _send(self, message):
+        for attempt in range(2):
+            if not self.server:
+                self.server = self.account.connect()
+            try:
+                self.server.send_message(message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+                if attempt:
+                    raise
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self._send(message)
+                self.sent += 1
+            except (OSError, smtplib.SMTPException) as e:
+                self.failed += 1
+                self.logger.make_error_entry(f"Unable to send email to {message['To']}: {e}")
+        if self.server:
+            try:
+                self.server.quit()
+            except (OSError, smtplib.SMTPException):
+                pass
+            self.server = None
+
+    def close(self, timeout=300):
+        """Send what is queued and end the session.  Returns False if still sending after timeout seconds.
+
+        Messages not sent by then are dropped - each is logged - and the message being sent is left to the
+        thread, which dies with the process."""
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            dropped = self._drop_queued()
+            self.logger.make_error_entry(f"Email still being sent after {timeout}s - abandoned, "
+                                         f"{len(dropped)} queued messages not sent")
+            for message in dropped:
+                self.logger.make_error_entry(f"Email to {message['To']} not sent: {message['Subject']}")
+            return False
+        self.logger.make_info_entry(f"Email: {self.sent} sent, {self.failed} failed")
+        return True
+
+    def _drop_queued(self):
+        """Take the messages not yet sent off the queue and return them."""
+        dropped = []
+        while True:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if message is not None:
+                dropped.append(message)
+        self.queue.put(None)    # The thread still ends once it is done with the message it is sending
+        return dropped
+
+
+# One worker sends all mail of the run - started on first use, closed at the end of the run (driver).
+_mail_worker = None
+
+
+def start_mail_worker(sender, password, smtp_server, smtp_port, logger, starttls=True):
+    global _mail_worker
+    if not _mail_worker:
+        _mail_worker = MailWorker(sender, password, smtp_server, smtp_port, logger, starttls=starttls)
+    return _mail_worker
+
+
+def stop_mail_worker(timeout=300):
+    """Send what is queued - messages still not sent after timeout seconds are logged and dropped."""
+    global _mail_worker
+    if _mail_worker:
+        _mail_worker.close(timeout)
+        _mail_worker = None
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import json
+import os
+import re
+import threading
+
+# Command line arguments that name a file or drive location rather than say what the command does
+REMOTE_ARG = re.compile(r'^\w[\w-]*:')
+PATH_ARG = re.compile(r'[/\\]|\.\w{1,5}$')
+RCLONE_COMMANDS = {'cat', 'check', 'copy', 'copyto', 'delete', 'deletefile', 'ls', 'lsd', 'lsf', 'lsjson', 'mkdir',
+                   'move', 'moveto', 'purge', 'rc', 'rcd', 'rmdir', 'size', 'sync'}
+
+
+def command_template(args):
+    """The command line with file and drive paths replaced, so runs on different files group together."""
+    template = [os.path.basename(args[0])]
+    for arg in args[1:]:
+        option, sep, value = arg.partition('=') if arg.startswith('--') else ('', '', arg)
+        if REMOTE_ARG.match(value):
+            value = '<remote>'
+        elif PATH_ARG.search(value) or (template[-1] in ('-o', '--output') and not sep):
+            value = '<path>'
+        template.append(option + sep + value)
+    return ' '.join(template)
+
+
+def command_kind(args):
+    """Program and, for rclone, its subcommand (e.g. 'rclone copy', 'pandoc')."""
+    program = os.path.basename(args[0])
+    if program == 'rclone':
+        # Options come before or after the subcommand and some take a value - look for a known subcommand
+        subcommand = next((x for x in args[1:] if x in RCLONE_COMMANDS), '')
+        return f"{program} {subcommand}".strip()
+    return program
+
+
+class SubprocessAccounting(object):
+    """Record of each external command of the run - wall time, CPU time, exit status, output size.
+
+    CPU time is that of the command and the processes it waited for: from os.wait4, or for commands run in
+    the event loop the change in resource.getrusage(RUSAGE_CHILDREN) when no other command ran alongside
+    (None if not known).
+    Records are aggregated by command kind and by folder at the end of the run."""
+
+    def __init__(self, max_records=100000):
+        self.max_records = max_records
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, args, wall, cpu, returncode, output_bytes, folder=None):
+        entry = {'kind': command_kind(args), 'template': command_template(args), 'folder': folder,
+                 'wall': wall, 'cpu': cpu, 'returncode': returncode, 'output_bytes': output_bytes}
+        with self.lock:
+            if len(self.records) < self.max_records:
+                self.records.append(entry)
+
+    def aggregate(self, key):
+        """(key value, count, wall seconds, cpu seconds, failures, output bytes) by record key, most wall time first."""
+        totals = dict()
+        with self.lock:
+            records = list(self.records)
+        for entry in records:
+            count, wall, cpu, failures, output_bytes = totals.get(entry[key], (0, 0.0, 0.0, 0, 0))
+            totals[entry[key]] = (count + 1, wall + entry['wall'], cpu + (entry['cpu'] or 0.0),
+                                  failures + (entry['returncode'] != 0), output_bytes + entry['output_bytes'])
+        return sorted(((value,) + row for value, row in totals.items()), key=lambda x: x[2], reverse=True)
+
+    def report(self, logger, top=15):
+        if not self.records:
+            return
+        for key, title in (('kind', 'command'), ('template', 'command line'), ('folder', 'folder')):
+            rows = self.aggregate(key)
+            logger.make_info_entry(f"External commands by {title} ({len(rows)}):")
+            logger.make_info_entry(f"    {'wall s':>9} {'cpu s':>8} {'count':>6} {'failed':>6} {'out KB':>8}  {title}")
+            for value, count, wall, cpu, failures, output_bytes in rows[:top]:
+                logger.make_info_entry(f"    {wall:9.2f} {cpu:8.2f} {count:6d} {failures:6d} {output_bytes / 1024:8.1f}  "
+                                       f"{value or '-'}")
+
+    def write_json(self, path):
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w') as fd:
+            json.dump({'records': records, 'by_kind': self.aggregate('kind'), 'by_folder': self.aggregate('folder')},
+                      fd, indent=1)
+        return path
+
+
+# Every command run through run_command/run_command_async is recorded here
+_accounting = SubprocessAccounting()
+
+
+def get_accounting():
+    return _accounting
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """One timed piece of work.  Folder is inherited from the enclosing span if not given."""
+    __slots__ = ('name', 'category', 'start', 'end', 'thread', 'parent', 'fields', 'bytes', 'subprocesses')
+
+    def __init__(self, name, category, parent, fields):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.fields = fields
+        if parent and 'folder' not in fields and 'folder' in parent.fields:
+            fields['folder'] = parent.fields['folder']
+        self.thread = threading.current_thread().name
+        self.bytes = 0
+        self.subprocesses = 0
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Tracer(object):
+    """Collect the spans of a run for a Chrome trace (chrome://tracing, Perfetto) and a summary table."""
+
+    def __init__(self, max_spans=200000):
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.wall_origin = time.time()
+
+    def record(self, span):
+        with self.lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def export_chrome_trace(self, path):
+        """Write the spans as Chrome trace 'complete' events - one track per thread."""
+        with self.lock:
+            spans = list(self.spans)
+        threads = sorted({span.thread for span in spans})
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': threads.index(thread),
+                   'args': {'name': thread}} for thread in threads]
+        for span in spans:
+            args = dict(span.fields)
+            if span.bytes:
+                args['bytes'] = span.bytes
+            if span.subprocesses:
+                args['subprocesses'] = span.subprocesses
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': os.getpid(),
+                           'tid': threads.index(span.thread), 'ts': round((span.start - self.origin) * 1e6),
+                           'dur': round(span.duration * 1e6), 'args': args})
+        with open(path, 'w') as fd:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'started': self.wall_origin}}, fd, default=str)
+        return path
+
+    def summary(self):
+        """(name, count, total seconds, max seconds, bytes, subprocesses) per span name, longest total first."""
+        totals = dict()
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            count, total, longest, transferred, subprocesses = totals.get(span.name, (0, 0.0, 0.0, 0, 0))
+            totals[span.name] = (count + 1, total + span.duration, max(longest, span.duration),
+                                 transferred + span.bytes, subprocesses + span.subprocesses)
+        return sorted(((name,) + values for name, values in totals.items()), key=lambda x: x[2], reverse=True)
+
+    def report(self, logger, top=20):
+        rows = self.summary()
+        logger.make_info_entry(f"Slowest of {len(rows)} traced operations ({len(self.spans)} spans"
+                               f"{f', {self.dropped} not recorded' if self.dropped else ''}):")
+        logger.make_info_entry(f"    {'total s':>9} {'max s':>8} {'count':>6} {'MB':>8} {'procs':>6}  name")
+        for name, count, total, longest, transferred, subprocesses in rows[:top]:
+            logger.make_info_entry(f"    {total:9.2f} {longest:8.2f} {count:6d} {transferred / 1e6:8.1f} "
+                                   f"{subprocesses:6d}  {name}")
+
+
+# Spans are only recorded once configure_tracing has been called (driver, [performance] tracing)
+_tracer = None
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def configure_tracing(max_spans=200000):
+    global _tracer
+    _tracer = Tracer(max_spans=max_spans)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+@contextlib.contextmanager
+def span(name, category='run', **fields):
+    """Time the block as a span (nested in the span the block is run from, on this thread)."""
+    if not _tracer:
+        yield None
+        return
+    current = Span(name, category, _current_span.get(), fields)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+        if current.parent:
+            # Counts include everything done within the span, like its duration
+            current.parent.bytes += current.bytes
+            current.parent.subprocesses += current.subprocesses
+        _tracer.record(current)
+
+
+def traced(name=None, category='function'):
+    """Decorator - run each call of the function in a span named name (default its qualified name)."""
+    def decorate(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _tracer:
+                return func(*args, **kwargs)
+            with span(span_name, category=category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def add_to_span(transferred=0, subprocesses=0):
+    """Count bytes transferred and subprocesses run against the current span (and so the spans enclosing it)."""
+    current = _current_span.get()
+    if current:
+        current.bytes += transferred
+        current.subprocesses += subprocesses